@@ -4,6 +4,7 @@
 
 use std::io;
 use std::io::ErrorKind;
+use std::io::IoSlice;
 use std::io::Read;
 use std::io::Write;
 use std::mem;
@@ -557,6 +558,88 @@ pub struct Rframe {
     pub msg: Rmessage,
 }
 
+impl Rframe {
+    fn message_type(&self) -> u8 {
+        match self.msg {
+            Rmessage::Version(_) => RVERSION,
+            Rmessage::Flush => RFLUSH,
+            Rmessage::Walk(_) => RWALK,
+            Rmessage::Read(_) => RREAD,
+            Rmessage::Write(_) => RWRITE,
+            Rmessage::Clunk => RCLUNK,
+            Rmessage::Remove => RREMOVE,
+            Rmessage::Attach(_) => RATTACH,
+            Rmessage::Auth(_) => RAUTH,
+            Rmessage::Statfs(_) => RSTATFS,
+            Rmessage::Lopen(_) => RLOPEN,
+            Rmessage::Lcreate(_) => RLCREATE,
+            Rmessage::Symlink(_) => RSYMLINK,
+            Rmessage::Mknod(_) => RMKNOD,
+            Rmessage::Rename => RRENAME,
+            Rmessage::Readlink(_) => RREADLINK,
+            Rmessage::GetAttr(_) => RGETATTR,
+            Rmessage::SetAttr => RSETATTR,
+            Rmessage::XattrWalk(_) => RXATTRWALK,
+            Rmessage::XattrCreate => RXATTRCREATE,
+            Rmessage::Readdir(_) => RREADDIR,
+            Rmessage::Fsync => RFSYNC,
+            Rmessage::Lock(_) => RLOCK,
+            Rmessage::GetLock(_) => RGETLOCK,
+            Rmessage::Link => RLINK,
+            Rmessage::Mkdir(_) => RMKDIR,
+            Rmessage::RenameAt => RRENAMEAT,
+            Rmessage::UnlinkAt => RUNLINKAT,
+            Rmessage::Lerror(_) => RLERROR,
+        }
+    }
+
+    /// Encodes the header of an Rread frame up to its data, which is `count` bytes long and written
+    /// separately after it.
+    pub fn encode_rread_header<W: Write>(tag: u16, count: u32, writer: &mut W) -> io::Result<()> {
+        let empty = Rframe {
+            tag,
+            msg: Rmessage::Read(Rread {
+                data: Data(Vec::new()),
+            }),
+        };
+        (empty.byte_size() + count).encode(writer)?;
+        RREAD.encode(writer)?;
+        tag.encode(writer)?;
+        count.encode(writer)
+    }
+
+    /// Encodes the frame to `writer` with as few writes as possible, using `scratch` as a buffer.
+    /// The data of Rread and Rreaddir messages is written from where it is, along with the header,
+    /// instead of being copied to `scratch` first.
+    pub fn write_to<W: Write>(&self, writer: &mut W, scratch: &mut Vec<u8>) -> io::Result<()> {
+        scratch.clear();
+        let data = match self.msg {
+            Rmessage::Read(Rread { ref data }) | Rmessage::Readdir(Rreaddir { ref data }) => data,
+            _ => {
+                self.encode(scratch)?;
+                return writer.write_all(scratch);
+            }
+        };
+
+        self.byte_size().encode(scratch)?;
+        self.message_type().encode(scratch)?;
+        self.tag.encode(scratch)?;
+        (data.len() as u32).encode(scratch)?;
+
+        let mut bufs = [IoSlice::new(scratch), IoSlice::new(data)];
+        let mut bufs = &mut bufs[..];
+        while !bufs.is_empty() {
+            match writer.write_vectored(bufs) {
+                Ok(0) => return Err(io::Error::from(ErrorKind::WriteZero)),
+                Ok(n) => IoSlice::advance_slices(&mut bufs, n),
+                Err(e) if e.kind() == ErrorKind::Interrupted => {}
+                Err(e) => return Err(e),
+            }
+        }
+        Ok(())
+    }
+}
+
 impl WireFormat for Rframe {
     fn byte_size(&self) -> u32 {
         let msg_size = match self.msg {
@@ -597,40 +680,7 @@ impl WireFormat for Rframe {
 
     fn encode<W: Write>(&self, writer: &mut W) -> io::Result<()> {
         self.byte_size().encode(writer)?;
-
-        let ty = match self.msg {
-            Rmessage::Version(_) => RVERSION,
-            Rmessage::Flush => RFLUSH,
-            Rmessage::Walk(_) => RWALK,
-            Rmessage::Read(_) => RREAD,
-            Rmessage::Write(_) => RWRITE,
-            Rmessage::Clunk => RCLUNK,
-            Rmessage::Remove => RREMOVE,
-            Rmessage::Attach(_) => RATTACH,
-            Rmessage::Auth(_) => RAUTH,
-            Rmessage::Statfs(_) => RSTATFS,
-            Rmessage::Lopen(_) => RLOPEN,
-            Rmessage::Lcreate(_) => RLCREATE,
-            Rmessage::Symlink(_) => RSYMLINK,
-            Rmessage::Mknod(_) => RMKNOD,
-            Rmessage::Rename => RRENAME,
-            Rmessage::Readlink(_) => RREADLINK,
-            Rmessage::GetAttr(_) => RGETATTR,
-            Rmessage::SetAttr => RSETATTR,
-            Rmessage::XattrWalk(_) => RXATTRWALK,
-            Rmessage::XattrCreate => RXATTRCREATE,
-            Rmessage::Readdir(_) => RREADDIR,
-            Rmessage::Fsync => RFSYNC,
-            Rmessage::Lock(_) => RLOCK,
-            Rmessage::GetLock(_) => RGETLOCK,
-            Rmessage::Link => RLINK,
-            Rmessage::Mkdir(_) => RMKDIR,
-            Rmessage::RenameAt => RRENAMEAT,
-            Rmessage::UnlinkAt => RUNLINKAT,
-            Rmessage::Lerror(_) => RLERROR,
-        };
-
-        ty.encode(writer)?;
+        self.message_type().encode(writer)?;
         self.tag.encode(writer)?;
 
         match self.msg {
@@ -861,3 +911,75 @@ pub struct Rgetlock {
 pub struct Rmkdir {
     pub qid: Qid,
 }
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    // A writer that accepts a few bytes at a time.
+    struct Trickle(Vec<u8>);
+
+    impl Write for Trickle {
+        fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+            let n = buf.len().min(3);
+            self.0.extend_from_slice(&buf[..n]);
+            Ok(n)
+        }
+
+        fn flush(&mut self) -> io::Result<()> {
+            Ok(())
+        }
+    }
+
+    #[test]
+    fn write_to_matches_encode() {
+        let frames = [
+            Rframe {
+                tag: 7,
+                msg: Rmessage::Read(Rread {
+                    data: Data((0..=255).collect()),
+                }),
+            },
+            Rframe {
+                tag: 8,
+                msg: Rmessage::Readdir(Rreaddir { data: Data(vec![]) }),
+            },
+            Rframe {
+                tag: 9,
+                msg: Rmessage::Lerror(Rlerror { ecode: 2 }),
+            },
+        ];
+
+        let mut scratch = Vec::new();
+        for frame in &frames {
+            let mut expected = Vec::new();
+            frame.encode(&mut expected).expect("failed to encode frame");
+
+            let mut written = Trickle(Vec::new());
+            frame
+                .write_to(&mut written, &mut scratch)
+                .expect("failed to write frame");
+            assert_eq!(written.0, expected);
+        }
+    }
+
+    #[test]
+    fn rread_header_matches_encode() {
+        let data: Vec<u8> = (0..=255).collect();
+        let mut expected = Vec::new();
+        Rframe {
+            tag: 7,
+            msg: Rmessage::Read(Rread {
+                data: Data(data.clone()),
+            }),
+        }
+        .encode(&mut expected)
+        .expect("failed to encode frame");
+
+        let mut written = Vec::new();
+        Rframe::encode_rread_header(7, data.len() as u32, &mut written)
+            .expect("failed to encode header");
+        written.extend_from_slice(&data);
+        assert_eq!(written, expected);
+    }
+}
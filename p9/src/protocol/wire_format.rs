@@ -165,7 +165,7 @@ impl DerefMut for Data {
 // Same as Vec<u8> except that it encodes the length as a u32 instead of a u16.
 impl WireFormat for Data {
     fn byte_size(&self) -> u32 {
-        mem::size_of::<u32>() as u32 + self.iter().map(|elem| elem.byte_size()).sum::<u32>()
+        mem::size_of::<u32>() as u32 + self.len() as u32
     }
 
     fn encode<W: Write>(&self, writer: &mut W) -> io::Result<()> {
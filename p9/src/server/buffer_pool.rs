@@ -0,0 +1,40 @@
+//! Reuses the buffers that file data is read into.
+//!
+//! Every Rread carries a buffer as large as the negotiated message size.  Allocating a new one for
+//! each, and zeroing it before it is read into, costs as much as the read itself for files in the
+//! page cache, so buffers are returned to the pool once their response is sent.
+
+use std::sync::Mutex;
+use std::sync::PoisonError;
+
+// The number of idle buffers kept.  Each is as large as the negotiated message size, and about as
+// many are in use at a time as requests run in parallel.
+const MAX_IDLE_BUFFERS: usize = 8;
+
+#[derive(Default)]
+pub struct BufferPool {
+    idle: Mutex<Vec<Vec<u8>>>,
+}
+
+impl BufferPool {
+    /// Returns an empty buffer with room for at least `capacity` bytes.
+    pub fn take(&self, capacity: usize) -> Vec<u8> {
+        let buf = self
+            .idle
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .pop();
+        let mut buf = buf.unwrap_or_default();
+        buf.clear();
+        buf.reserve(capacity);
+        buf
+    }
+
+    /// Returns `buf` to the pool, unless enough buffers are idle already.
+    pub fn give(&self, buf: Vec<u8>) {
+        let mut idle = self.idle.lock().unwrap_or_else(PoisonError::into_inner);
+        if idle.len() < MAX_IDLE_BUFFERS {
+            idle.push(buf);
+        }
+    }
+}
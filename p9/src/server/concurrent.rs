@@ -0,0 +1,296 @@
+//! Runs the requests of a client on several threads.
+//!
+//! The Linux 9p client sends many requests without waiting for their responses, so one slow
+//! request should not hold up the others.  A reader decodes requests and queues them, a pool of
+//! workers runs them, and a writer sends the responses back in the order they are completed.
+
+use std::cmp::max;
+use std::collections::BTreeMap;
+use std::collections::BTreeSet;
+use std::collections::VecDeque;
+use std::io;
+use std::io::BufRead;
+use std::io::BufReader;
+use std::io::BufWriter;
+use std::io::Read;
+use std::io::Write;
+use std::panic;
+use std::panic::AssertUnwindSafe;
+use std::process;
+use std::sync::mpsc;
+use std::sync::Condvar;
+use std::sync::Mutex;
+use std::sync::MutexGuard;
+use std::sync::PoisonError;
+use std::thread;
+use std::time::Instant;
+
+use super::Output;
+use super::Response;
+use super::Server;
+use crate::protocol::*;
+
+// Returns the fids a request operates on.  Requests that share a fid run in the order they arrive.
+fn request_fids(msg: &Tmessage) -> Vec<u32> {
+    match msg {
+        Tmessage::Version(_) | Tmessage::Flush(_) => vec![],
+        Tmessage::Walk(walk) => vec![walk.fid, walk.newfid],
+        Tmessage::Read(read) => vec![read.fid],
+        Tmessage::Write(write) => vec![write.fid],
+        Tmessage::Clunk(clunk) => vec![clunk.fid],
+        Tmessage::Remove(remove) => vec![remove.fid],
+        Tmessage::Attach(attach) => vec![attach.fid],
+        Tmessage::Auth(auth) => vec![auth.afid],
+        Tmessage::Statfs(statfs) => vec![statfs.fid],
+        Tmessage::Lopen(lopen) => vec![lopen.fid],
+        Tmessage::Lcreate(lcreate) => vec![lcreate.fid],
+        Tmessage::Symlink(symlink) => vec![symlink.fid],
+        Tmessage::Mknod(mknod) => vec![mknod.dfid],
+        Tmessage::Rename(rename) => vec![rename.fid, rename.dfid],
+        Tmessage::Readlink(readlink) => vec![readlink.fid],
+        Tmessage::GetAttr(get_attr) => vec![get_attr.fid],
+        Tmessage::SetAttr(set_attr) => vec![set_attr.fid],
+        Tmessage::XattrWalk(xattr_walk) => vec![xattr_walk.fid, xattr_walk.newfid],
+        Tmessage::XattrCreate(xattr_create) => vec![xattr_create.fid],
+        Tmessage::Readdir(readdir) => vec![readdir.fid],
+        Tmessage::Fsync(fsync) => vec![fsync.fid],
+        Tmessage::Lock(lock) => vec![lock.fid],
+        Tmessage::GetLock(get_lock) => vec![get_lock.fid],
+        Tmessage::Link(link) => vec![link.dfid, link.fid],
+        Tmessage::Mkdir(mkdir) => vec![mkdir.dfid],
+        Tmessage::RenameAt(rename_at) => vec![rename_at.olddirfid, rename_at.newdirfid],
+        Tmessage::UnlinkAt(unlink_at) => vec![unlink_at.dirfd],
+    }
+}
+
+// Returns whether a request must run alone: after every request that arrived before it finishes,
+// and before any request that arrives after it starts.  Tversion resets every fid, and the
+// response to Tflush must not be sent before the response to the request it flushes.
+fn is_barrier(msg: &Tmessage) -> bool {
+    matches!(msg, Tmessage::Version(_) | Tmessage::Flush(_))
+}
+
+struct Job {
+    tframe: Tframe,
+    fids: Vec<u32>,
+    barrier: bool,
+    // When the request was read.
+    queued: Instant,
+}
+
+impl Job {
+    fn new(tframe: Tframe) -> Job {
+        let (fids, barrier) = match tframe.msg {
+            Ok(ref msg) => (request_fids(msg), is_barrier(msg)),
+            // Requests that failed to decode only get an error response.
+            Err(_) => (vec![], false),
+        };
+        Job {
+            tframe,
+            fids,
+            barrier,
+            queued: Instant::now(),
+        }
+    }
+}
+
+#[derive(Default)]
+struct Queue {
+    // Requests that must wait for earlier requests to finish, in the order they arrived.
+    waiting: VecDeque<Job>,
+    // Requests that may run now.
+    ready: VecDeque<Job>,
+    // The fids of ready and running requests, with the number of times they are in use.
+    busy: BTreeMap<u32, usize>,
+    // The number of ready and running requests.
+    active: usize,
+    barrier_active: bool,
+    // Set once no more requests will arrive.
+    closed: bool,
+}
+
+impl Queue {
+    fn push(&mut self, job: Job) {
+        self.waiting.push_back(job);
+        self.schedule();
+    }
+
+    // Moves the waiting requests that need not wait anymore to the ready queue.
+    fn schedule(&mut self) {
+        if self.barrier_active {
+            return;
+        }
+
+        // The fids of earlier requests that are still waiting.
+        let mut blocked = BTreeSet::new();
+        let mut i = 0;
+        while i < self.waiting.len() {
+            let job = &self.waiting[i];
+            if job.barrier {
+                if i == 0 && self.active == 0 {
+                    let job = self.waiting.pop_front().expect("waiting queue is empty");
+                    self.barrier_active = true;
+                    self.active += 1;
+                    self.ready.push_back(job);
+                }
+                return;
+            }
+
+            if job
+                .fids
+                .iter()
+                .any(|fid| self.busy.contains_key(fid) || blocked.contains(fid))
+            {
+                blocked.extend(job.fids.iter().copied());
+                i += 1;
+                continue;
+            }
+
+            let job = self.waiting.remove(i).expect("waiting queue is too short");
+            for fid in &job.fids {
+                *self.busy.entry(*fid).or_insert(0) += 1;
+            }
+            self.active += 1;
+            self.ready.push_back(job);
+        }
+    }
+
+    fn finish(&mut self, fids: &[u32], barrier: bool) {
+        for fid in fids {
+            if let Some(count) = self.busy.get_mut(fid) {
+                *count -= 1;
+                if *count == 0 {
+                    self.busy.remove(fid);
+                }
+            }
+        }
+        if barrier {
+            self.barrier_active = false;
+        }
+        self.active -= 1;
+        self.schedule();
+    }
+
+    fn is_done(&self) -> bool {
+        self.closed && self.waiting.is_empty() && self.ready.is_empty()
+    }
+}
+
+fn lock(queue: &Mutex<Queue>) -> MutexGuard<'_, Queue> {
+    queue.lock().unwrap_or_else(PoisonError::into_inner)
+}
+
+impl Server {
+    /// Serves the requests read from `reader` until it reaches end of file, writing the responses
+    /// to `writer`.  Up to `workers` requests run at the same time.  Requests on the same fid run
+    /// in the order they arrive, and Tversion and Tflush run alone.
+    ///
+    /// Returns when every request read has been answered.
+    pub fn serve<R: Read, W: Output + Send>(
+        &self,
+        reader: R,
+        writer: W,
+        workers: usize,
+    ) -> io::Result<()> {
+        let queue = Mutex::new(Queue::default());
+        let changed = Condvar::new();
+        let (responses, received) = mpsc::channel();
+        let splice = self.cfg.splice_reads && writer.pipe().is_some();
+
+        thread::scope(|scope| {
+            let writer_thread = scope.spawn(move || self.write_responses(received, writer));
+            for _ in 0..max(workers, 1) {
+                let responses = responses.clone();
+                let (queue, changed) = (&queue, &changed);
+                scope.spawn(move || self.work(queue, changed, responses, splice));
+            }
+            drop(responses);
+
+            let read = self.read_requests(reader, &queue, &changed);
+
+            lock(&queue).closed = true;
+            changed.notify_all();
+            let written = writer_thread
+                .join()
+                .unwrap_or_else(|e| panic::resume_unwind(e));
+            read.and(written)
+        })
+    }
+
+    fn write_responses<W: Output>(
+        &self,
+        responses: mpsc::Receiver<Response>,
+        writer: W,
+    ) -> io::Result<()> {
+        // Small responses are gathered in the buffer, while file data is written from where it
+        // is, along with the header of its response.
+        let mut writer = BufWriter::new(writer);
+        let mut scratch = Vec::new();
+        while let Ok(response) = responses.recv() {
+            let start = Instant::now();
+            let mut bytes = self.send(response, &mut writer, &mut scratch)?;
+            // Send the buffered responses once there are no more to send.
+            while let Ok(response) = responses.try_recv() {
+                bytes += self.send(response, &mut writer, &mut scratch)?;
+            }
+            writer.flush()?;
+            self.stats.send().record(start.elapsed(), bytes, false);
+        }
+        Ok(())
+    }
+
+    fn read_requests<R: Read>(
+        &self,
+        reader: R,
+        queue: &Mutex<Queue>,
+        changed: &Condvar,
+    ) -> io::Result<()> {
+        let mut reader = BufReader::new(reader);
+        loop {
+            // End of file between requests means the client is done.
+            if reader.fill_buf()?.is_empty() {
+                return Ok(());
+            }
+            let tframe = WireFormat::decode(&mut (&mut reader).take(self.msize() as u64))?;
+            lock(queue).push(Job::new(tframe));
+            changed.notify_all();
+        }
+    }
+
+    fn work(
+        &self,
+        queue: &Mutex<Queue>,
+        changed: &Condvar,
+        responses: mpsc::Sender<Response>,
+        splice: bool,
+    ) {
+        let mut guard = lock(queue);
+        loop {
+            if let Some(job) = guard.ready.pop_front() {
+                drop(guard);
+                let Job {
+                    tframe,
+                    fids,
+                    barrier,
+                    queued,
+                } = job;
+                self.stats.queue().record(queued.elapsed(), 0, false);
+                // A panic would leave the requests waiting on these fids stuck forever, so
+                // treat it as fatal, as it would be if requests ran one at a time.
+                let response =
+                    panic::catch_unwind(AssertUnwindSafe(|| self.respond(tframe, splice)))
+                        .unwrap_or_else(|_| process::abort());
+                // The response must be queued before later requests on its fids may run.  If the
+                // writer is gone, so is the client, and the response can be dropped.
+                let _ = responses.send(response);
+                guard = lock(queue);
+                guard.finish(&fids, barrier);
+                changed.notify_all();
+            } else if guard.is_done() {
+                return;
+            } else {
+                guard = changed.wait(guard).unwrap_or_else(PoisonError::into_inner);
+            }
+        }
+    }
+}
@@ -0,0 +1,629 @@
+//! Caches the attributes of the files served.
+//!
+//! Clients ask for the same attributes over and over: `ls -l` walks to every entry of a directory
+//! and gets its attributes, and editors poll the files they have open.  The cache keeps the
+//! attributes of the inodes stat()ed recently, and the inodes the names in cached directories lead
+//! to, evicting the least recently used when it is full.
+//!
+//! Every cached inode is watched with inotify.  The kernel queues the events of a change before the
+//! system call that made it returns, so reading them before every lookup keeps the cache as current
+//! as the file system.  Inodes that cannot be watched, typically because the limit of inotify
+//! watches was reached, are cached for `FALLBACK_TTL` only.  Access times are not watched, as every
+//! read would queue an event, so the cached ones may lag behind.
+//!
+//! inotify misses some changes: writes through shared memory mappings, and changes made by other
+//! machines to network file systems.  The attributes of watched inodes are therefore only trusted
+//! for `WATCHED_TTL` after they were read, which bounds how long such changes go unnoticed.
+//!
+//! Watches count against the limit of the user in `/proc/sys/fs/inotify/max_user_watches`, shared
+//! by the qfsd of every mount and every other program of the user, which fail to watch anything
+//! once it is reached.  The cache therefore holds no more than `1 / WATCH_SHARE` of the limit, and
+//! caches the inodes it cannot watch within that share for `FALLBACK_TTL` as well.
+
+use std::cmp;
+use std::collections::BTreeMap;
+use std::collections::HashMap;
+use std::ffi::CStr;
+use std::ffi::CString;
+use std::fs;
+use std::fs::File;
+use std::io;
+use std::mem::size_of;
+use std::os::unix::io::AsRawFd;
+use std::os::unix::io::FromRawFd;
+use std::ptr;
+use std::sync::Mutex;
+use std::sync::MutexGuard;
+use std::sync::PoisonError;
+use std::time::Duration;
+use std::time::Instant;
+
+use super::stat;
+
+// How long the attributes of an inode that cannot be watched are cached.
+pub const FALLBACK_TTL: Duration = Duration::from_secs(1);
+
+// How long the attributes of a watched inode are cached, in case inotify misses a change.
+pub const WATCHED_TTL: Duration = Duration::from_secs(5);
+
+// The share of the inotify watches of the user one cache may hold.
+pub const WATCH_SHARE: usize = 64;
+
+// The limit of inotify watches of the user, if it cannot be read.
+const DEFAULT_MAX_USER_WATCHES: usize = 8192;
+
+const WATCH_MASK: u32 = libc::IN_MODIFY
+    | libc::IN_ATTRIB
+    | libc::IN_CREATE
+    | libc::IN_DELETE
+    | libc::IN_MOVED_FROM
+    | libc::IN_MOVED_TO
+    | libc::IN_DELETE_SELF
+    | libc::IN_MOVE_SELF;
+
+// Events that change the inode a name in a directory leads to.
+const NAME_EVENTS: u32 =
+    libc::IN_CREATE | libc::IN_DELETE | libc::IN_MOVED_FROM | libc::IN_MOVED_TO;
+
+/// Identifies an inode by its device and inode numbers.
+pub type InodeKey = (u64, u64);
+
+pub fn inode_key(st: &libc::stat64) -> InodeKey {
+    (st.st_dev as u64, st.st_ino)
+}
+
+/// The number of changes the cache had seen when a request started.  What the request learns is
+/// only cached if nothing changed since, as it may predate the change.
+#[derive(Clone, Copy, PartialEq, Eq)]
+pub struct Token(u64);
+
+struct Inode {
+    // None once the attributes changed, while the names in the directory may still be cached.
+    st: Option<libc::stat64>,
+    wd: Option<libc::c_int>,
+    // When the attributes stop being trusted.
+    expires: Instant,
+    used: u64,
+}
+
+impl Inode {
+    fn is_live(&self) -> bool {
+        Instant::now() < self.expires
+    }
+}
+
+// Returns when attributes read now stop being trusted, depending on whether the inode is watched.
+fn expiry(wd: Option<libc::c_int>) -> Instant {
+    Instant::now() + wd.map_or(FALLBACK_TTL, |_| WATCHED_TTL)
+}
+
+#[derive(Default)]
+struct State {
+    inodes: HashMap<InodeKey, Inode>,
+    // The inodes the names in cached directories lead to.
+    names: HashMap<InodeKey, HashMap<CString, InodeKey>>,
+    name_count: usize,
+    // Cached inodes by the last time they were used.
+    lru: BTreeMap<u64, InodeKey>,
+    watches: HashMap<libc::c_int, InodeKey>,
+    clock: u64,
+    changes: u64,
+}
+
+impl State {
+    fn touch(&mut self, inode: InodeKey) {
+        if let Some(entry) = self.inodes.get_mut(&inode) {
+            self.lru.remove(&entry.used);
+            self.clock += 1;
+            entry.used = self.clock;
+            self.lru.insert(self.clock, inode);
+        }
+    }
+
+    // Returns whether an inode is cached, forgetting it if it expired.
+    fn is_cached(&mut self, inotify: Option<&File>, inode: InodeKey) -> bool {
+        match self.inodes.get(&inode) {
+            Some(entry) if entry.is_live() => true,
+            Some(_) => {
+                self.remove(inotify, inode);
+                false
+            }
+            None => false,
+        }
+    }
+
+    // Returns the attributes of an inode, if they are cached.
+    fn attributes(&mut self, inotify: Option<&File>, inode: InodeKey) -> Option<libc::stat64> {
+        if !self.is_cached(inotify, inode) {
+            return None;
+        }
+        let st = self.inodes.get(&inode)?.st?;
+        self.touch(inode);
+        Some(st)
+    }
+
+    fn remove(&mut self, inotify: Option<&File>, inode: InodeKey) {
+        if let Some(entry) = self.inodes.remove(&inode) {
+            self.lru.remove(&entry.used);
+            if let Some(wd) = entry.wd {
+                self.watches.remove(&wd);
+                if let Some(inotify) = inotify {
+                    // Safe because this doesn't modify any memory.  Failure means the watch is
+                    // already gone.
+                    unsafe { libc::inotify_rm_watch(inotify.as_raw_fd(), wd) };
+                }
+            }
+        }
+        if let Some(names) = self.names.remove(&inode) {
+            self.name_count -= names.len();
+        }
+    }
+
+    fn clear(&mut self, inotify: Option<&File>) {
+        let inodes: Vec<InodeKey> = self.inodes.keys().copied().collect();
+        for inode in inodes {
+            self.remove(inotify, inode);
+        }
+    }
+
+    fn invalidate(&mut self, inode: InodeKey) {
+        self.changes += 1;
+        if let Some(entry) = self.inodes.get_mut(&inode) {
+            entry.st = None;
+        }
+    }
+
+    fn invalidate_name(&mut self, dir: InodeKey, name: &CStr) {
+        self.invalidate(dir);
+        let removed = self
+            .names
+            .get_mut(&dir)
+            .and_then(|names| names.remove(name));
+        if let Some(inode) = removed {
+            self.name_count -= 1;
+            // Renaming or unlinking a file changes its attributes as well.
+            self.invalidate(inode);
+        }
+    }
+
+    fn event(&mut self, inotify: &File, wd: libc::c_int, mask: u32, name: &CStr) {
+        self.changes += 1;
+        if mask & libc::IN_Q_OVERFLOW != 0 {
+            // Events were lost.
+            self.clear(Some(inotify));
+            return;
+        }
+
+        let inode = match self.watches.get(&wd) {
+            Some(inode) => *inode,
+            None => return,
+        };
+        if mask & libc::IN_IGNORED != 0 {
+            // The inode is gone, or no longer watched.
+            self.watches.remove(&wd);
+            if let Some(entry) = self.inodes.get_mut(&inode) {
+                entry.wd = None;
+            }
+            self.remove(Some(inotify), inode);
+        } else if name.is_empty() {
+            self.invalidate(inode);
+        } else if mask & NAME_EVENTS != 0 {
+            self.invalidate_name(inode, name);
+        }
+        // Other events on the entries of a directory are also reported to the watches of the
+        // entries themselves.
+    }
+
+    fn evict(&mut self, inotify: Option<&File>, capacity: usize) {
+        while self.inodes.len() + self.name_count > capacity {
+            let inode = match self.lru.values().next() {
+                Some(inode) => *inode,
+                None => break,
+            };
+            self.remove(inotify, inode);
+        }
+    }
+}
+
+/// A bounded cache of the attributes of inodes, and of the inodes names lead to.  It is safe to
+/// use from several threads at once.
+pub struct MetadataCache {
+    // The maximum number of inodes and names cached.  Nothing is cached if zero.
+    capacity: usize,
+    // The maximum number of inodes watched.
+    max_watches: usize,
+    inotify: Option<File>,
+    state: Mutex<State>,
+}
+
+// Returns the number of inotify watches a cache of `capacity` entries may hold.
+fn max_watches(capacity: usize) -> usize {
+    let limit = fs::read_to_string("/proc/sys/fs/inotify/max_user_watches")
+        .ok()
+        .and_then(|s| s.trim().parse::<usize>().ok())
+        .unwrap_or(DEFAULT_MAX_USER_WATCHES);
+    cmp::min(capacity, limit / WATCH_SHARE)
+}
+
+impl MetadataCache {
+    pub fn new(capacity: usize) -> MetadataCache {
+        let inotify = if capacity > 0 {
+            // Safe because this doesn't modify any memory and we check the return value.  Without
+            // inotify, every inode is cached as if it could not be watched.
+            let fd = unsafe { libc::inotify_init1(libc::IN_NONBLOCK | libc::IN_CLOEXEC) };
+            // Safe because we just opened this fd.
+            (fd >= 0).then(|| unsafe { File::from_raw_fd(fd) })
+        } else {
+            None
+        };
+        MetadataCache {
+            capacity,
+            max_watches: max_watches(capacity),
+            inotify,
+            state: Mutex::new(State::default()),
+        }
+    }
+
+    pub fn inotify_fd(&self) -> Option<&File> {
+        self.inotify.as_ref()
+    }
+
+    fn state(&self) -> MutexGuard<'_, State> {
+        let mut state = self.state.lock().unwrap_or_else(PoisonError::into_inner);
+        self.read_events(&mut state);
+        state
+    }
+
+    fn read_events(&self, state: &mut State) {
+        let inotify = match self.inotify {
+            Some(ref inotify) => inotify,
+            None => return,
+        };
+
+        let mut buf = [0u8; 4096];
+        loop {
+            // Safe because the kernel will only write up to `buf.len()` bytes in `buf` and we
+            // check the return value.
+            let len = unsafe {
+                libc::read(
+                    inotify.as_raw_fd(),
+                    buf.as_mut_ptr() as *mut libc::c_void,
+                    buf.len(),
+                )
+            };
+            if len <= 0 {
+                // Nothing else is queued.
+                return;
+            }
+
+            let events = &buf[..len as usize];
+            let mut offset = 0;
+            while offset + size_of::<libc::inotify_event>() <= events.len() {
+                // Safe because the kernel wrote a whole event here, and it is read unaligned.
+                let event = unsafe {
+                    ptr::read_unaligned(events[offset..].as_ptr() as *const libc::inotify_event)
+                };
+                let start = offset + size_of::<libc::inotify_event>();
+                offset = start + event.len as usize;
+                // The name is padded with nul bytes, and missing for events on the watched inode
+                // itself.
+                let name = CStr::from_bytes_until_nul(&events[start..offset]).unwrap_or_default();
+                state.event(inotify, event.wd, event.mask, name);
+            }
+        }
+    }
+
+    fn watch(&self, file: &File) -> Option<libc::c_int> {
+        let inotify = self.inotify.as_ref()?;
+        let path = CString::new(format!("/proc/self/fd/{}", file.as_raw_fd())).ok()?;
+        // Safe because this doesn't modify any memory and we check the return value.
+        let wd = unsafe { libc::inotify_add_watch(inotify.as_raw_fd(), path.as_ptr(), WATCH_MASK) };
+        (wd >= 0).then_some(wd)
+    }
+
+    pub fn token(&self) -> Token {
+        if self.capacity == 0 {
+            return Token(0);
+        }
+        Token(self.state().changes)
+    }
+
+    /// Returns the attributes of `inode`, if they are cached and did not change since `token`.
+    pub fn get(&self, inode: InodeKey, token: Token) -> Option<libc::stat64> {
+        if self.capacity == 0 {
+            return None;
+        }
+        let mut state = self.state();
+        if state.changes != token.0 {
+            return None;
+        }
+        state.attributes(self.inotify.as_ref(), inode)
+    }
+
+    /// Returns the attributes of the inode `name` in directory `dir` leads to, if they are cached
+    /// and did not change since `token`.
+    pub fn lookup(&self, dir: InodeKey, name: &CStr, token: Token) -> Option<libc::stat64> {
+        if self.capacity == 0 {
+            return None;
+        }
+        let mut state = self.state();
+        if state.changes != token.0 {
+            return None;
+        }
+        let inode = *state.names.get(&dir)?.get(name)?;
+        if !state.is_cached(self.inotify.as_ref(), dir) {
+            return None;
+        }
+        state.touch(dir);
+        state.attributes(self.inotify.as_ref(), inode)
+    }
+
+    /// Stats `file` and caches its attributes, unless something changed since `token`.  If `name`
+    /// is given, as the directory and name `file` was found under, the inode it leads to is cached
+    /// as well.
+    pub fn stat(
+        &self,
+        file: &File,
+        name: Option<(InodeKey, &CStr)>,
+        token: Token,
+    ) -> io::Result<libc::stat64> {
+        if self.capacity == 0 {
+            return stat(file);
+        }
+
+        // Watch before stat()ing, so no change goes unnoticed in between.  Other threads may
+        // add watches in the meantime, so the cache may briefly hold a few more than its share.
+        let watching = self.state().watches.len();
+        let wd = if watching < self.max_watches {
+            self.watch(file)
+        } else {
+            None
+        };
+        let st = stat(file);
+
+        let mut guard = self.state();
+        let state = &mut *guard;
+        let st = match st {
+            Ok(st) => st,
+            Err(e) => {
+                if let (Some(inotify), Some(wd)) = (self.inotify.as_ref(), wd) {
+                    if !state.watches.contains_key(&wd) {
+                        // Safe because this doesn't modify any memory.
+                        unsafe { libc::inotify_rm_watch(inotify.as_raw_fd(), wd) };
+                    }
+                }
+                return Err(e);
+            }
+        };
+
+        let inode = inode_key(&st);
+        let fresh = state.changes == token.0;
+        if let Some(wd) = wd {
+            state.watches.insert(wd, inode);
+        }
+        match state.inodes.get_mut(&inode) {
+            Some(entry) => {
+                if wd.is_some() && entry.wd != wd {
+                    // The inode was not watched, or its watch is gone.
+                    if let Some(old) = entry.wd.take() {
+                        state.watches.remove(&old);
+                    }
+                    entry.wd = wd;
+                }
+                if fresh {
+                    entry.st = Some(st);
+                    entry.expires = expiry(entry.wd);
+                }
+            }
+            None => {
+                let entry = Inode {
+                    st: fresh.then_some(st),
+                    wd,
+                    expires: expiry(wd),
+                    used: 0,
+                };
+                state.inodes.insert(inode, entry);
+            }
+        }
+        state.touch(inode);
+
+        if let Some((dir, name)) = name {
+            if fresh && state.inodes.contains_key(&dir) {
+                let names = state.names.entry(dir).or_default();
+                if names.insert(name.to_owned(), inode).is_none() {
+                    state.name_count += 1;
+                }
+            }
+        }
+
+        state.evict(self.inotify.as_ref(), self.capacity);
+        Ok(st)
+    }
+
+    /// Forgets the attributes of `inode`, which the server changed.
+    pub fn invalidate(&self, inode: InodeKey) {
+        if self.capacity == 0 {
+            return;
+        }
+        self.state().invalidate(inode);
+    }
+
+    /// Forgets the inode `name` in directory `dir` leads to, and the attributes of both, after the
+    /// server created, linked, renamed or removed `name`.
+    pub fn invalidate_name(&self, dir: InodeKey, name: &CStr) {
+        if self.capacity == 0 {
+            return;
+        }
+        self.state().invalidate_name(dir, name);
+    }
+
+    #[cfg(test)]
+    fn len(&self) -> usize {
+        let state = self.state();
+        state.inodes.len() + state.name_count
+    }
+}
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    use std::env;
+    use std::fs;
+    use std::io::Write;
+    use std::os::unix::ffi::OsStrExt;
+    use std::path::Path;
+    use std::path::PathBuf;
+
+    struct TempDir(PathBuf);
+
+    impl TempDir {
+        fn new(name: &str) -> TempDir {
+            let path = env::temp_dir().join(format!("{}.{}", name, std::process::id()));
+            fs::create_dir(&path).expect("failed to create directory");
+            TempDir(path)
+        }
+    }
+
+    impl Drop for TempDir {
+        fn drop(&mut self) {
+            let _ = fs::remove_dir_all(&self.0);
+        }
+    }
+
+    fn cstr(path: &Path) -> CString {
+        CString::new(path.file_name().unwrap().as_bytes()).unwrap()
+    }
+
+    fn cache_entry(cache: &MetadataCache, dir: &Path, path: &Path) -> libc::stat64 {
+        let dir_file = File::open(dir).expect("failed to open directory");
+        let token = cache.token();
+        let dir_st = cache.stat(&dir_file, None, token).unwrap();
+        let file = File::open(path).expect("failed to open file");
+        let name = cstr(path);
+        cache
+            .stat(&file, Some((inode_key(&dir_st), &name)), token)
+            .unwrap()
+    }
+
+    #[test]
+    fn disabled() {
+        let dir = TempDir::new("metadata_cache_disabled");
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+
+        let cache = MetadataCache::new(0);
+        let st = cache_entry(&cache, &dir.0, &path);
+        assert_eq!(st.st_size, 4);
+        assert!(cache.get(inode_key(&st), cache.token()).is_none());
+        assert_eq!(cache.len(), 0);
+    }
+
+    #[test]
+    fn invalidated_by_changes() {
+        let dir = TempDir::new("metadata_cache_invalidated");
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+
+        let cache = MetadataCache::new(16);
+        let st = cache_entry(&cache, &dir.0, &path);
+        let dir_key = inode_key(&stat(&File::open(&dir.0).unwrap()).unwrap());
+        let name = cstr(&path);
+
+        let cached = cache.lookup(dir_key, &name, cache.token()).unwrap();
+        assert_eq!(cached.st_ino, st.st_ino);
+        assert_eq!(cache.get(inode_key(&st), cache.token()).unwrap().st_size, 4);
+
+        // Writing to the file is noticed.
+        fs::OpenOptions::new()
+            .append(true)
+            .open(&path)
+            .unwrap()
+            .write_all(b" and more")
+            .unwrap();
+        assert!(cache.get(inode_key(&st), cache.token()).is_none());
+
+        // So is replacing it.
+        let other = dir.0.join("other");
+        fs::write(&other, b"other").unwrap();
+        fs::rename(&other, &path).unwrap();
+        assert!(cache.lookup(dir_key, &name, cache.token()).is_none());
+    }
+
+    #[test]
+    fn stale_results_not_cached() {
+        let dir = TempDir::new("metadata_cache_stale");
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+
+        let cache = MetadataCache::new(16);
+        let st = cache_entry(&cache, &dir.0, &path);
+        let token = cache.token();
+        cache.invalidate(inode_key(&st));
+
+        let file = File::open(&path).unwrap();
+        cache.stat(&file, None, token).unwrap();
+        assert!(cache.get(inode_key(&st), cache.token()).is_none());
+    }
+
+    #[test]
+    fn expires_without_watches() {
+        let dir = TempDir::new("metadata_cache_expires");
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+
+        let cache = MetadataCache {
+            capacity: 16,
+            max_watches: 16,
+            inotify: None,
+            state: Mutex::new(State::default()),
+        };
+        let st = cache_entry(&cache, &dir.0, &path);
+        assert!(cache.get(inode_key(&st), cache.token()).is_some());
+        std::thread::sleep(FALLBACK_TTL);
+        assert!(cache.get(inode_key(&st), cache.token()).is_none());
+    }
+
+    #[test]
+    fn watched_entries_expire() {
+        let dir = TempDir::new("metadata_cache_watched");
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+
+        let cache = MetadataCache::new(16);
+        let st = cache_entry(&cache, &dir.0, &path);
+        let state = cache.state();
+        let entry = &state.inodes[&inode_key(&st)];
+        // Changes inotify misses are noticed once the attributes expire.
+        assert!(entry.wd.is_some());
+        assert!(entry.expires <= Instant::now() + WATCHED_TTL);
+    }
+
+    #[test]
+    fn watches_bounded() {
+        let dir = TempDir::new("metadata_cache_watches");
+        let mut cache = MetadataCache::new(16);
+        cache.max_watches = 1;
+        let path = dir.0.join("file");
+        fs::write(&path, b"data").unwrap();
+        // The directory takes the only watch, so the file is cached for a while only.
+        let st = cache_entry(&cache, &dir.0, &path);
+        assert_eq!(cache.state().watches.len(), 1);
+        assert!(cache.get(inode_key(&st), cache.token()).is_some());
+        std::thread::sleep(FALLBACK_TTL);
+        assert!(cache.get(inode_key(&st), cache.token()).is_none());
+        assert!(max_watches(16) <= 16);
+    }
+
+    #[test]
+    fn bounded() {
+        let dir = TempDir::new("metadata_cache_bounded");
+        let cache = MetadataCache::new(8);
+        for i in 0..32 {
+            let path = dir.0.join(format!("file_{}", i));
+            fs::write(&path, b"data").unwrap();
+            cache_entry(&cache, &dir.0, &path);
+            assert!(cache.len() <= 8);
+        }
+    }
+}
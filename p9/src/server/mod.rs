@@ -2,15 +2,23 @@
 // Use of this source code is governed by a BSD-style license that can be
 // found in the LICENSE file.
 
+mod buffer_pool;
+mod concurrent;
+mod metadata_cache;
 mod read_dir;
+mod read_pattern;
+mod splice;
+mod stats;
 
+use std::cell::RefCell;
+use std::cmp::max;
 use std::cmp::min;
-use std::collections::btree_map;
 use std::collections::BTreeMap;
 use std::ffi::CStr;
 use std::ffi::CString;
 use std::fs::File;
 use std::io;
+use std::io::BufWriter;
 use std::io::Cursor;
 use std::io::Read;
 use std::io::Write;
@@ -23,11 +31,28 @@ use std::os::unix::io::AsRawFd;
 use std::os::unix::io::FromRawFd;
 use std::os::unix::io::RawFd;
 use std::path::Path;
+use std::path::PathBuf;
 use std::str::FromStr;
-
+use std::sync::atomic::AtomicU32;
+use std::sync::atomic::Ordering;
+use std::sync::Arc;
+use std::sync::Mutex;
+use std::sync::MutexGuard;
+use std::sync::PoisonError;
+use std::time::Instant;
+
+use buffer_pool::BufferPool;
+use metadata_cache::inode_key;
+use metadata_cache::InodeKey;
+use metadata_cache::MetadataCache;
 use read_dir::read_dir;
+use read_dir::DirEntry;
+use read_pattern::ReadPattern;
 use serde::Deserialize;
 use serde::Serialize;
+use splice::Pipe;
+use splice::PipePool;
+pub use stats::Stats;
 
 use crate::protocol::*;
 use crate::syscall;
@@ -127,10 +152,13 @@ const _P9_LOCK_ERROR: u8 = 2;
 const _P9_LOCK_GRACE: u8 = 3;
 
 // Minimum and maximum message size that we'll expect from the client.
-const MIN_MESSAGE_SIZE: u32 = 256;
-const MAX_MESSAGE_SIZE: u32 = 64 * 1024 + 24; // 64 KiB of payload plus some extra for the header
+pub const MIN_MESSAGE_SIZE: u32 = 256;
+pub const MAX_MESSAGE_SIZE: u32 = 16 * 1024 * 1024 + 24; // 16 MiB of payload plus some extra for the header
+
+// Message size offered to clients unless configured otherwise.
+pub const DEFAULT_MESSAGE_SIZE: u32 = 64 * 1024 + 24; // 64 KiB of payload plus some extra for the header
 
-#[derive(PartialEq, Eq)]
+#[derive(Clone, Copy, PartialEq, Eq)]
 enum FileType {
     Regular,
     Directory,
@@ -152,10 +180,16 @@ impl From<libc::mode_t> for FileType {
 // 32-bit number chosen by the client. Most messages sent by clients include a fid on which to
 // operate. The fid in a Tattach message represents the root of the file system tree that the client
 // is allowed to access. A client can create more fids by walking the directory tree from that fid.
+//
+// Fids are never modified once created: operations that change what a fid refers to replace it
+// with a new one, so that other threads may keep using the fid they looked up.  Only the pattern
+// of the reads made through them is kept up to date.
 struct Fid {
-    path: File,
+    path: Arc<File>,
     file: Option<File>,
     filetype: FileType,
+    inode: InodeKey,
+    reads: Mutex<ReadPattern>,
 }
 
 impl From<libc::stat64> for Qid {
@@ -169,13 +203,22 @@ impl From<libc::stat64> for Qid {
 
         Qid {
             ty,
-            // TODO: deal with the 2038 problem before 2038
-            version: st.st_mtime as u32,
+            version: qid_version(st.st_ctime, st.st_ctime_nsec),
             path: st.st_ino,
         }
     }
 }
 
+// Returns the version of the qid of a file last changed at `ctime`.  Writing to a file, changing its
+// attributes or linking it anywhere updates its ctime to the nanosecond, so the version changes
+// whenever the file does, and clients can tell whether what they cached about it is still current.
+fn qid_version(ctime: i64, ctime_nsec: i64) -> u32 {
+    let nanos = (ctime as u64)
+        .wrapping_mul(1_000_000_000)
+        .wrapping_add(ctime_nsec as u64);
+    (nanos ^ (nanos >> 32)) as u32
+}
+
 fn statat(d: &File, name: &CStr, flags: libc::c_int) -> io::Result<libc::stat64> {
     let mut st = MaybeUninit::<libc::stat64>::zeroed();
 
@@ -268,6 +311,18 @@ impl<'a, T> AsRef<T> for MaybeOwned<'a, T> {
     }
 }
 
+// Returns the size of the header of Rread frames, up to their data.
+fn rread_header_size() -> u32 {
+    // Use an empty Rread struct to figure out the overhead of the header.
+    Rframe {
+        tag: 0,
+        msg: Rmessage::Read(Rread {
+            data: Data(Vec::new()),
+        }),
+    }
+    .byte_size()
+}
+
 fn ebadf() -> io::Error {
     io::Error::from_raw_os_error(libc::EBADF)
 }
@@ -280,10 +335,50 @@ fn map_id_from_host<T: Clone + Ord>(map: &ServerIdMap<T>, id: T) -> T {
     map.get(&id).map_or(id.clone(), |v| v.clone())
 }
 
+// Largest buffer used to read directory entries.  Directory entries take about as much space in
+// a Rreaddir as they do in the buffer, so a buffer as large as the Rreaddir lets a single
+// getdents64 system call fill it.
+const MAX_DIRENT_BUFFER_SIZE: usize = 256 * 1024;
+
+thread_local! {
+    // Reused by every Treaddir served by the thread.
+    static DIRENT_BUFFER: RefCell<Vec<u8>> = const { RefCell::new(Vec::new()) };
+    // Reused to encode every response sent by the thread.
+    static RESPONSE_BUFFER: RefCell<Vec<u8>> = const { RefCell::new(Vec::new()) };
+}
+
+// Returns the qid and the file type of a directory entry.  The inode number and file type in the
+// entry are all the Linux client uses, so the entry is only stat()ed when the file system does not
+// provide its type.
+fn dirent_qid(dir: &File, dirent: &DirEntry) -> io::Result<(Qid, u8)> {
+    let ty = match dirent.type_ {
+        libc::DT_DIR => P9_QTDIR,
+        libc::DT_REG => P9_QTFILE,
+        libc::DT_LNK => P9_QTSYMLINK,
+        libc::DT_UNKNOWN => {
+            let st = statat(dir, dirent.name, 0)?;
+            // The file type bits of the mode are the DT_* constants, shifted.
+            let dtype = ((st.st_mode & libc::S_IFMT) >> 12) as u8;
+            return Ok((st.into(), dtype));
+        }
+        _ => 0,
+    };
+
+    Ok((
+        Qid {
+            ty,
+            version: 0,
+            path: dirent.ino,
+        },
+        dirent.type_,
+    ))
+}
+
 // Performs an ascii case insensitive lookup and returns an O_PATH fd for the entry, if found.
 fn ascii_casefold_lookup(proc: &File, parent: &File, name: &[u8]) -> io::Result<File> {
-    let mut dir = open_fid(proc, parent, P9_DIRECTORY)?;
-    let mut dirents = read_dir(&mut dir, 0)?;
+    let dir = open_fid(proc, parent, P9_DIRECTORY)?;
+    let mut buf = [0u8; read_dir::MIN_BUFFER_SIZE];
+    let mut dirents = read_dir(&dir, 0, &mut buf)?;
 
     while let Some(entry) = dirents.next().transpose()? {
         if name.eq_ignore_ascii_case(entry.name.to_bytes()) {
@@ -310,25 +405,41 @@ fn lookup(parent: &File, name: &CStr) -> io::Result<File> {
 
 fn do_walk(
     proc: &File,
+    metadata: &MetadataCache,
     wnames: Vec<String>,
-    start: &File,
+    start: &Fid,
     ascii_casefold: bool,
     mds: &mut Vec<libc::stat64>,
 ) -> io::Result<File> {
-    let mut current = MaybeOwned::Borrowed(start);
+    let token = metadata.token();
+    let mut current = MaybeOwned::Borrowed(&*start.path);
+    let mut dir = start.inode;
 
     for wname in wnames {
         let name = string_to_cstring(wname)?;
-        current = MaybeOwned::Owned(lookup(current.as_ref(), &name).or_else(|e| {
+        let mut casefolded = false;
+        let next = lookup(current.as_ref(), &name).or_else(|e| {
             if ascii_casefold {
                 if let Some(libc::ENOENT) = e.raw_os_error() {
+                    casefolded = true;
                     return ascii_casefold_lookup(proc, current.as_ref(), name.to_bytes());
                 }
             }
 
             Err(e)
-        })?);
-        mds.push(stat(&current)?);
+        })?;
+        let st = if casefolded {
+            // Changes are reported under the name the entry really has, so the one asked for
+            // cannot be cached.
+            metadata.stat(&next, None, token)?
+        } else if let Some(st) = metadata.lookup(dir, &name, token) {
+            st
+        } else {
+            metadata.stat(&next, Some((dir, &name)), token)?
+        };
+        dir = inode_key(&st);
+        current = MaybeOwned::Owned(next);
+        mds.push(st);
     }
 
     match current {
@@ -366,6 +477,49 @@ fn open_fid(proc: &File, path: &File, p9_flags: u32) -> io::Result<File> {
     Ok(unsafe { File::from_raw_fd(fd) })
 }
 
+/// Where responses are written.
+///
+/// With `Config::splice_reads`, file data is spliced to outputs that are pipes instead of being
+/// written to them.
+pub trait Output: Write {
+    /// Returns the pipe the output writes to, if it writes to one.
+    fn pipe(&self) -> Option<RawFd> {
+        None
+    }
+}
+
+impl Output for File {
+    fn pipe(&self) -> Option<RawFd> {
+        Some(self.as_raw_fd()).filter(|&fd| splice::is_pipe(fd))
+    }
+}
+
+impl Output for Vec<u8> {}
+
+impl<W: Output + ?Sized> Output for &mut W {
+    fn pipe(&self) -> Option<RawFd> {
+        (**self).pipe()
+    }
+}
+
+impl<W: Output> Output for BufWriter<W> {
+    fn pipe(&self) -> Option<RawFd> {
+        self.get_ref().pipe()
+    }
+}
+
+// A response ready to be sent.
+enum Response {
+    Frame(Rframe),
+    // An Rread whose data is the `len` bytes waiting in `pipe`, followed by `tail`.
+    Spliced {
+        tag: u16,
+        pipe: Pipe,
+        len: usize,
+        tail: Vec<u8>,
+    },
+}
+
 #[derive(Clone, Serialize, Deserialize)]
 pub struct Config {
     pub root: Box<Path>,
@@ -375,6 +529,20 @@ pub struct Config {
     pub gid_map: ServerGidMap,
 
     pub ascii_casefold: bool,
+
+    // Number of inodes and names whose metadata is cached.  Zero disables the cache.
+    #[serde(default)]
+    pub metadata_cache: usize,
+
+    // Whether file data is spliced to the client rather than copied, when responses are written to
+    // a pipe.
+    #[serde(default)]
+    pub splice_reads: bool,
+
+    // Number of bytes prefetched into the page cache past the reads of files read sequentially.
+    // Zero disables prefetching.
+    #[serde(default)]
+    pub readahead: u32,
 }
 
 impl FromStr for Config {
@@ -392,6 +560,33 @@ impl FromStr for Config {
                 .next()
                 .ok_or("`cfg` options must be of the form `kind=value`")?;
             match kind {
+                "msize" => {
+                    let msize = value
+                        .parse()
+                        .map_err(|_| "`msize` must be a number of bytes")?;
+                    if !(MIN_MESSAGE_SIZE..=MAX_MESSAGE_SIZE).contains(&msize) {
+                        return Err("`msize` is out of range");
+                    }
+                    cfg.msize = msize;
+                }
+                "metadata_cache" => {
+                    let metadata_cache = value
+                        .parse()
+                        .map_err(|_| "`metadata_cache` must be a number of entries")?;
+                    cfg.metadata_cache = metadata_cache;
+                }
+                "readahead" => {
+                    let readahead = value
+                        .parse()
+                        .map_err(|_| "`readahead` must be a number of bytes")?;
+                    cfg.readahead = readahead;
+                }
+                "splice_reads" => {
+                    let splice_reads = value
+                        .parse()
+                        .map_err(|_| "`splice_reads` must be a boolean")?;
+                    cfg.splice_reads = splice_reads;
+                }
                 "ascii_casefold" => {
                     let ascii_casefold = value
                         .parse()
@@ -409,17 +604,32 @@ impl Default for Config {
     fn default() -> Config {
         Config {
             root: Path::new("/").into(),
-            msize: MAX_MESSAGE_SIZE,
+            msize: DEFAULT_MESSAGE_SIZE,
             uid_map: Default::default(),
             gid_map: Default::default(),
             ascii_casefold: false,
+            metadata_cache: 0,
+            splice_reads: false,
+            readahead: 0,
         }
     }
 }
+/// Returns the folder that attaches with an aname are served from, or an error to refuse them
+/// with.
+pub type Roots = Box<dyn Fn(&str) -> io::Result<PathBuf> + Send + Sync>;
+
 pub struct Server {
-    fids: BTreeMap<u32, Fid>,
+    fids: Mutex<BTreeMap<u32, Arc<Fid>>>,
     proc: File,
     cfg: Config,
+    // Where attaches are served from, if not from `cfg.root`.
+    roots: Option<Roots>,
+    // The maximum message size negotiated with the client, at most `cfg.msize`.
+    msize: AtomicU32,
+    metadata: MetadataCache,
+    buffers: BufferPool,
+    pipes: PipePool,
+    stats: Stats,
 }
 
 impl Server {
@@ -430,14 +640,21 @@ impl Server {
     ) -> io::Result<Server> {
         Server::with_config(Config {
             root: root.into(),
-            msize: MAX_MESSAGE_SIZE,
+            msize: DEFAULT_MESSAGE_SIZE,
             uid_map,
             gid_map,
             ascii_casefold: false,
+            metadata_cache: 0,
+            splice_reads: false,
+            readahead: 0,
         })
     }
 
     pub fn with_config(cfg: Config) -> io::Result<Server> {
+        if !(MIN_MESSAGE_SIZE..=MAX_MESSAGE_SIZE).contains(&cfg.msize) {
+            return Err(io::Error::from_raw_os_error(libc::EINVAL));
+        }
+
         // Safe because this is a valid c-string.
         let proc_cstr = unsafe { CStr::from_bytes_with_nul_unchecked(b"/proc\0") };
 
@@ -453,22 +670,155 @@ impl Server {
         // Safe because we just opened this fd and we know it is valid.
         let proc = unsafe { File::from_raw_fd(fd) };
         Ok(Server {
-            fids: BTreeMap::new(),
+            fids: Mutex::new(BTreeMap::new()),
             proc,
+            msize: AtomicU32::new(cfg.msize),
+            metadata: MetadataCache::new(cfg.metadata_cache),
+            buffers: Default::default(),
+            pipes: Default::default(),
+            stats: Default::default(),
             cfg,
+            roots: None,
         })
     }
 
+    /// Serves every attach from the folder `roots` returns for its aname, instead of from the
+    /// root of the configuration, so that a client can mount several folders over one
+    /// connection.
+    pub fn set_roots(&mut self, roots: Roots) {
+        self.roots = Some(roots);
+    }
+
     pub fn keep_fds(&self) -> Vec<RawFd> {
-        vec![self.proc.as_raw_fd()]
+        let mut fds = vec![self.proc.as_raw_fd()];
+        fds.extend(self.metadata.inotify_fd().map(AsRawFd::as_raw_fd));
+        fds
+    }
+
+    /// Returns the statistics of the requests served so far.
+    pub fn stats(&self) -> &Stats {
+        &self.stats
+    }
+
+    fn fids(&self) -> MutexGuard<'_, BTreeMap<u32, Arc<Fid>>> {
+        // Fids are replaced whole, so the map is consistent even if a thread panicked.
+        self.fids.lock().unwrap_or_else(PoisonError::into_inner)
+    }
+
+    fn fid(&self, fid: u32) -> io::Result<Arc<Fid>> {
+        self.fids().get(&fid).cloned().ok_or_else(ebadf)
+    }
+
+    fn msize(&self) -> u32 {
+        self.msize.load(Ordering::Relaxed)
     }
 
-    pub fn handle_message<R: Read, W: Write>(
-        &mut self,
+    // Returns the attributes of the file `fid` refers to.
+    fn stat_fid(&self, fid: &Fid) -> io::Result<libc::stat64> {
+        let token = self.metadata.token();
+        match self.metadata.get(fid.inode, token) {
+            Some(st) => Ok(st),
+            None => self.metadata.stat(&fid.path, None, token),
+        }
+    }
+
+    pub fn handle_message<R: Read, W: Output>(
+        &self,
         reader: &mut R,
         writer: &mut W,
     ) -> io::Result<()> {
-        let Tframe { tag, msg } = WireFormat::decode(&mut reader.take(self.cfg.msize as u64))?;
+        let tframe: Tframe = WireFormat::decode(&mut reader.take(self.msize() as u64))?;
+        let splice = self.cfg.splice_reads
+            && matches!(tframe.msg, Ok(Tmessage::Read(_)))
+            && writer.pipe().is_some();
+        let response = self.respond(tframe, splice);
+        let start = Instant::now();
+        let bytes = RESPONSE_BUFFER
+            .with(|scratch| self.send(response, writer, &mut scratch.borrow_mut()))?;
+        writer.flush()?;
+        self.stats.send().record(start.elapsed(), bytes, false);
+        Ok(())
+    }
+
+    // Writes `response` to `writer` and releases its buffers.  Returns the size of the response.
+    fn send<W: Output>(
+        &self,
+        response: Response,
+        writer: &mut W,
+        scratch: &mut Vec<u8>,
+    ) -> io::Result<u64> {
+        match response {
+            Response::Frame(frame) => {
+                let res = frame.write_to(writer, scratch);
+                let size = frame.byte_size() as u64;
+                if let Rmessage::Read(Rread { data: Data(buf) }) = frame.msg {
+                    self.buffers.give(buf);
+                }
+                res.map(|()| size)
+            }
+            Response::Spliced {
+                tag,
+                pipe,
+                len,
+                tail,
+            } => {
+                Rframe::encode_rread_header(tag, (len + tail.len()) as u32, writer)?;
+                // The header must reach the pipe before the data spliced after it.
+                writer.flush()?;
+                match writer.pipe() {
+                    Some(fd) => pipe.drain_to(fd, len)?,
+                    None => pipe.copy_to(writer, len)?,
+                }
+                // Pipes left with data in them after an error are dropped.
+                self.pipes.give(pipe);
+                writer.write_all(&tail)?;
+                let size = (rread_header_size() as usize + len + tail.len()) as u64;
+                self.buffers.give(tail);
+                Ok(size)
+            }
+        }
+    }
+
+    // Handles `tframe`, and counts it in the statistics.
+    fn respond(&self, tframe: Tframe, splice: bool) -> Response {
+        let timings = self.stats.request(&tframe.msg);
+        let start = Instant::now();
+        let response = self.handle_request(tframe, splice);
+        let (bytes, error) = match response {
+            Response::Frame(Rframe { ref msg, .. }) => match msg {
+                Rmessage::Read(Rread { data }) | Rmessage::Readdir(Rreaddir { data }) => {
+                    (data.len() as u64, false)
+                }
+                Rmessage::Write(Rwrite { count }) => (*count as u64, false),
+                Rmessage::Lerror(_) => (0, true),
+                _ => (0, false),
+            },
+            Response::Spliced { len, ref tail, .. } => ((len + tail.len()) as u64, false),
+        };
+        timings.record(start.elapsed(), bytes, error);
+        response
+    }
+
+    // Handles `tframe`.  With `splice`, the data a Tread asks for is spliced to a pipe, to be
+    // spliced on to the output when the response is sent.
+    fn handle_request(&self, tframe: Tframe, splice: bool) -> Response {
+        if let (true, Ok(Tmessage::Read(ref read))) = (splice, &tframe.msg) {
+            match self.read_spliced(tframe.tag, read) {
+                Ok(Some(response)) => return response,
+                Ok(None) => {}
+                Err(e) => {
+                    return Response::Frame(Rframe {
+                        tag: tframe.tag,
+                        msg: error_to_rmessage(e),
+                    })
+                }
+            }
+        }
+        Response::Frame(self.handle_tframe(tframe))
+    }
+
+    fn handle_tframe(&self, tframe: Tframe) -> Rframe {
+        let Tframe { tag, msg } = tframe;
 
         let rmsg = match msg {
             Ok(Tmessage::Version(ref version)) => self.version(version).map(Rmessage::Version),
@@ -518,65 +868,69 @@ impl Server {
         };
 
         // Errors while handling requests are never fatal.
-        let response = Rframe {
+        Rframe {
             tag,
             msg: rmsg.unwrap_or_else(error_to_rmessage),
-        };
-
-        response.encode(writer)?;
-        writer.flush()
+        }
     }
 
-    fn auth(&mut self, _auth: &Tauth) -> io::Result<Rauth> {
+    fn auth(&self, _auth: &Tauth) -> io::Result<Rauth> {
         // Returning an error for the auth message means that the server does not require
         // authentication.
         Err(io::Error::from_raw_os_error(libc::EOPNOTSUPP))
     }
 
-    fn attach(&mut self, attach: &Tattach) -> io::Result<Rattach> {
+    fn attach(&self, attach: &Tattach) -> io::Result<Rattach> {
         // TODO: Check attach parameters
-        match self.fids.entry(attach.fid) {
-            btree_map::Entry::Vacant(entry) => {
-                let root = CString::new(self.cfg.root.as_os_str().as_bytes())
-                    .map_err(|e| io::Error::new(io::ErrorKind::InvalidData, e))?;
-
-                // Safe because this doesn't modify any memory and we check the return value.
-                let fd = syscall!(unsafe {
-                    libc::openat64(
-                        libc::AT_FDCWD,
-                        root.as_ptr(),
-                        libc::O_PATH | libc::O_NOFOLLOW | libc::O_CLOEXEC,
-                    )
-                })?;
-
-                let root_path = unsafe { File::from_raw_fd(fd) };
-                let st = stat(&root_path)?;
-
-                let fid = Fid {
-                    // Safe because we just opened this fd.
-                    path: root_path,
-                    file: None,
-                    filetype: st.st_mode.into(),
-                };
-                let response = Rattach { qid: st.into() };
-                entry.insert(fid);
-                Ok(response)
-            }
-            btree_map::Entry::Occupied(_) => Err(io::Error::from_raw_os_error(libc::EBADF)),
+        if self.fids().contains_key(&attach.fid) {
+            return Err(io::Error::from_raw_os_error(libc::EBADF));
         }
+
+        let root = match self.roots {
+            Some(ref roots) => roots(&attach.aname)?,
+            None => self.cfg.root.to_path_buf(),
+        };
+        let root = CString::new(root.as_os_str().as_bytes())
+            .map_err(|e| io::Error::new(io::ErrorKind::InvalidData, e))?;
+
+        // Safe because this doesn't modify any memory and we check the return value.
+        let fd = syscall!(unsafe {
+            libc::openat64(
+                libc::AT_FDCWD,
+                root.as_ptr(),
+                libc::O_PATH | libc::O_NOFOLLOW | libc::O_CLOEXEC,
+            )
+        })?;
+
+        // Safe because we just opened this fd.
+        let root_path = unsafe { File::from_raw_fd(fd) };
+        let st = self
+            .metadata
+            .stat(&root_path, None, self.metadata.token())?;
+
+        let fid = Fid {
+            path: Arc::new(root_path),
+            file: None,
+            filetype: st.st_mode.into(),
+            inode: inode_key(&st),
+            reads: Default::default(),
+        };
+        self.fids().insert(attach.fid, Arc::new(fid));
+        Ok(Rattach { qid: st.into() })
     }
 
-    fn version(&mut self, version: &Tversion) -> io::Result<Rversion> {
+    fn version(&self, version: &Tversion) -> io::Result<Rversion> {
         if version.msize < MIN_MESSAGE_SIZE {
             return Err(io::Error::from_raw_os_error(libc::EINVAL));
         }
 
         // A Tversion request clunks all open fids and terminates any pending I/O.
-        self.fids.clear();
-        self.cfg.msize = min(self.cfg.msize, version.msize);
+        self.fids().clear();
+        let msize = min(self.msize(), version.msize);
+        self.msize.store(msize, Ordering::Relaxed);
 
         Ok(Rversion {
-            msize: self.cfg.msize,
+            msize,
             version: if version.version == "9P2000.L" {
                 String::from("9P2000.L")
             } else {
@@ -586,41 +940,48 @@ impl Server {
     }
 
     #[allow(clippy::unnecessary_wraps)]
-    fn flush(&mut self, _flush: &Tflush) -> io::Result<()> {
+    fn flush(&self, _flush: &Tflush) -> io::Result<()> {
         // TODO: Since everything is synchronous we can't actually flush requests.
         Ok(())
     }
 
-    fn walk(&mut self, walk: Twalk) -> io::Result<Rwalk> {
+    fn walk(&self, walk: Twalk) -> io::Result<Rwalk> {
         // `newfid` must not currently be in use unless it is the same as `fid`.
-        if walk.fid != walk.newfid && self.fids.contains_key(&walk.newfid) {
+        if walk.fid != walk.newfid && self.fids().contains_key(&walk.newfid) {
             return Err(io::Error::from_raw_os_error(libc::EBADF));
         }
 
-        // We need to walk the tree.  First get the starting path.
-        let start = &self.fids.get(&walk.fid).ok_or_else(ebadf)?.path;
+        // We need to walk the tree.  First get the starting fid.
+        let fid = self.fid(walk.fid)?;
 
         // Now walk the tree and break on the first error, if any.
         let expected_len = walk.wnames.len();
         let mut mds = Vec::with_capacity(expected_len);
         match do_walk(
             &self.proc,
+            &self.metadata,
             walk.wnames,
-            start,
+            &fid,
             self.cfg.ascii_casefold,
             &mut mds,
         ) {
             Ok(end) => {
                 // Store the new fid if the full walk succeeded.
                 if mds.len() == expected_len {
-                    let st = mds.last().copied().map(Ok).unwrap_or_else(|| stat(&end))?;
-                    self.fids.insert(
+                    let st = mds
+                        .last()
+                        .copied()
+                        .map(Ok)
+                        .unwrap_or_else(|| self.stat_fid(&fid))?;
+                    self.fids().insert(
                         walk.newfid,
-                        Fid {
-                            path: end,
+                        Arc::new(Fid {
+                            path: Arc::new(end),
                             file: None,
                             filetype: st.st_mode.into(),
-                        },
+                            inode: inode_key(&st),
+                            reads: Default::default(),
+                        }),
                     );
                 }
             }
@@ -637,64 +998,122 @@ impl Server {
         })
     }
 
-    fn read(&mut self, read: &Tread) -> io::Result<Rread> {
-        // Thankfully, `read` cannot be used to read directories in 9P2000.L.
-        let file = self
-            .fids
-            .get_mut(&read.fid)
-            .and_then(|fid| fid.file.as_mut())
-            .ok_or_else(ebadf)?;
+    // Returns the number of bytes a Tread for `count` bytes may read.
+    fn read_capacity(&self, count: u32) -> usize {
+        min(self.msize() - rread_header_size(), count) as usize
+    }
 
-        // Use an empty Rread struct to figure out the overhead of the header.
-        let header_size = Rframe {
-            tag: 0,
-            msg: Rmessage::Read(Rread {
-                data: Data(Vec::new()),
-            }),
-        }
-        .byte_size();
+    // Records a read of `len` bytes at `offset` through `fid`, and tells the kernel how the file is
+    // read.
+    fn record_read(&self, fid: &Fid, file: &File, offset: u64, len: usize) {
+        let hints = fid
+            .reads
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .record(offset, len as u64, self.cfg.readahead as u64);
+        read_pattern::advise(file, &hints);
+    }
+
+    // Reads up to `capacity` bytes of `file` at `offset` into a buffer from the pool.
+    fn read_at(&self, file: &File, offset: u64, capacity: usize) -> io::Result<Vec<u8>> {
+        let mut buf = self.buffers.take(capacity);
+
+        // Safe because the kernel will only write up to `capacity` bytes in the spare capacity of
+        // `buf`, and we check the return value.
+        let count = syscall!(unsafe {
+            libc::pread64(
+                file.as_raw_fd(),
+                buf.as_mut_ptr() as *mut libc::c_void,
+                capacity,
+                offset as libc::off64_t,
+            )
+        })?;
+        // Safe because the kernel initialized the first `count` bytes of `buf`.
+        unsafe { buf.set_len(count as usize) };
+
+        Ok(buf)
+    }
+
+    fn read(&self, read: &Tread) -> io::Result<Rread> {
+        // Thankfully, `read` cannot be used to read directories in 9P2000.L.
+        let fid = self.fid(read.fid)?;
+        let file = fid.file.as_ref().ok_or_else(ebadf)?;
 
-        let capacity = min(self.cfg.msize - header_size, read.count);
-        let mut buf = Data(vec![0u8; capacity as usize]);
+        let buf = self.read_at(file, read.offset, self.read_capacity(read.count))?;
+        self.record_read(&fid, file, read.offset, buf.len());
+        Ok(Rread { data: Data(buf) })
+    }
 
-        let count = file.read_at(&mut buf, read.offset)?;
-        buf.truncate(count);
+    // Splices the data `read` asks for to a pipe.  Returns None at the end of the file, and for
+    // files that cannot be spliced from, which are read as usual.
+    fn read_spliced(&self, tag: u16, read: &Tread) -> io::Result<Option<Response>> {
+        let fid = self.fid(read.fid)?;
+        let file = fid.file.as_ref().ok_or_else(ebadf)?;
+
+        let capacity = self.read_capacity(read.count);
+        let pipe = self.pipes.take(capacity)?;
+        let len = match pipe.fill(file, read.offset, capacity) {
+            Ok(len) => len,
+            Err(e) if e.raw_os_error() == Some(libc::EINVAL) => 0,
+            Err(e) => {
+                self.pipes.give(pipe);
+                return Err(e);
+            }
+        };
+        if len == 0 {
+            self.pipes.give(pipe);
+            return Ok(None);
+        }
 
-        Ok(Rread { data: buf })
+        // The pipe holds whole pages, so when the read does not start at a page boundary, the
+        // last bytes asked for may not fit.  Read those rather than answer with a short read,
+        // which the client would follow with another request.
+        let tail = if len < capacity {
+            match self.read_at(file, read.offset + len as u64, capacity - len) {
+                Ok(tail) => tail,
+                // The next read will report the error.
+                Err(_) => Vec::new(),
+            }
+        } else {
+            Vec::new()
+        };
+        self.record_read(&fid, file, read.offset, len + tail.len());
+        Ok(Some(Response::Spliced {
+            tag,
+            pipe,
+            len,
+            tail,
+        }))
     }
 
-    fn write(&mut self, write: &Twrite) -> io::Result<Rwrite> {
-        let file = self
-            .fids
-            .get_mut(&write.fid)
-            .and_then(|fid| fid.file.as_mut())
-            .ok_or_else(ebadf)?;
+    fn write(&self, write: &Twrite) -> io::Result<Rwrite> {
+        let fid = self.fid(write.fid)?;
+        let file = fid.file.as_ref().ok_or_else(ebadf)?;
 
-        let count = file.write_at(&write.data, write.offset)?;
+        let count = file.write_at(&write.data, write.offset);
+        self.metadata.invalidate(fid.inode);
+        let count = count?;
         Ok(Rwrite {
             count: count as u32,
         })
     }
 
-    fn clunk(&mut self, clunk: &Tclunk) -> io::Result<()> {
-        match self.fids.entry(clunk.fid) {
-            btree_map::Entry::Vacant(_) => Err(io::Error::from_raw_os_error(libc::EBADF)),
-            btree_map::Entry::Occupied(entry) => {
-                entry.remove();
-                Ok(())
-            }
+    fn clunk(&self, clunk: &Tclunk) -> io::Result<()> {
+        match self.fids().remove(&clunk.fid) {
+            None => Err(io::Error::from_raw_os_error(libc::EBADF)),
+            Some(_) => Ok(()),
         }
     }
 
-    fn remove(&mut self, _remove: &Tremove) -> io::Result<()> {
+    fn remove(&self, _remove: &Tremove) -> io::Result<()> {
         // Since a file could be linked into multiple locations, there is no way to know exactly
         // which path we are supposed to unlink. Linux uses unlink_at anyway, so we can just return
         // an error here.
         Err(io::Error::from_raw_os_error(libc::EOPNOTSUPP))
     }
 
-    fn statfs(&mut self, statfs: &Tstatfs) -> io::Result<Rstatfs> {
-        let fid = self.fids.get(&statfs.fid).ok_or_else(ebadf)?;
+    fn statfs(&self, statfs: &Tstatfs) -> io::Result<Rstatfs> {
+        let fid = self.fid(statfs.fid)?;
         let mut buf = MaybeUninit::zeroed();
 
         // Safe because this will only modify `out` and we check the return value.
@@ -717,21 +1136,33 @@ impl Server {
         })
     }
 
-    fn lopen(&mut self, lopen: &Tlopen) -> io::Result<Rlopen> {
-        let fid = self.fids.get_mut(&lopen.fid).ok_or_else(ebadf)?;
+    fn lopen(&self, lopen: &Tlopen) -> io::Result<Rlopen> {
+        let fid = self.fid(lopen.fid)?;
 
         let file = open_fid(&self.proc, &fid.path, lopen.flags)?;
-        let st = stat(&file)?;
-
-        fid.file = Some(file);
+        if lopen.flags & P9_TRUNC != 0 {
+            self.metadata.invalidate(fid.inode);
+        }
+        let st = self.stat_fid(&fid)?;
+
+        self.fids().insert(
+            lopen.fid,
+            Arc::new(Fid {
+                path: fid.path.clone(),
+                file: Some(file),
+                filetype: fid.filetype,
+                inode: fid.inode,
+                reads: Default::default(),
+            }),
+        );
         Ok(Rlopen {
             qid: st.into(),
             iounit: 0, // Allow the client to send requests up to the negotiated max message size.
         })
     }
 
-    fn lcreate(&mut self, lcreate: Tlcreate) -> io::Result<Rlcreate> {
-        let fid = self.fids.get_mut(&lcreate.fid).ok_or_else(ebadf)?;
+    fn lcreate(&self, lcreate: Tlcreate) -> io::Result<Rlcreate> {
+        let fid = self.fid(lcreate.fid)?;
 
         if fid.filetype != FileType::Directory {
             return Err(io::Error::from_raw_os_error(libc::ENOTDIR));
@@ -753,17 +1184,24 @@ impl Server {
         let fd = syscall!(unsafe {
             libc::openat64(fid.path.as_raw_fd(), name.as_ptr(), flags, lcreate.mode)
         })?;
+        self.metadata.invalidate_name(fid.inode, &name);
 
         // Safe because we just opened this fd and we know it is valid.
         let file = unsafe { File::from_raw_fd(fd) };
         let st = stat(&file)?;
 
-        fid.file = Some(file);
-        fid.filetype = FileType::Regular;
-
         // This fid now refers to the newly created file so we need to update the O_PATH fd for it
         // as well.
-        fid.path = lookup(&fid.path, &name)?;
+        self.fids().insert(
+            lcreate.fid,
+            Arc::new(Fid {
+                path: Arc::new(lookup(&fid.path, &name)?),
+                file: Some(file),
+                filetype: FileType::Regular,
+                inode: inode_key(&st),
+                reads: Default::default(),
+            }),
+        );
 
         Ok(Rlcreate {
             qid: st.into(),
@@ -771,25 +1209,25 @@ impl Server {
         })
     }
 
-    fn symlink(&mut self, _symlink: &Tsymlink) -> io::Result<Rsymlink> {
+    fn symlink(&self, _symlink: &Tsymlink) -> io::Result<Rsymlink> {
         // symlinks are not allowed.
         Err(io::Error::from_raw_os_error(libc::EACCES))
     }
 
-    fn mknod(&mut self, _mknod: &Tmknod) -> io::Result<Rmknod> {
+    fn mknod(&self, _mknod: &Tmknod) -> io::Result<Rmknod> {
         // No nodes either.
         Err(io::Error::from_raw_os_error(libc::EACCES))
     }
 
-    fn rename(&mut self, _rename: &Trename) -> io::Result<()> {
+    fn rename(&self, _rename: &Trename) -> io::Result<()> {
         // We cannot support this as an inode may be linked into multiple directories but we don't
         // know which one the client wants us to rename. Linux uses rename_at anyway, so we don't
         // need to worry about this.
         Err(io::Error::from_raw_os_error(libc::EOPNOTSUPP))
     }
 
-    fn readlink(&mut self, readlink: &Treadlink) -> io::Result<Rreadlink> {
-        let fid = self.fids.get(&readlink.fid).ok_or_else(ebadf)?;
+    fn readlink(&self, readlink: &Treadlink) -> io::Result<Rreadlink> {
+        let fid = self.fid(readlink.fid)?;
 
         let mut link = vec![0; libc::PATH_MAX as usize];
 
@@ -809,10 +1247,10 @@ impl Server {
     }
 
     #[allow(clippy::unnecessary_cast)] // nlink_t is u32 on 32-bit platforms
-    fn get_attr(&mut self, get_attr: &Tgetattr) -> io::Result<Rgetattr> {
-        let fid = self.fids.get_mut(&get_attr.fid).ok_or_else(ebadf)?;
+    fn get_attr(&self, get_attr: &Tgetattr) -> io::Result<Rgetattr> {
+        let fid = self.fid(get_attr.fid)?;
 
-        let st = stat(&fid.path)?;
+        let st = self.stat_fid(&fid)?;
 
         Ok(Rgetattr {
             valid: P9_GETATTR_BASIC,
@@ -838,8 +1276,14 @@ impl Server {
         })
     }
 
-    fn set_attr(&mut self, set_attr: &Tsetattr) -> io::Result<()> {
-        let fid = self.fids.get(&set_attr.fid).ok_or_else(ebadf)?;
+    fn set_attr(&self, set_attr: &Tsetattr) -> io::Result<()> {
+        let fid = self.fid(set_attr.fid)?;
+        let res = self.change_attr(&fid, set_attr);
+        self.metadata.invalidate(fid.inode);
+        res
+    }
+
+    fn change_attr(&self, fid: &Fid, set_attr: &Tsetattr) -> io::Result<()> {
         let path = string_to_cstring(format!("self/fd/{}", fid.path.as_raw_fd()))?;
 
         if set_attr.valid & P9_SETATTR_MODE != 0 {
@@ -937,16 +1381,16 @@ impl Server {
         Ok(())
     }
 
-    fn xattr_walk(&mut self, _xattr_walk: &Txattrwalk) -> io::Result<Rxattrwalk> {
+    fn xattr_walk(&self, _xattr_walk: &Txattrwalk) -> io::Result<Rxattrwalk> {
         Err(io::Error::from_raw_os_error(libc::EOPNOTSUPP))
     }
 
-    fn xattr_create(&mut self, _xattr_create: &Txattrcreate) -> io::Result<()> {
+    fn xattr_create(&self, _xattr_create: &Txattrcreate) -> io::Result<()> {
         Err(io::Error::from_raw_os_error(libc::EOPNOTSUPP))
     }
 
-    fn readdir(&mut self, readdir: &Treaddir) -> io::Result<Rreaddir> {
-        let fid = self.fids.get_mut(&readdir.fid).ok_or_else(ebadf)?;
+    fn readdir(&self, readdir: &Treaddir) -> io::Result<Rreaddir> {
+        let fid = self.fid(readdir.fid)?;
 
         if fid.filetype != FileType::Directory {
             return Err(io::Error::from_raw_os_error(libc::ENOTDIR));
@@ -961,48 +1405,57 @@ impl Server {
             }),
         }
         .byte_size();
-        let count = min(self.cfg.msize - header_size, readdir.count);
+        let count = min(self.msize() - header_size, readdir.count);
         let mut cursor = Cursor::new(Vec::with_capacity(count as usize));
 
-        let dir = fid.file.as_mut().ok_or_else(ebadf)?;
-        let mut dirents = read_dir(dir, readdir.offset as libc::off64_t)?;
-        while let Some(dirent) = dirents.next().transpose()? {
-            let st = statat(&fid.path, dirent.name, 0)?;
-
-            let name = dirent
-                .name
-                .to_str()
-                .map(String::from)
-                .map_err(|err| io::Error::new(io::ErrorKind::InvalidData, err))?;
-
-            let entry = Dirent {
-                qid: st.into(),
-                offset: dirent.offset,
-                ty: dirent.type_,
-                name,
-            };
+        let dir = fid.file.as_ref().ok_or_else(ebadf)?;
+        DIRENT_BUFFER.with(|buf| -> io::Result<()> {
+            let mut buf = buf.borrow_mut();
+            let size = max(
+                min(count as usize, MAX_DIRENT_BUFFER_SIZE),
+                read_dir::MIN_BUFFER_SIZE,
+            );
+            if buf.len() < size {
+                buf.resize(size, 0);
+            }
 
-            let byte_size = entry.byte_size() as usize;
+            let mut dirents = read_dir(dir, readdir.offset as libc::off64_t, &mut buf[..size])?;
+            while let Some(dirent) = dirents.next().transpose()? {
+                let (qid, ty) = dirent_qid(&fid.path, &dirent)?;
+
+                let name = dirent
+                    .name
+                    .to_str()
+                    .map(String::from)
+                    .map_err(|err| io::Error::new(io::ErrorKind::InvalidData, err))?;
+
+                let entry = Dirent {
+                    qid,
+                    offset: dirent.offset,
+                    ty,
+                    name,
+                };
 
-            if cursor.get_ref().capacity() - cursor.get_ref().len() < byte_size {
-                // No more room in the buffer.
-                break;
-            }
+                let byte_size = entry.byte_size() as usize;
 
-            entry.encode(&mut cursor)?;
-        }
+                if cursor.get_ref().capacity() - cursor.get_ref().len() < byte_size {
+                    // No more room in the buffer.
+                    break;
+                }
+
+                entry.encode(&mut cursor)?;
+            }
+            Ok(())
+        })?;
 
         Ok(Rreaddir {
             data: Data(cursor.into_inner()),
         })
     }
 
-    fn fsync(&mut self, fsync: &Tfsync) -> io::Result<()> {
-        let file = self
-            .fids
-            .get(&fsync.fid)
-            .and_then(|fid| fid.file.as_ref())
-            .ok_or_else(ebadf)?;
+    fn fsync(&self, fsync: &Tfsync) -> io::Result<()> {
+        let fid = self.fid(fsync.fid)?;
+        let file = fid.file.as_ref().ok_or_else(ebadf)?;
 
         if fsync.datasync == 0 {
             file.sync_all()?;
@@ -1024,14 +1477,10 @@ impl Server {
     /// tracks with QEMU implementation, and will be obviated if crosvm decides
     /// to drop 9p in favor of virtio-fs. QEMU only allows for a single client,
     /// and we leave it to users of the crate to provide actual lock handling.
-    fn lock(&mut self, lock: &Tlock) -> io::Result<Rlock> {
+    fn lock(&self, lock: &Tlock) -> io::Result<Rlock> {
         // Ensure fd passed in TLOCK request exists and has a mapping.
-        let fd = self
-            .fids
-            .get(&lock.fid)
-            .and_then(|fid| fid.file.as_ref())
-            .ok_or_else(ebadf)?
-            .as_raw_fd();
+        let fid = self.fid(lock.fid)?;
+        let fd = fid.file.as_ref().ok_or_else(ebadf)?.as_raw_fd();
 
         syscall!(unsafe {
             // Safe because zero-filled libc::stat is a valid value, fstat
@@ -1049,14 +1498,10 @@ impl Server {
     ///
     /// Much like lock(), defer locking semantics to VFS and return success.
     ///
-    fn get_lock(&mut self, get_lock: &Tgetlock) -> io::Result<Rgetlock> {
+    fn get_lock(&self, get_lock: &Tgetlock) -> io::Result<Rgetlock> {
         // Ensure fd passed in GETTLOCK request exists and has a mapping.
-        let fd = self
-            .fids
-            .get(&get_lock.fid)
-            .and_then(|fid| fid.file.as_ref())
-            .ok_or_else(ebadf)?
-            .as_raw_fd();
+        let fid = self.fid(get_lock.fid)?;
+        let fd = fid.file.as_ref().ok_or_else(ebadf)?.as_raw_fd();
 
         // Safe because this doesn't modify memory and we check the return value.
         syscall!(unsafe {
@@ -1073,11 +1518,11 @@ impl Server {
         })
     }
 
-    fn link(&mut self, link: Tlink) -> io::Result<()> {
-        let target = self.fids.get(&link.fid).ok_or_else(ebadf)?;
+    fn link(&self, link: Tlink) -> io::Result<()> {
+        let target = self.fid(link.fid)?;
         let path = string_to_cstring(format!("self/fd/{}", target.path.as_raw_fd()))?;
 
-        let dir = self.fids.get(&link.dfid).ok_or_else(ebadf)?;
+        let dir = self.fid(link.dfid)?;
         let name = string_to_cstring(link.name)?;
 
         // Safe because this doesn't modify any memory and we check the return value.
@@ -1090,25 +1535,28 @@ impl Server {
                 libc::AT_SYMLINK_FOLLOW,
             )
         })?;
+        self.metadata.invalidate_name(dir.inode, &name);
+        self.metadata.invalidate(target.inode);
         Ok(())
     }
 
-    fn mkdir(&mut self, mkdir: Tmkdir) -> io::Result<Rmkdir> {
-        let fid = self.fids.get(&mkdir.dfid).ok_or_else(ebadf)?;
+    fn mkdir(&self, mkdir: Tmkdir) -> io::Result<Rmkdir> {
+        let fid = self.fid(mkdir.dfid)?;
         let name = string_to_cstring(mkdir.name)?;
 
         // Safe because this doesn't modify any memory and we check the return value.
         syscall!(unsafe { libc::mkdirat(fid.path.as_raw_fd(), name.as_ptr(), mkdir.mode) })?;
+        self.metadata.invalidate_name(fid.inode, &name);
         Ok(Rmkdir {
             qid: statat(&fid.path, &name, 0).map(Qid::from)?,
         })
     }
 
-    fn rename_at(&mut self, rename_at: Trenameat) -> io::Result<()> {
-        let olddir = self.fids.get(&rename_at.olddirfid).ok_or_else(ebadf)?;
+    fn rename_at(&self, rename_at: Trenameat) -> io::Result<()> {
+        let olddir = self.fid(rename_at.olddirfid)?;
         let oldname = string_to_cstring(rename_at.oldname)?;
 
-        let newdir = self.fids.get(&rename_at.newdirfid).ok_or_else(ebadf)?;
+        let newdir = self.fid(rename_at.newdirfid)?;
         let newname = string_to_cstring(rename_at.newname)?;
 
         // Safe because this doesn't modify any memory and we check the return value.
@@ -1120,12 +1568,14 @@ impl Server {
                 newname.as_ptr(),
             )
         })?;
+        self.metadata.invalidate_name(olddir.inode, &oldname);
+        self.metadata.invalidate_name(newdir.inode, &newname);
 
         Ok(())
     }
 
-    fn unlink_at(&mut self, unlink_at: Tunlinkat) -> io::Result<()> {
-        let dir = self.fids.get(&unlink_at.dirfd).ok_or_else(ebadf)?;
+    fn unlink_at(&self, unlink_at: Tunlinkat) -> io::Result<()> {
+        let dir = self.fid(unlink_at.dirfd)?;
         let name = string_to_cstring(unlink_at.name)?;
 
         syscall!(unsafe {
@@ -1135,6 +1585,7 @@ impl Server {
                 unlink_at.flags as libc::c_int,
             )
         })?;
+        self.metadata.invalidate_name(dir.inode, &name);
 
         Ok(())
     }
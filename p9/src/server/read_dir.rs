@@ -44,21 +44,23 @@ pub struct DirEntry<'r> {
     pub name: &'r CStr,
 }
 
-pub struct ReadDir<'d, D> {
-    // This buffer is double the size of NAME_MAX because
-    // getdents64 chokes (EINVAL) with a buffer sized
-    // NAME MAX on file names close to NAME_MAX in length.
-    buf: [u8; 512],
-    dir: &'d mut D,
+// The smallest buffer `read_dir` accepts.  This is double the size of NAME_MAX because
+// getdents64 chokes (EINVAL) with a buffer sized NAME MAX on file names close to NAME_MAX
+// in length.
+pub const MIN_BUFFER_SIZE: usize = 512;
+
+pub struct ReadDir<'d, 'b, D> {
+    buf: &'b mut [u8],
+    dir: &'d D,
     current: usize,
     end: usize,
 }
 
-impl<'d, D: AsRawFd> ReadDir<'d, D> {
+impl<'d, 'b, D: AsRawFd> ReadDir<'d, 'b, D> {
     /// Return the next directory entry. This is implemented as a separate method rather than via
     /// the `Iterator` trait because rust doesn't currently support generic associated types.
     #[allow(clippy::should_implement_trait)]
-    pub fn next(&mut self) -> Option<Result<DirEntry>> {
+    pub fn next(&mut self) -> Option<Result<DirEntry<'_>>> {
         if self.current >= self.end {
             let res: Result<libc::c_long> = syscall!(unsafe {
                 libc::syscall(
@@ -116,12 +118,20 @@ impl<'d, D: AsRawFd> ReadDir<'d, D> {
     }
 }
 
-pub fn read_dir<D: AsRawFd>(dir: &mut D, offset: libc::off64_t) -> Result<ReadDir<D>> {
+/// Reads the entries of `dir` from `offset` on, as many at a time as fit in `buf`, which must be
+/// at least `MIN_BUFFER_SIZE` bytes long.
+pub fn read_dir<'d, 'b, D: AsRawFd>(
+    dir: &'d D,
+    offset: libc::off64_t,
+    buf: &'b mut [u8],
+) -> Result<ReadDir<'d, 'b, D>> {
+    debug_assert!(buf.len() >= MIN_BUFFER_SIZE, "`buf` is too small");
+
     // Safe because this doesn't modify any memory and we check the return value.
     syscall!(unsafe { libc::lseek64(dir.as_raw_fd(), offset, libc::SEEK_SET) })?;
 
     Ok(ReadDir {
-        buf: [0u8; 512],
+        buf,
         dir,
         current: 0,
         end: 0,
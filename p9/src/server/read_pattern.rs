@@ -0,0 +1,174 @@
+//! Tells the kernel how the files served are read.
+//!
+//! The kernel reads ahead of sequential reads on its own, but the reads of a client arrive one or
+//! a few at a time, after a round trip over qrexec each, and rarely make the pattern obvious
+//! enough for it to read far ahead.  So every open fid tracks where its last read ended.  Once a
+//! few reads in a row continue where the previous one ended, the kernel is told that the file is
+//! read sequentially, which grows its readahead, and the window past the last read is prefetched
+//! into the page cache, so that the next requests find their data there instead of waiting for
+//! the disk.  Reads that keep jumping around turn readahead off, as it would only waste I/O,
+//! until reads are sequential again.
+
+use std::fs::File;
+use std::os::unix::io::AsRawFd;
+
+// The number of reads in a row that must continue where the previous one ended, or must not, for
+// the file to be deemed read sequentially or randomly.
+const SEQUENTIAL_READS: u32 = 2;
+const RANDOM_READS: u32 = 4;
+
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum Advice {
+    #[default]
+    Normal,
+    Sequential,
+    Random,
+}
+
+/// What the kernel should be told after a read.
+#[derive(Debug, Default, PartialEq, Eq)]
+pub struct Hints {
+    /// How the file is read, if that changed.
+    pub advice: Option<Advice>,
+    /// The offset and length of a range to prefetch.
+    pub prefetch: Option<(u64, u64)>,
+}
+
+#[derive(Default)]
+pub struct ReadPattern {
+    // Where the last read ended.
+    next: u64,
+    // The number of reads in a row that continued where the previous one ended, and that did not.
+    sequential: u32,
+    random: u32,
+    advice: Advice,
+    // Where the range prefetched so far ends.
+    prefetched: u64,
+}
+
+impl ReadPattern {
+    /// Records a read of `len` bytes at `offset`, and returns what to tell the kernel about it.
+    /// Up to `window` bytes past the reads of a file read sequentially are prefetched.
+    pub fn record(&mut self, offset: u64, len: u64, window: u64) -> Hints {
+        if offset == self.next {
+            self.sequential = self.sequential.saturating_add(1);
+            self.random = 0;
+        } else {
+            self.sequential = 0;
+            self.random = self.random.saturating_add(1);
+            self.prefetched = 0;
+        }
+        self.next = offset + len;
+
+        let mut hints = Hints::default();
+        let advice = if self.sequential >= SEQUENTIAL_READS {
+            Advice::Sequential
+        } else if self.random >= RANDOM_READS {
+            Advice::Random
+        } else {
+            self.advice
+        };
+        if advice != self.advice {
+            self.advice = advice;
+            hints.advice = Some(advice);
+        }
+
+        // Prefetch a window at a time, once reads are half way through the previous one.
+        if advice == Advice::Sequential
+            && self.sequential > 0
+            && window > 0
+            && self.prefetched <= self.next + window / 2
+        {
+            let start = self.prefetched.max(self.next);
+            self.prefetched = self.next + window;
+            hints.prefetch = Some((start, self.prefetched - start));
+        }
+        hints
+    }
+}
+
+/// Gives `hints` to the kernel for `file`.  Hints are only hints, so errors are ignored.
+pub fn advise(file: &File, hints: &Hints) {
+    let fd = file.as_raw_fd();
+    if let Some(advice) = hints.advice {
+        let advice = match advice {
+            Advice::Normal => libc::POSIX_FADV_NORMAL,
+            Advice::Sequential => libc::POSIX_FADV_SEQUENTIAL,
+            Advice::Random => libc::POSIX_FADV_RANDOM,
+        };
+        // Safe because this doesn't modify any memory.
+        unsafe { libc::posix_fadvise64(fd, 0, 0, advice) };
+    }
+    if let Some((offset, len)) = hints.prefetch {
+        // Safe because this doesn't modify any memory.
+        unsafe {
+            libc::posix_fadvise64(
+                fd,
+                offset as libc::off64_t,
+                len as libc::off64_t,
+                libc::POSIX_FADV_WILLNEED,
+            )
+        };
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const WINDOW: u64 = 4096;
+
+    #[test]
+    fn sequential() {
+        let mut pattern = ReadPattern::default();
+        assert_eq!(pattern.record(0, 1024, WINDOW), Hints::default());
+        assert_eq!(
+            pattern.record(1024, 1024, WINDOW),
+            Hints {
+                advice: Some(Advice::Sequential),
+                prefetch: Some((2048, WINDOW)),
+            }
+        );
+        // The next window is only prefetched once reads are half way through this one.
+        assert_eq!(pattern.record(2048, 1024, WINDOW), Hints::default());
+        assert_eq!(
+            pattern.record(3072, 1024, WINDOW),
+            Hints {
+                advice: None,
+                prefetch: Some((6144, 2048)),
+            }
+        );
+        // Nothing is prefetched with no window.
+        assert_eq!(pattern.record(4096, 1024, 0), Hints::default());
+    }
+
+    #[test]
+    fn random() {
+        let mut pattern = ReadPattern::default();
+        pattern.record(0, 1024, WINDOW);
+        pattern.record(1024, 1024, WINDOW);
+
+        // A single seek does not end sequential reads.
+        assert_eq!(pattern.record(65536, 1024, WINDOW).advice, None);
+        for offset in [0, 32768] {
+            assert_eq!(pattern.record(offset, 1024, WINDOW), Hints::default());
+        }
+        assert_eq!(
+            pattern.record(16384, 1024, WINDOW),
+            Hints {
+                advice: Some(Advice::Random),
+                prefetch: None,
+            }
+        );
+
+        // Reads are sequential again once they continue where the previous one ended.
+        assert_eq!(pattern.record(17408, 1024, WINDOW).advice, None);
+        assert_eq!(
+            pattern.record(18432, 1024, WINDOW),
+            Hints {
+                advice: Some(Advice::Sequential),
+                prefetch: Some((19456, WINDOW)),
+            }
+        );
+    }
+}
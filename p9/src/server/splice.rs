@@ -0,0 +1,173 @@
+//! Moves file data to the client without copying it through memory.
+//!
+//! When responses are written to a pipe, as they are over qrexec, the data of an Rread can be
+//! spliced from the page cache to the pipe instead of being read into a buffer and written from
+//! there.  Its header goes first, and holds the number of bytes that follow, which is only known
+//! once the file has been read: a short read at the end of the file or a concurrent truncation
+//! must not leave the client waiting for bytes that never come.  So the data is first spliced to
+//! a pipe of the server's own, which only moves references to pages, and from there to the client
+//! after the header.
+
+use std::fs::File;
+use std::io;
+use std::io::ErrorKind;
+use std::io::Read;
+use std::io::Write;
+use std::os::unix::io::AsRawFd;
+use std::os::unix::io::FromRawFd;
+use std::os::unix::io::RawFd;
+use std::ptr;
+use std::sync::Mutex;
+use std::sync::PoisonError;
+
+use crate::syscall;
+
+// The number of idle pipes kept, like the buffers of `BufferPool`.
+const MAX_IDLE_PIPES: usize = 8;
+
+// The size of a new pipe, in bytes.
+const DEFAULT_PIPE_SIZE: libc::c_int = 64 * 1024;
+
+/// Returns whether `fd` is a pipe that file data can be spliced to.
+pub fn is_pipe(fd: RawFd) -> bool {
+    // Safe because this only writes to `st`, and we check the return value.
+    let mut st = unsafe { std::mem::zeroed::<libc::stat64>() };
+    syscall!(unsafe { libc::fstat64(fd, &mut st) }).is_ok()
+        && st.st_mode & libc::S_IFMT == libc::S_IFIFO
+}
+
+/// A pipe that holds file data on its way to the client.
+pub struct Pipe {
+    read: File,
+    write: File,
+    // The number of bytes the pipe holds when full.
+    capacity: usize,
+}
+
+impl Pipe {
+    fn new(capacity: usize) -> io::Result<Pipe> {
+        let mut fds = [0; 2];
+        // Safe because this only writes two fds to `fds`, and we check the return value.
+        syscall!(unsafe { libc::pipe2(fds.as_mut_ptr(), libc::O_CLOEXEC) })?;
+        // Safe because we just opened these fds and nothing else owns them.
+        let (read, write) = unsafe { (File::from_raw_fd(fds[0]), File::from_raw_fd(fds[1])) };
+
+        // Pipes only hold 64 KiB by default.  Unprivileged processes may grow them up to
+        // /proc/sys/fs/pipe-max-size, 1 MiB by default, and reads are shortened to what fits.
+        let mut size = libc::c_int::try_from(capacity).unwrap_or(libc::c_int::MAX);
+        let capacity = loop {
+            // Safe because this doesn't modify any memory and we check the return value.
+            match syscall!(unsafe { libc::fcntl(write.as_raw_fd(), libc::F_SETPIPE_SZ, size) }) {
+                Ok(capacity) => break capacity,
+                Err(e) if e.raw_os_error() == Some(libc::EPERM) && size > DEFAULT_PIPE_SIZE => {
+                    size /= 2
+                }
+                // Safe because this doesn't modify any memory and we check the return value.
+                Err(_) => {
+                    break syscall!(unsafe { libc::fcntl(write.as_raw_fd(), libc::F_GETPIPE_SZ) })?
+                }
+            }
+        };
+        Ok(Pipe {
+            read,
+            write,
+            capacity: capacity as usize,
+        })
+    }
+
+    /// Splices up to `count` bytes of `file` starting at `offset` into the pipe, which must be
+    /// empty.  Returns the number of bytes spliced, which is less than `count` at the end of the
+    /// file or when the pipe is full.
+    pub fn fill(&self, file: &File, offset: u64, count: usize) -> io::Result<usize> {
+        let count = count.min(self.capacity);
+        let mut offset = offset as libc::loff_t;
+        let mut filled = 0;
+        while filled < count {
+            // The pipe is ours and never waited on, so a full pipe is reported rather than
+            // blocking.  Safe because this only modifies `offset`, and we check the return value.
+            let res = syscall!(unsafe {
+                libc::splice(
+                    file.as_raw_fd(),
+                    &mut offset,
+                    self.write.as_raw_fd(),
+                    ptr::null_mut(),
+                    count - filled,
+                    libc::SPLICE_F_NONBLOCK,
+                )
+            });
+            match res {
+                Ok(0) => break,
+                Ok(n) => filled += n as usize,
+                Err(e) if e.kind() == ErrorKind::Interrupted => {}
+                // Pages that straddle the end of a partially filled pipe may leave it full early.
+                // Other errors are left for the next read to report, as read(2) does.
+                Err(_) if filled > 0 => break,
+                Err(e) => return Err(e),
+            }
+        }
+        Ok(filled)
+    }
+
+    /// Splices the `len` bytes the pipe holds to `fd`, leaving the pipe empty.
+    pub fn drain_to(&self, fd: RawFd, len: usize) -> io::Result<()> {
+        let mut left = len;
+        while left > 0 {
+            // Safe because this doesn't modify any memory and we check the return value.
+            let res = syscall!(unsafe {
+                libc::splice(
+                    self.read.as_raw_fd(),
+                    ptr::null_mut(),
+                    fd,
+                    ptr::null_mut(),
+                    left,
+                    libc::SPLICE_F_MOVE,
+                )
+            });
+            match res {
+                Ok(0) => return Err(io::Error::from(ErrorKind::WriteZero)),
+                Ok(n) => left -= n as usize,
+                Err(e) if e.kind() == ErrorKind::Interrupted => {}
+                Err(e) => return Err(e),
+            }
+        }
+        Ok(())
+    }
+
+    /// Copies the `len` bytes the pipe holds to `writer`, for outputs that cannot be spliced to.
+    pub fn copy_to<W: Write>(&self, writer: &mut W, len: usize) -> io::Result<()> {
+        let copied = io::copy(&mut (&self.read).take(len as u64), writer)?;
+        if copied < len as u64 {
+            return Err(io::Error::from(ErrorKind::UnexpectedEof));
+        }
+        Ok(())
+    }
+}
+
+#[derive(Default)]
+pub struct PipePool {
+    idle: Mutex<Vec<Pipe>>,
+}
+
+impl PipePool {
+    /// Returns an empty pipe.  New pipes are grown to hold `capacity` bytes, or as many as they
+    /// may.
+    pub fn take(&self, capacity: usize) -> io::Result<Pipe> {
+        let pipe = self
+            .idle
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .pop();
+        match pipe {
+            Some(pipe) => Ok(pipe),
+            None => Pipe::new(capacity),
+        }
+    }
+
+    /// Returns `pipe` to the pool, unless enough pipes are idle already.  The pipe must be empty.
+    pub fn give(&self, pipe: Pipe) {
+        let mut idle = self.idle.lock().unwrap_or_else(PoisonError::into_inner);
+        if idle.len() < MAX_IDLE_PIPES {
+            idle.push(pipe);
+        }
+    }
+}
@@ -0,0 +1,269 @@
+//! Counts the requests served and times them.
+//!
+//! A slow mount may be waiting for the disk, for the server, or for the transport to carry its
+//! messages.  Every request is timed from when a worker starts handling it until its response is
+//! ready, which covers the system calls it makes, and the responses are timed while they are
+//! written to the client, which covers the time the transport takes to accept them.  When requests
+//! run concurrently, the time they wait in the queue for a worker is timed as well.
+//!
+//! Times are kept in histograms with buckets that double in size, from under a microsecond to over
+//! half an hour, so that the few slow requests that users notice are not averaged away.
+
+use std::io;
+use std::io::Write;
+use std::sync::atomic::AtomicU64;
+use std::sync::atomic::Ordering;
+use std::time::Duration;
+use std::time::Instant;
+
+use crate::protocol::*;
+
+// The names of the operations requests are counted under, with the requests that could not be
+// decoded last.
+const OPERATIONS: [&str; 29] = [
+    "version",
+    "flush",
+    "walk",
+    "read",
+    "write",
+    "clunk",
+    "remove",
+    "attach",
+    "auth",
+    "statfs",
+    "lopen",
+    "lcreate",
+    "symlink",
+    "mknod",
+    "rename",
+    "readlink",
+    "getattr",
+    "setattr",
+    "xattrwalk",
+    "xattrcreate",
+    "readdir",
+    "fsync",
+    "lock",
+    "getlock",
+    "link",
+    "mkdir",
+    "renameat",
+    "unlinkat",
+    "invalid",
+];
+
+// Bucket `i` counts the times under 2^i microseconds, and the last one the times over that.
+const BUCKETS: usize = 32;
+
+// Returns the index of the operation `msg` is counted under.
+fn operation(msg: &io::Result<Tmessage>) -> usize {
+    match msg {
+        Ok(Tmessage::Version(_)) => 0,
+        Ok(Tmessage::Flush(_)) => 1,
+        Ok(Tmessage::Walk(_)) => 2,
+        Ok(Tmessage::Read(_)) => 3,
+        Ok(Tmessage::Write(_)) => 4,
+        Ok(Tmessage::Clunk(_)) => 5,
+        Ok(Tmessage::Remove(_)) => 6,
+        Ok(Tmessage::Attach(_)) => 7,
+        Ok(Tmessage::Auth(_)) => 8,
+        Ok(Tmessage::Statfs(_)) => 9,
+        Ok(Tmessage::Lopen(_)) => 10,
+        Ok(Tmessage::Lcreate(_)) => 11,
+        Ok(Tmessage::Symlink(_)) => 12,
+        Ok(Tmessage::Mknod(_)) => 13,
+        Ok(Tmessage::Rename(_)) => 14,
+        Ok(Tmessage::Readlink(_)) => 15,
+        Ok(Tmessage::GetAttr(_)) => 16,
+        Ok(Tmessage::SetAttr(_)) => 17,
+        Ok(Tmessage::XattrWalk(_)) => 18,
+        Ok(Tmessage::XattrCreate(_)) => 19,
+        Ok(Tmessage::Readdir(_)) => 20,
+        Ok(Tmessage::Fsync(_)) => 21,
+        Ok(Tmessage::Lock(_)) => 22,
+        Ok(Tmessage::GetLock(_)) => 23,
+        Ok(Tmessage::Link(_)) => 24,
+        Ok(Tmessage::Mkdir(_)) => 25,
+        Ok(Tmessage::RenameAt(_)) => 26,
+        Ok(Tmessage::UnlinkAt(_)) => 27,
+        Err(_) => 28,
+    }
+}
+
+/// The number of events of one kind, the bytes they moved, and how long they took.
+pub struct Timings {
+    count: AtomicU64,
+    errors: AtomicU64,
+    bytes: AtomicU64,
+    total_nanos: AtomicU64,
+    max_nanos: AtomicU64,
+    histogram: [AtomicU64; BUCKETS],
+}
+
+impl Default for Timings {
+    fn default() -> Timings {
+        Timings {
+            count: Default::default(),
+            errors: Default::default(),
+            bytes: Default::default(),
+            total_nanos: Default::default(),
+            max_nanos: Default::default(),
+            histogram: std::array::from_fn(|_| Default::default()),
+        }
+    }
+}
+
+impl Timings {
+    /// Records an event that moved `bytes` and took `elapsed`.
+    pub(super) fn record(&self, elapsed: Duration, bytes: u64, error: bool) {
+        let nanos = u64::try_from(elapsed.as_nanos()).unwrap_or(u64::MAX);
+        let micros = nanos / 1000;
+        let bucket = (u64::BITS - micros.leading_zeros()) as usize;
+
+        self.count.fetch_add(1, Ordering::Relaxed);
+        if error {
+            self.errors.fetch_add(1, Ordering::Relaxed);
+        }
+        self.bytes.fetch_add(bytes, Ordering::Relaxed);
+        self.total_nanos.fetch_add(nanos, Ordering::Relaxed);
+        self.max_nanos.fetch_max(nanos, Ordering::Relaxed);
+        self.histogram[bucket.min(BUCKETS - 1)].fetch_add(1, Ordering::Relaxed);
+    }
+
+    fn write_json<W: Write>(&self, writer: &mut W) -> io::Result<()> {
+        write!(
+            writer,
+            "{{\"count\": {}, \"errors\": {}, \"bytes\": {}, \"total_us\": {}, \"max_us\": {}, \
+             \"histogram_us\": {{",
+            self.count.load(Ordering::Relaxed),
+            self.errors.load(Ordering::Relaxed),
+            self.bytes.load(Ordering::Relaxed),
+            self.total_nanos.load(Ordering::Relaxed) / 1000,
+            self.max_nanos.load(Ordering::Relaxed) / 1000,
+        )?;
+        // Only the buckets that counted anything are listed, keyed by the time they count
+        // events under, and "+" for the last one.
+        let mut separator = "";
+        for (i, bucket) in self.histogram.iter().enumerate() {
+            let count = bucket.load(Ordering::Relaxed);
+            if count == 0 {
+                continue;
+            }
+            if i == BUCKETS - 1 {
+                write!(writer, "{}\"+\": {}", separator, count)?;
+            } else {
+                write!(writer, "{}\"{}\": {}", separator, 1u64 << i, count)?;
+            }
+            separator = ", ";
+        }
+        write!(writer, "}}}}")
+    }
+}
+
+/// What the server has done since it started.
+pub struct Stats {
+    started: Instant,
+    requests: [Timings; OPERATIONS.len()],
+    queue: Timings,
+    send: Timings,
+}
+
+impl Default for Stats {
+    fn default() -> Stats {
+        Stats {
+            started: Instant::now(),
+            requests: std::array::from_fn(|_| Default::default()),
+            queue: Default::default(),
+            send: Default::default(),
+        }
+    }
+}
+
+impl Stats {
+    /// Returns the timings of the requests like `msg`.
+    pub(super) fn request(&self, msg: &io::Result<Tmessage>) -> &Timings {
+        &self.requests[operation(msg)]
+    }
+
+    /// Returns the timings of the time requests wait for a worker.
+    pub(super) fn queue(&self) -> &Timings {
+        &self.queue
+    }
+
+    /// Returns the timings of the writes of responses to the client.  A write may carry several
+    /// responses, and its bytes count the data of all of them.
+    pub(super) fn send(&self) -> &Timings {
+        &self.send
+    }
+
+    /// Writes the statistics to `writer` as a JSON object, on one line.  Operations that no
+    /// request was made for are left out.
+    pub fn write_json<W: Write>(&self, writer: &mut W) -> io::Result<()> {
+        write!(
+            writer,
+            "{{\"uptime_s\": {:.3}, \"requests\": {{",
+            self.started.elapsed().as_secs_f64()
+        )?;
+        let mut separator = "";
+        for (name, timings) in OPERATIONS.iter().zip(&self.requests) {
+            if timings.count.load(Ordering::Relaxed) == 0 {
+                continue;
+            }
+            write!(writer, "{}\"{}\": ", separator, name)?;
+            timings.write_json(writer)?;
+            separator = ", ";
+        }
+        write!(writer, "}}, \"queue\": ")?;
+        self.queue.write_json(writer)?;
+        write!(writer, ", \"send\": ")?;
+        self.send.write_json(writer)?;
+        writeln!(writer, "}}")
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn histogram() {
+        let timings = Timings::default();
+        timings.record(Duration::from_nanos(500), 0, false);
+        timings.record(Duration::from_micros(1), 0, false);
+        timings.record(Duration::from_micros(3), 10, true);
+        timings.record(Duration::from_micros(3), 20, false);
+        timings.record(Duration::from_secs(3600), 0, false);
+
+        let mut json = Vec::new();
+        timings.write_json(&mut json).unwrap();
+        assert_eq!(
+            String::from_utf8(json).unwrap(),
+            "{\"count\": 5, \"errors\": 1, \"bytes\": 30, \"total_us\": 3600000007, \
+             \"max_us\": 3600000000, \"histogram_us\": {\"1\": 1, \"2\": 1, \"4\": 2, \"+\": 1}}"
+        );
+    }
+
+    #[test]
+    fn operations() {
+        let stats = Stats::default();
+        let read = Ok(Tmessage::Read(Tread {
+            fid: 1,
+            offset: 0,
+            count: 4096,
+        }));
+        stats
+            .request(&read)
+            .record(Duration::from_micros(5), 4096, false);
+        stats
+            .request(&Err(io::Error::from(io::ErrorKind::InvalidData)))
+            .record(Duration::from_micros(1), 0, true);
+
+        let mut json = Vec::new();
+        stats.write_json(&mut json).unwrap();
+        let json = String::from_utf8(json).unwrap();
+        assert!(json.contains("\"read\": {\"count\": 1, \"errors\": 0, \"bytes\": 4096,"));
+        assert!(json.contains("\"invalid\": {\"count\": 1, \"errors\": 1,"));
+        assert!(!json.contains("\"write\""));
+        assert!(json.ends_with("}\n"));
+    }
+}
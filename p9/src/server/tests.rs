@@ -181,10 +181,21 @@ fn check_qid(qid: &Qid, md: &fs::Metadata) {
         panic!("unknown file type: {:?}", md.file_type());
     };
     assert_eq!(qid.ty, ty);
-    assert_eq!(qid.version, md.mtime() as u32);
+    assert_eq!(qid.version, qid_version(md.ctime(), md.ctime_nsec()));
     assert_eq!(qid.path, md.ino());
 }
 
+// Like check_qid, for the qids in directory entries, which carry no version.
+fn check_dirent_qid(qid: &Qid, md: &fs::Metadata) {
+    check_qid(
+        &Qid {
+            version: qid_version(md.ctime(), md.ctime_nsec()),
+            ..*qid
+        },
+        md,
+    );
+}
+
 fn check_attr(server: &mut Server, fid: u32, md: &fs::Metadata) {
     let tgetattr = Tgetattr {
         fid,
@@ -204,7 +215,10 @@ fn check_attr(server: &mut Server, fid: u32, md: &fs::Metadata) {
     };
     assert_eq!(rgetattr.valid, P9_GETATTR_BASIC);
     assert_eq!(rgetattr.qid.ty, ty);
-    assert_eq!(rgetattr.qid.version, md.mtime() as u32);
+    assert_eq!(
+        rgetattr.qid.version,
+        qid_version(md.ctime(), md.ctime_nsec())
+    );
     assert_eq!(rgetattr.qid.path, md.ino());
     assert_eq!(rgetattr.mode, md.mode());
     assert_eq!(rgetattr.uid, md.uid());
@@ -463,7 +477,7 @@ fn setup<P: AsRef<Path>>(name: P) -> (ScopedPath<OsString>, Server) {
         .symlink_metadata()
         .expect("failed to get metadata for root dir");
 
-    let mut server = Server::new(&*test_dir, Default::default(), Default::default())
+    let server = Server::new(&*test_dir, Default::default(), Default::default())
         .expect("Failed to create server");
 
     let tversion = Tversion {
@@ -526,7 +540,7 @@ fn invalid_joins() {
 
 #[test]
 fn clunk() {
-    let (_test_dir, mut server) = setup("clunk");
+    let (_test_dir, server) = setup("clunk");
 
     let tclunk = Tclunk { fid: ROOT_FID };
     server.clunk(&tclunk).expect("failed to clunk root fid");
@@ -543,6 +557,15 @@ fn get_attr() {
     check_attr(&mut server, ROOT_FID, &md);
 }
 
+#[test]
+fn qid_versions() {
+    // Changes within the same second change the version, as do changes a second apart.
+    let version = qid_version(1_700_000_000, 5);
+    assert_ne!(qid_version(1_700_000_000, 6), version);
+    assert_ne!(qid_version(1_700_000_001, 5), version);
+    assert_eq!(qid_version(1_700_000_000, 5), version);
+}
+
 #[test]
 fn tree_walk() {
     let (test_dir, mut server) = setup("readdir");
@@ -596,7 +619,7 @@ fn tree_walk() {
             };
 
             assert_eq!(dirent.ty, ty);
-            check_qid(&dirent.qid, &md);
+            check_dirent_qid(&dirent.qid, &md);
         }
 
         let tclunk = Tclunk { fid };
@@ -808,7 +831,7 @@ fn huge_directory() {
         let path = newdir.join(&f.name);
 
         let md = fs::symlink_metadata(path).expect("failed to get metadata for path");
-        check_qid(&f.qid, &md);
+        check_dirent_qid(&f.qid, &md);
 
         if f.name == "." || f.name == ".." {
             assert_eq!(f.ty, libc::DT_DIR);
@@ -823,7 +846,7 @@ fn huge_directory() {
 
 #[test]
 fn mkdir() {
-    let (test_dir, mut server) = setup("mkdir");
+    let (test_dir, server) = setup("mkdir");
 
     let name = "conan";
     let tmkdir = Tmkdir {
@@ -906,7 +929,7 @@ fn unlink_all() {
 
 #[test]
 fn rename_at() {
-    let (test_dir, mut server) = setup("rename");
+    let (test_dir, server) = setup("rename");
 
     let name = "oldfile";
     let content = create_local_file(&test_dir, name);
@@ -985,7 +1008,7 @@ fn setup_simple_lock(flags: u32) -> Server {
 
 #[test]
 fn lock_rdlck_no_open_file() {
-    let mut server = setup_simple_lock_no_open();
+    let server = setup_simple_lock_no_open();
 
     let tlock = setlk_tlock(ROOT_FID + 1, 8, 0, libc::F_RDLCK);
 
@@ -994,7 +1017,7 @@ fn lock_rdlck_no_open_file() {
 
 #[test]
 fn lock_rdlck() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, 8, 0, libc::F_RDLCK);
 
@@ -1002,7 +1025,7 @@ fn lock_rdlck() {
 }
 #[test]
 fn lock_wrlck_no_open_file() {
-    let mut server = setup_simple_lock_no_open();
+    let server = setup_simple_lock_no_open();
 
     let tlock = setlk_tlock(ROOT_FID + 1, 8, 0, libc::F_WRLCK);
 
@@ -1010,7 +1033,7 @@ fn lock_wrlck_no_open_file() {
 }
 #[test]
 fn lock_wrlck() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, 8, 0, libc::F_WRLCK);
 
@@ -1019,7 +1042,7 @@ fn lock_wrlck() {
 
 #[test]
 fn lock_unlck_no_lock() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, 0, 0, libc::F_UNLCK);
 
@@ -1028,7 +1051,7 @@ fn lock_unlck_no_lock() {
 
 #[test]
 fn lock_unlck() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, LOCAL_FILE_LEN / 2, 0, libc::F_RDLCK);
 
@@ -1041,7 +1064,7 @@ fn lock_unlck() {
 
 #[test]
 fn lock_unlck_relock() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, LOCAL_FILE_LEN / 2, 0, libc::F_RDLCK);
 
@@ -1058,7 +1081,7 @@ fn lock_unlck_relock() {
 
 #[test]
 fn getlock_rdlck_nolock() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tgetlock = getlk_tgetlock(ROOT_FID + 1, libc::F_RDLCK);
 
@@ -1069,7 +1092,7 @@ fn getlock_rdlck_nolock() {
 
 #[test]
 fn getlock_wrlck() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, LOCAL_FILE_LEN / 2, 0, libc::F_WRLCK);
 
@@ -1084,7 +1107,7 @@ fn getlock_wrlck() {
 
 #[test]
 fn getlock_rdlck() {
-    let mut server = setup_simple_lock(P9_RDWR);
+    let server = setup_simple_lock(P9_RDWR);
 
     let tlock = setlk_tlock(ROOT_FID + 1, LOCAL_FILE_LEN / 2, 0, libc::F_RDLCK);
 
@@ -1349,3 +1372,316 @@ fn readlink() {
 
     assert_eq!(rreadlink.target, "target/of/symlink");
 }
+
+#[test]
+fn msize_config() {
+    let cfg: Config = "msize=1048600".parse().expect("failed to parse msize");
+    assert_eq!(cfg.msize, 1048600);
+    assert!("msize=100".parse::<Config>().is_err());
+    assert!("msize=lots".parse::<Config>().is_err());
+
+    let mut cfg = Config::default();
+    cfg.msize = MAX_MESSAGE_SIZE + 1;
+    assert!(Server::with_config(cfg).is_err());
+}
+
+#[test]
+fn msize_negotiation() {
+    let server = Server::with_config(Config {
+        msize: 1024 * 1024 + 24,
+        ..Default::default()
+    })
+    .expect("Failed to create server");
+
+    // The client gets the largest message size both sides support.
+    let rversion = server
+        .version(&Tversion {
+            msize: 512 * 1024,
+            version: String::from("9P2000.L"),
+        })
+        .expect("failed to get version from server");
+    assert_eq!(rversion.msize, 512 * 1024);
+
+    let server = Server::with_config(Config {
+        msize: 1024 * 1024 + 24,
+        ..Default::default()
+    })
+    .expect("Failed to create server");
+    let rversion = server
+        .version(&Tversion {
+            msize: 8 * 1024 * 1024,
+            version: String::from("9P2000.L"),
+        })
+        .expect("failed to get version from server");
+    assert_eq!(rversion.msize, 1024 * 1024 + 24);
+}
+
+#[test]
+fn serve_concurrently() {
+    let (test_dir, server) = setup("serve_concurrently");
+    let names = ["one", "two", "three", "four"];
+    let contents: Vec<Vec<u8>> = names
+        .iter()
+        .map(|name| create_local_file(&test_dir, name))
+        .collect();
+
+    // Pipeline a walk, open, read and clunk for every file without waiting for responses, as the
+    // kernel does.  Each sequence only works if the requests on its fid run in order.
+    let mut requests = Vec::new();
+    let mut tag = 0;
+    let mut frame = |msg: Tmessage| {
+        tag += 1;
+        Tframe { tag, msg: Ok(msg) }
+            .encode(&mut requests)
+            .expect("failed to encode request");
+        tag
+    };
+    let mut reads = BTreeMap::new();
+    for (i, name) in names.iter().enumerate() {
+        let fid = ROOT_FID + 1 + i as u32;
+        frame(Tmessage::Walk(Twalk {
+            fid: ROOT_FID,
+            newfid: fid,
+            wnames: vec![String::from(*name)],
+        }));
+        frame(Tmessage::Lopen(Tlopen {
+            fid,
+            flags: P9_RDONLY,
+        }));
+        let read = frame(Tmessage::Read(Tread {
+            fid,
+            offset: 0,
+            count: DEFAULT_BUFFER_SIZE,
+        }));
+        reads.insert(read, i);
+        frame(Tmessage::Clunk(Tclunk { fid }));
+    }
+    let flush = frame(Tmessage::Flush(Tflush { oldtag: 1 }));
+
+    let mut responses = Vec::new();
+    server
+        .serve(Cursor::new(requests), &mut responses, 4)
+        .expect("failed to serve requests");
+
+    let mut reader = Cursor::new(responses);
+    let mut answered = BTreeMap::new();
+    while (reader.position() as usize) < reader.get_ref().len() {
+        let rframe: Rframe = WireFormat::decode(&mut reader).expect("failed to decode response");
+        if let Rmessage::Lerror(ref lerror) = rframe.msg {
+            panic!("request {} failed: {}", rframe.tag, lerror.ecode);
+        }
+        if let Some(&i) = reads.get(&rframe.tag) {
+            match rframe.msg {
+                Rmessage::Read(ref rread) => assert_eq!(&*rread.data, &contents[i][..]),
+                ref msg => panic!("unexpected response to read: {:?}", msg),
+            }
+        }
+        answered.insert(rframe.tag, answered.len());
+    }
+
+    assert_eq!(answered.len() as u16, tag);
+    // The flush must be answered after every request before it.
+    assert_eq!(answered[&flush], answered.len() - 1);
+    // Only the root fid is left.
+    assert_eq!(server.fids().keys().collect::<Vec<_>>(), vec![&ROOT_FID]);
+}
+
+#[test]
+fn metadata_cache() {
+    let (test_dir, _) = setup("metadata_cache");
+    let mut server = Server::with_config(Config {
+        root: Path::new(&*test_dir).into(),
+        metadata_cache: 64,
+        ..Default::default()
+    })
+    .expect("Failed to create server");
+    let tattach = Tattach {
+        fid: ROOT_FID,
+        afid: P9_NOFID,
+        uname: String::from("unittest"),
+        aname: String::from(""),
+        n_uname: 1000,
+    };
+    server.attach(&tattach).expect("failed to attach to server");
+
+    let path = test_dir.join("subdir").join("b");
+    let wnames = vec![String::from("subdir"), String::from("b")];
+    let fid = ROOT_FID + 1;
+    walk(&mut server, &*test_dir, ROOT_FID, fid, wnames.clone());
+    check_attr(&mut server, fid, &path.symlink_metadata().unwrap());
+
+    // Changes made behind the server's back are seen.
+    fs::OpenOptions::new()
+        .append(true)
+        .open(&path)
+        .and_then(|mut f| f.write_all(b" and goodbye"))
+        .expect("failed to append to file");
+    check_attr(&mut server, fid, &path.symlink_metadata().unwrap());
+
+    let other = test_dir.join("subdir").join("c");
+    fs::write(&other, b"replacement").expect("failed to write file");
+    fs::rename(&other, &path).expect("failed to rename file");
+    let newfid = fid + 1;
+    walk(&mut server, &*test_dir, ROOT_FID, newfid, wnames.clone());
+    check_attr(&mut server, newfid, &path.symlink_metadata().unwrap());
+
+    // And so are the server's own.
+    let tsetattr = Tsetattr {
+        fid: newfid,
+        valid: P9_SETATTR_SIZE,
+        mode: 0,
+        uid: 0,
+        gid: 0,
+        size: 3,
+        atime_sec: 0,
+        atime_nsec: 0,
+        mtime_sec: 0,
+        mtime_nsec: 0,
+    };
+    server.set_attr(&tsetattr).expect("failed to set size");
+    check_attr(&mut server, newfid, &path.symlink_metadata().unwrap());
+    walk(&mut server, &*test_dir, ROOT_FID, newfid + 1, wnames);
+}
+
+#[test]
+fn splice_reads() {
+    let (test_dir, _) = setup("splice_reads");
+    let mut server = Server::with_config(Config {
+        root: Path::new(&*test_dir).into(),
+        splice_reads: true,
+        ..Default::default()
+    })
+    .expect("Failed to create server");
+    let tattach = Tattach {
+        fid: ROOT_FID,
+        afid: P9_NOFID,
+        uname: String::from("unittest"),
+        aname: String::from(""),
+        n_uname: 1000,
+    };
+    server.attach(&tattach).expect("failed to attach to server");
+
+    let content: Vec<u8> = (0..200_000u32).map(|i| (i % 251) as u8).collect();
+    fs::write(test_dir.join("big"), &content).expect("failed to create file");
+    let fid = ROOT_FID + 1;
+    open(&mut server, &*test_dir, ROOT_FID, "big", fid, P9_RDONLY).expect("failed to open file");
+
+    // Reads that start at and off page boundaries, that end past the end of the file, and that
+    // start there.
+    let offsets = [0, 1, 4095, 65536 * 2 + 3, 199_990, 200_000, 300_000];
+    let mut requests = Vec::new();
+    for (tag, &offset) in offsets.iter().enumerate() {
+        Tframe {
+            tag: tag as u16,
+            msg: Ok(Tmessage::Read(Tread {
+                fid,
+                offset,
+                count: 65536,
+            })),
+        }
+        .encode(&mut requests)
+        .expect("failed to encode request");
+    }
+    let capacity = server.read_capacity(65536);
+    let check = |responses: Vec<u8>| {
+        let mut reader = Cursor::new(responses);
+        let mut answered = 0;
+        while (reader.position() as usize) < reader.get_ref().len() {
+            let rframe: Rframe =
+                WireFormat::decode(&mut reader).expect("failed to decode response");
+            let offset = min(offsets[rframe.tag as usize] as usize, content.len());
+            let expected = &content[offset..min(offset + capacity, content.len())];
+            match rframe.msg {
+                Rmessage::Read(ref rread) => assert_eq!(&*rread.data, expected),
+                ref msg => panic!("unexpected response to read: {:?}", msg),
+            }
+            answered += 1;
+        }
+        assert_eq!(answered, offsets.len());
+    };
+
+    // Responses written to a pipe are spliced, one at a time or concurrently.
+    let through_pipe = |serve: &dyn Fn(&mut File)| {
+        let mut fds = [0; 2];
+        // Safe because this only writes two fds to `fds`, and we check the return value.
+        assert_eq!(unsafe { libc::pipe2(fds.as_mut_ptr(), libc::O_CLOEXEC) }, 0);
+        // Safe because we just opened these fds and nothing else owns them.
+        let (mut reader, mut writer) =
+            unsafe { (File::from_raw_fd(fds[0]), File::from_raw_fd(fds[1])) };
+        let responses = std::thread::spawn(move || {
+            let mut responses = Vec::new();
+            reader
+                .read_to_end(&mut responses)
+                .expect("failed to read responses");
+            responses
+        });
+        serve(&mut writer);
+        drop(writer);
+        responses.join().expect("failed to read responses")
+    };
+    check(through_pipe(&|writer| {
+        let mut reader = Cursor::new(&requests[..]);
+        for _ in &offsets {
+            server
+                .handle_message(&mut reader, writer)
+                .expect("failed to handle request");
+        }
+    }));
+    check(through_pipe(&|writer| {
+        server
+            .serve(Cursor::new(&requests[..]), writer, 4)
+            .expect("failed to serve requests");
+    }));
+
+    // Spliced data is copied to outputs that are not pipes.
+    let mut responses = Vec::new();
+    let mut reader = Cursor::new(&requests[..]);
+    let mut scratch = Vec::new();
+    for _ in &offsets {
+        let tframe = WireFormat::decode(&mut reader).expect("failed to decode request");
+        let response = server.respond(tframe, true);
+        server
+            .send(response, &mut responses, &mut scratch)
+            .expect("failed to send response");
+    }
+    check(responses);
+}
+
+#[test]
+fn attach_roots() {
+    let (test_dir, _) = setup("attach_roots");
+    let mut server = Server::new(&*test_dir, Default::default(), Default::default())
+        .expect("Failed to create server");
+    let subdir = test_dir.join("subdir");
+    server.set_roots(Box::new(move |aname| match aname {
+        "subdir" => Ok(subdir.clone()),
+        _ => Err(io::Error::from_raw_os_error(libc::EACCES)),
+    }));
+
+    let mut tattach = Tattach {
+        fid: ROOT_FID,
+        afid: P9_NOFID,
+        uname: String::from("unittest"),
+        aname: String::from("subdir"),
+        n_uname: 1000,
+    };
+    let rattach = server.attach(&tattach).expect("failed to attach to server");
+    check_qid(
+        &rattach.qid,
+        &test_dir.join("subdir").symlink_metadata().unwrap(),
+    );
+    walk(
+        &mut server,
+        test_dir.join("subdir"),
+        ROOT_FID,
+        ROOT_FID + 1,
+        vec![String::from("b")],
+    );
+
+    tattach.fid = ROOT_FID + 2;
+    tattach.aname = String::from("");
+    let err = server
+        .attach(&tattach)
+        .expect_err("attached to a refused aname");
+    assert_eq!(err.raw_os_error(), Some(libc::EACCES));
+}
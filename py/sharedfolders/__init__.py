@@ -1,16 +1,26 @@
 #!/usr/bin/python3
 
-import collections
-import glob
-import hashlib
-from json import JSONEncoder
-import json
 import logging
 import os
 import re
-import subprocess
 import sys
-from typing import Optional, Tuple, Dict, Type, Any, List
+import time
+from typing import (
+    Optional,
+    Tuple,
+    Dict,
+    Type,
+    Any,
+    Iterable,
+    List,
+    Set,
+    TYPE_CHECKING,
+)
+
+# The modules below are imported where they are used instead, to keep the
+# startup of the qrexec services that import this package fast.
+if TYPE_CHECKING:
+    import sqlite3
 
 
 PATH_MAX = 4096
@@ -19,18 +29,75 @@ VM_REGEX = "^[a-zA-Z][a-zA-Z0-9_-]*$"
 CONNECT_RPCNAME = "ruddo.ConnectToFolder"
 
 
+def _stat_key(st: os.stat_result) -> Tuple[int, int, int]:
+    """Identify a version of a file that is replaced by rename on update."""
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class VMInventory(object):
+    """The names of the qubes in the system, queried once and then cached.
+
+    The cached names are reused for as long as the Qubes database file is
+    unchanged, or for TTL seconds if it cannot be examined.
+    """
+
+    QUBES_XML = "/var/lib/qubes/qubes.xml"
+    TTL = 10.0
+
+    def __init__(self) -> None:
+        self._names: Optional[List[str]] = None
+        self._name_set: Set[str] = set()
+        self._generation: Any = None
+        self._fetched = 0.0
+
+    def _current_generation(self) -> Any:
+        try:
+            return _stat_key(os.stat(self.QUBES_XML))
+        except OSError:
+            return None
+
+    def query(self) -> List[str]:
+        import subprocess
+
+        try:
+            vm_list = subprocess.check_output(
+                ["qvm-ls", "--raw-list"], universal_newlines=True
+            ).splitlines()
+        except FileNotFoundError:
+            return ["demovm", "work", "stuff", "social", "sys-usb"]
+        if "dom0" in vm_list:
+            vm_list.remove("dom0")
+        if "" in vm_list:
+            vm_list.remove("")
+        return vm_list
+
+    def invalidate(self) -> None:
+        self._names = None
+
+    def names(self) -> List[str]:
+        generation = self._current_generation()
+        now = time.monotonic()
+        if (
+            self._names is None
+            or generation != self._generation
+            or (generation is None and now - self._fetched > self.TTL)
+        ):
+            self._names = self.query()
+            self._name_set = set(self._names)
+            self._generation = generation
+            self._fetched = now
+        return list(self._names)
+
+    def __contains__(self, vm: str) -> bool:
+        self.names()
+        return vm in self._name_set
+
+
+vm_inventory = VMInventory()
+
+
 def get_vm_list() -> List[str]:
-    try:
-        vm_list = subprocess.check_output(
-            ["qvm-ls", "--raw-list"], universal_newlines=True
-        ).splitlines()
-    except FileNotFoundError:
-        return ["demovm", "work", "stuff", "social", "sys-usb"]
-    if "dom0" in vm_list:
-        vm_list.remove("dom0")
-    if "" in vm_list:
-        vm_list.remove("")
-    return vm_list
+    return vm_inventory.names()
 
 
 def is_disp(vm: str) -> bool:
@@ -42,8 +109,7 @@ def valid_vm_name(target: str) -> bool:
         raise ValueError(target)
     if re.match(VM_REGEX, target) is None:
         raise ValueError(target)
-    vm_list = get_vm_list()
-    return target in vm_list
+    return target in vm_inventory
 
 
 def valid_path(folder: str) -> bool:
@@ -51,6 +117,8 @@ def valid_path(folder: str) -> bool:
 
 
 class Response(object):
+    __slots__ = ("name",)
+
     def __init__(self, name: str) -> None:
         self.name = name
 
@@ -107,6 +175,8 @@ def contains(needle: str, haystack: str) -> bool:
 
 
 def fingerprint_decision(source: str, target: str, folder: str) -> str:
+    import hashlib
+
     fingerprint = hashlib.sha256()
     fingerprint.update(source.encode("utf-8"))
     fingerprint.update(b"\0")
@@ -118,18 +188,47 @@ def fingerprint_decision(source: str, target: str, folder: str) -> str:
 
 
 class Decision(object):
-    source = ""
-    target = ""
-    folder = ""
-    response = Response("invalid")
+    """An immutable decision on access from the source qube to a folder
+    in the target qube.
+
+    Policy databases hold many decisions over few qubes and folders, so
+    decisions have no instance dictionary, and their names are interned.
+    """
+
+    __slots__ = ("source", "target", "folder", "response")
+
+    source: str
+    target: str
+    folder: str
+    response: Response
 
     def __init__(
         self, source: str, target: str, folder: str, response: Response
     ) -> None:
-        self.source = source
-        self.target = target
-        self.folder = folder
-        self.response = response
+        setattr = object.__setattr__
+        setattr(self, "source", sys.intern(source))
+        setattr(self, "target", sys.intern(target))
+        setattr(self, "folder", sys.intern(folder))
+        setattr(self, "response", response)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("Decision objects are immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("Decision objects are immutable")
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Decision):
+            return NotImplemented
+        return (
+            self.source == other.source
+            and self.target == other.target
+            and self.folder == other.folder
+            and self.response is other.response
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.source, self.target, self.folder, self.response.name))
 
     def __repr__(self) -> str:
         return "<Decision %r -> %r: %r = %s>" % (
@@ -140,11 +239,115 @@ class Decision(object):
         )
 
 
-class DecisionMatrix(Dict[str, Decision]):
-    POLICY_DB = "/etc/qubes/shared-folders/policy.db"
+def path_components(folder: str) -> List[str]:
+    """Split a folder into its components, as contains() would compare them."""
+    return [c for c in os.path.abspath(folder).split(os.path.sep) if c]
+
+
+class _PathTrie(object):
+    """Path-component trie holding the decisions for a source/target pair.
+
+    Each node keeps the decisions made on the folder it represents, so
+    the decisions on a folder and all its parents can be found by walking
+    down the trie, without looking at decisions made on unrelated folders.
+    """
+
+    __slots__ = ("children", "decisions")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _PathTrie] = {}
+        self.decisions: Dict[str, Decision] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.children or self.decisions)
+
+    def copy(self) -> "_PathTrie":
+        new = _PathTrie()
+        new.decisions = self.decisions.copy()
+        new.children = dict((c, t.copy()) for c, t in self.children.items())
+        return new
+
+    def insert(self, fingerprint: str, decision: Decision) -> None:
+        node = self
+        for component in path_components(decision.folder):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _PathTrie()
+            node = child
+        node.decisions[fingerprint] = decision
+
+    def remove(self, fingerprint: str, decision: Decision) -> None:
+        path = [self]
+        for component in path_components(decision.folder):
+            child = path[-1].children.get(component)
+            if child is None:
+                return
+            path.append(child)
+        path[-1].decisions.pop(fingerprint, None)
+        # Prune the nodes left empty, from the deepest one upwards.
+        components = path_components(decision.folder)
+        while len(path) > 1 and not path[-1]:
+            path.pop()
+            del path[-1].children[components[len(path) - 1]]
+
+    def containing(self, folder: str) -> List[Tuple[str, Decision]]:
+        """Return the decisions made on the folder or any of its parents."""
+        node: Optional[_PathTrie] = self
+        matches: List[Tuple[str, Decision]] = []
+        for component in path_components(folder):
+            assert node is not None
+            matches.extend(node.decisions.items())
+            node = node.children.get(component)
+            if node is None:
+                return matches
+        assert node is not None
+        matches.extend(node.decisions.items())
+        return matches
+
+
+class _PolicyStore(object):
+    """Persistent storage for the decisions of a DecisionMatrix.
+
+    A store is created with the path of the policy database configured
+    in DecisionMatrix.POLICY_DB, and decides where and how to keep the
+    decisions based on it.
+    """
+
+    def __init__(self, policy_db: str) -> None:
+        self.path = policy_db
+
+    def version(self) -> Any:
+        """Return a token that changes whenever the stored decisions change."""
+        raise NotImplementedError
+
+    def load(self) -> Iterable[Tuple[str, Decision]]:
+        """Return the stored (fingerprint, decision) pairs."""
+        raise NotImplementedError
+
+    def save(
+        self, decisions: Dict[str, Decision], changed: Optional[Set[str]], since: Any
+    ) -> Any:
+        """Store the decisions.
+
+        If changed is not None, only the decisions with those fingerprints
+        have changed since the decisions were loaded at version since,
+        and the rest of the stored decisions may be left alone.
+
+        Return the version of the stored decisions if they are now the same
+        as the decisions passed, or None if that cannot be told.
+        """
+        raise NotImplementedError
+
+
+class _JSONPolicyStore(_PolicyStore):
+    """Keeps all decisions in a JSON document, rewritten on every save."""
+
+    def version(self) -> Any:
+        return _stat_key(os.stat(self.path))
+
+    def load(self) -> Iterable[Tuple[str, Decision]]:
+        import json
 
-    @classmethod
-    def load(klass):  # type: (Type[DecisionMatrix]) -> DecisionMatrix
         def hook(obj: Dict[Any, Any]) -> Any:
             if "folder" in obj:
                 return Decision(
@@ -154,17 +357,354 @@ class DecisionMatrix(Dict[str, Decision]):
                     response=Response.from_string(obj["response"]),
                 )
             else:
-                return DecisionMatrix(obj)
+                return obj
+
+        with open(self.path, "r") as db:
+            data = json.load(db, object_hook=hook)
+        assert isinstance(data, dict)
+        return data.items()
+
+    def save(
+        self, decisions: Dict[str, Decision], changed: Optional[Set[str]], since: Any
+    ) -> Any:
+        import json
+        from json import JSONEncoder
+
+        if changed is not None:
+            # Only the changed decisions are written over those stored.
+            try:
+                stored = dict(self.load())
+            except FileNotFoundError:
+                stored = {}
+            merged = stored.copy()
+            for fingerprint in changed:
+                if fingerprint in decisions:
+                    merged[fingerprint] = decisions[fingerprint]
+                else:
+                    merged.pop(fingerprint, None)
+            same = merged == dict(decisions)
+            decisions = merged
 
+        class DecisionMatrixEncoder(JSONEncoder):
+            def default(self, obj: Any) -> Any:
+                if isinstance(obj, Decision):
+                    return {
+                        "source": obj.source,
+                        "target": obj.target,
+                        "folder": obj.folder,
+                        "response": obj.response,
+                    }
+                if isinstance(obj, Response):
+                    return str(obj)
+                return JSONEncoder.default(self, obj)
+
+        with open(self.path + ".tmp", "w") as db:
+            json.dump(
+                decisions, db, indent=4, sort_keys=True, cls=DecisionMatrixEncoder
+            )
+        os.chmod(self.path + ".tmp", 0o664)
+        os.rename(self.path + ".tmp", self.path)
+        if changed is not None and not same:
+            return None
+        return self.version()
+
+
+class _SQLitePolicyStore(_PolicyStore):
+    """Keeps decisions in an SQLite database, one row per decision.
+
+    Saves only write the rows of the decisions that changed.  The database
+    lives next to the configured JSON policy database, and is populated
+    from it once, which the database records along with the decisions
+    migrated.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS decisions (
+            fingerprint TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            response TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS generation (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0);
+        CREATE TABLE IF NOT EXISTS migrated (
+            id INTEGER PRIMARY KEY CHECK (id = 0)
+        );
+    """
+
+    def __init__(self, policy_db: str) -> None:
+        self.legacy_path = policy_db
+        super().__init__(os.path.splitext(policy_db)[0] + ".sqlite")
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        exists = os.path.exists(self.path)
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not exists:
+            os.chmod(self.path, 0o664)
+        # The schema is created, and the decisions migrated, until the
+        # database records the migration.  Databases left incomplete by a
+        # crash or a failed migration are thus completed later.
         try:
-            with open(klass.POLICY_DB, "r") as db:
-                data = json.load(db, object_hook=hook)
-            self = klass()
-            for k, v in data.items():
-                self[k] = v
-            return self
-        except Exception:
-            return klass()
+            migrated = db.execute("SELECT id FROM migrated").fetchone() is not None
+        except sqlite3.OperationalError:
+            migrated = False
+        if not migrated:
+            db.executescript(self.SCHEMA)
+            self._migrate(db)
+        return db
+
+    def _migrate(self, db: "sqlite3.Connection") -> None:
+        with _Transaction(db):
+            if db.execute("SELECT id FROM migrated").fetchone() is not None:
+                # Another process migrated the decisions concurrently.
+                return
+            try:
+                with open(self.legacy_path) as f:
+                    empty = not f.read().strip()
+                decisions = (
+                    {} if empty else dict(_JSONPolicyStore(self.legacy_path).load())
+                )
+            except FileNotFoundError:
+                decisions = {}
+            except Exception as e:
+                # Tried again the next time the database is used.
+                logger.error(
+                    "Cannot migrate decisions from %s: %s", self.legacy_path, e
+                )
+                return
+            if decisions:
+                logger.info(
+                    "Migrating %d decisions from %s to %s",
+                    len(decisions),
+                    self.legacy_path,
+                    self.path,
+                )
+                self._write(db, decisions, set(decisions))
+            db.execute("INSERT INTO migrated (id) VALUES (0)")
+        if decisions:
+            try:
+                os.rename(self.legacy_path, self.legacy_path + ".migrated")
+            except FileNotFoundError:
+                pass
+
+    def _generation(self, db: "sqlite3.Connection") -> Tuple[int, int]:
+        # The inode tells apart databases recreated from scratch.
+        row = db.execute("SELECT value FROM generation WHERE id = 0").fetchone()
+        return (os.stat(self.path).st_ino, int(row[0]))
+
+    def _write(
+        self,
+        db: "sqlite3.Connection",
+        decisions: Dict[str, Decision],
+        changed: Optional[Set[str]],
+    ) -> None:
+        if changed is None:
+            db.execute("DELETE FROM decisions")
+            changed = set(decisions)
+        upserts = [
+            (
+                fingerprint,
+                decisions[fingerprint].source,
+                decisions[fingerprint].target,
+                decisions[fingerprint].folder,
+                str(decisions[fingerprint].response),
+            )
+            for fingerprint in changed
+            if fingerprint in decisions
+        ]
+        deletes = [(fp,) for fp in changed if fp not in decisions]
+        db.executemany(
+            "INSERT OR REPLACE INTO decisions"
+            " (fingerprint, source, target, folder, response)"
+            " VALUES (?, ?, ?, ?, ?)",
+            upserts,
+        )
+        db.executemany("DELETE FROM decisions WHERE fingerprint = ?", deletes)
+        db.execute("UPDATE generation SET value = value + 1 WHERE id = 0")
+
+    def version(self) -> Any:
+        db = self._connect()
+        try:
+            return self._generation(db)
+        finally:
+            db.close()
+
+    def load(self) -> Iterable[Tuple[str, Decision]]:
+        db = self._connect()
+        try:
+            rows = db.execute(
+                "SELECT fingerprint, source, target, folder, response FROM decisions"
+            )
+            for fingerprint, source, target, folder, response in rows:
+                yield fingerprint, Decision(
+                    source, target, folder, Response.from_string(response)
+                )
+        finally:
+            db.close()
+
+    def save(
+        self, decisions: Dict[str, Decision], changed: Optional[Set[str]], since: Any
+    ) -> Any:
+        db = self._connect()
+        try:
+            with _Transaction(db):
+                previous = self._generation(db)
+                self._write(db, decisions, changed)
+                current = self._generation(db)
+        finally:
+            db.close()
+        # If somebody else wrote to the database after the decisions were
+        # loaded, the database now holds more than what was passed here.
+        if changed is None or previous == since:
+            return current
+        return None
+
+
+class _Transaction(object):
+    def __init__(self, db: "sqlite3.Connection") -> None:
+        self.db = db
+
+    def __enter__(self) -> None:
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type: Any, *unused_args: Any) -> None:
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+class DecisionMatrix(Dict[str, Decision]):
+    """A table of decisions, keyed by fingerprint.
+
+    The matrix maintains a secondary index of its decisions, keyed by
+    source and target qube, so lookups do not need to scan every decision.
+    Every mutation of the matrix must therefore go through the dict
+    methods overridden here.  Matrices loaded from disk also remember
+    which decisions changed since, so saving them only writes those.
+    """
+
+    POLICY_DB = "/etc/qubes/shared-folders/policy.db"
+    STORE: Type[_PolicyStore] = _SQLitePolicyStore
+
+    # Last matrix loaded from or saved to disk, along with the path and the
+    # version of the store it came from.  load() hands out copies of it for
+    # as long as the store remains at the same version.
+    _cache: Optional[Tuple[str, Any, "DecisionMatrix"]] = None
+
+    def __init__(self, *args: Any, **kwargs: Decision) -> None:
+        super().__init__()
+        self._index: Dict[Tuple[str, str], _PathTrie] = {}
+        # Copies of a matrix share the tries in their indexes, and copy a
+        # trie before changing it, unless its key is listed here.
+        self._owned: Set[Tuple[str, str]] = set()
+        # Fingerprints changed since the matrix was loaded from the store
+        # at the path and version in _origin, or None if the matrix did not
+        # come from a store.
+        self._changed: Optional[Set[str]] = None
+        self._origin: Optional[Tuple[str, Any]] = None
+        self.update(*args, **kwargs)
+
+    def _loaded_at(self, path: str, version: Any) -> "DecisionMatrix":
+        self._changed = set()
+        self._origin = (path, version)
+        return self
+
+    def _writable_trie(self, key: Tuple[str, str]) -> _PathTrie:
+        trie = self._index.get(key)
+        if trie is None:
+            trie = self._index[key] = _PathTrie()
+        elif key not in self._owned:
+            trie = self._index[key] = trie.copy()
+        self._owned.add(key)
+        return trie
+
+    def _index_decision(self, fingerprint: str, decision: Decision) -> None:
+        key = (decision.source, decision.target)
+        self._writable_trie(key).insert(fingerprint, decision)
+
+    def _unindex_decision(self, fingerprint: str, decision: Decision) -> None:
+        key = (decision.source, decision.target)
+        if key not in self._index:
+            return
+        trie = self._writable_trie(key)
+        trie.remove(fingerprint, decision)
+        if not trie:
+            del self._index[key]
+            self._owned.discard(key)
+
+    def __setitem__(self, fingerprint: str, decision: Decision) -> None:
+        if fingerprint in self:
+            self._unindex_decision(fingerprint, self[fingerprint])
+        super().__setitem__(fingerprint, decision)
+        self._index_decision(fingerprint, decision)
+        if self._changed is not None:
+            self._changed.add(fingerprint)
+
+    def __delitem__(self, fingerprint: str) -> None:
+        self._unindex_decision(fingerprint, self[fingerprint])
+        super().__delitem__(fingerprint)
+        if self._changed is not None:
+            self._changed.add(fingerprint)
+
+    def update(self, *args: Any, **kwargs: Decision) -> None:
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 argument, got %d" % len(args))
+        for other in list(args) + [kwargs]:
+            # Iterate over other as dict.update() would, without making
+            # a dictionary out of it first.
+            if hasattr(other, "keys"):
+                for fingerprint in other.keys():
+                    self[fingerprint] = other[fingerprint]
+            else:
+                for fingerprint, decision in other:
+                    self[fingerprint] = decision
+
+    def setdefault(self, fingerprint: str, decision: Decision) -> Decision:
+        if fingerprint not in self:
+            self[fingerprint] = decision
+        return self[fingerprint]
+
+    def pop(self, fingerprint: str, *default: Any) -> Any:
+        if fingerprint not in self and default:
+            return default[0]
+        decision = self[fingerprint]
+        del self[fingerprint]
+        return decision
+
+    def popitem(self) -> Tuple[str, Decision]:
+        fingerprint, decision = super().popitem()
+        self._unindex_decision(fingerprint, decision)
+        if self._changed is not None:
+            self._changed.add(fingerprint)
+        return fingerprint, decision
+
+    def clear(self) -> None:
+        if self._changed is not None:
+            self._changed.update(self)
+        super().clear()
+        self._index.clear()
+        self._owned.clear()
+
+    @classmethod
+    def load(klass):  # type: (Type[DecisionMatrix]) -> DecisionMatrix
+        store = klass.STORE(klass.POLICY_DB)
+        try:
+            version = store.version()
+            cached = klass._cache
+            if cached and cached[0] == store.path and cached[1] == version:
+                return cached[2].copy()._loaded_at(store.path, version)
+            self = klass(store.load())._loaded_at(store.path, version)
+        except Exception as e:
+            # Saving what could not be loaded must not replace the stored
+            # decisions, so the matrix only saves the changes made to it.
+            logger.error("Cannot load decisions from %s: %s", store.path, e)
+            return klass()._loaded_at(store.path, None)
+        klass._cache = (store.path, version, self.copy())
+        return self
 
     def check_decision(
         self, source: str, target: str, folder: str, response: Optional[Response]
@@ -201,28 +741,28 @@ class DecisionMatrix(Dict[str, Decision]):
         return fingerprint
 
     def save(self) -> None:
-        class DecisionMatrixEncoder(JSONEncoder):
-            def default(self, obj: Any) -> Any:
-                if isinstance(obj, Decision):
-                    return obj.__dict__
-                if isinstance(obj, Response):
-                    return str(obj)
-                return JSONEncoder.default(self, obj)
-
-        with open(self.POLICY_DB + ".tmp", "w") as db:
-            json.dump(self, db, indent=4, sort_keys=True, cls=DecisionMatrixEncoder)
-        os.chmod(self.POLICY_DB + ".tmp", 0o664)
-        os.rename(self.POLICY_DB + ".tmp", self.POLICY_DB)
+        store = self.STORE(self.POLICY_DB)
+        if self._origin is not None and self._origin[0] == store.path:
+            version = store.save(self, self._changed, self._origin[1])
+        else:
+            version = store.save(self, None, None)
+        # Whatever was written, later saves only need to write later changes.
+        self._loaded_at(store.path, version)
+        if version is None:
+            self.__class__._cache = None
+        else:
+            self.__class__._cache = (store.path, version, self.copy())
 
     def copy(self):  # type: () -> DecisionMatrix
-        newd = DecisionMatrix()
-        for k, v in self.items():
-            newd[k] = Decision(
-                v.source,
-                v.target,
-                v.folder,
-                v.response,
-            )
+        # Decisions are immutable, so the copy can share them.  Both matrices
+        # share the tries of the index too, until either changes one.
+        newd = self.__class__()
+        dict.update(newd, self)
+        newd._index = self._index.copy()
+        self._owned = set()
+        if self._changed is not None:
+            newd._changed = set(self._changed)
+        newd._origin = self._origin
         return newd
 
     def revoke_onetime_accesses_for_fingerprint(self, fingerprint: str) -> None:
@@ -232,7 +772,7 @@ class DecisionMatrix(Dict[str, Decision]):
                 "One-time decision expired for %s, applying policy changes", fingerprint
             )
             del self[fingerprint]
-            ConnectToFolderPolicy.apply_policy_changes_from(self)
+            connect_to_folder_policy().apply_policy_changes_from(self)
             self.save()
 
     def lookup_decision(
@@ -242,14 +782,8 @@ class DecisionMatrix(Dict[str, Decision]):
 
         If no decision is made, prospectively generate a fingerprint for this decision to use later.
         """
-        matches = []
-        for fingerprint, decision in self.items():
-            if (
-                source == decision.source
-                and target == decision.target
-                and contains(folder, decision.folder)
-            ):
-                matches.append((fingerprint, decision))
+        trie = self._index.get((source, target))
+        matches = trie.containing(folder) if trie is not None else []
         if matches:
             for fingerprint, match in reversed(
                 sorted(matches, key=lambda m: len(m[1].folder))
@@ -283,21 +817,37 @@ class DecisionMatrix(Dict[str, Decision]):
 
         This method mutates the internal state and updates the policy on disk."""
         fingerprint = self.add_decision(source, target, folder, response)
-        ConnectToFolderPolicy.apply_policy_changes_from(self)
+        connect_to_folder_policy().apply_policy_changes_from(self)
         self.save()
         return fingerprint
 
     def lookup_decision_folder(
-        self, fingerprint: str, requested_folder: str
+        self,
+        fingerprint: str,
+        requested_folder: str,
+        source: Optional[str] = None,
+        target: Optional[str] = None,
     ) -> Optional[str]:
         """Called by the server qube during ConnectToFolder to verify the
         folder is a subfolder or is the same as the folder the client qube
         is authorized to access.
 
         The client qube has already connected to the server qube here.
+        When the fingerprint came over that connection rather than as the
+        argument of the call, the source and target qubes of the
+        connection are given, and must be those of the decision.
 
         This method mutates the internal state and updates the policy on disk."""
         match = self.get(fingerprint)
+        if match and source is not None:
+            if match.source != source or match.target != target:
+                logger.info(
+                    "Fingerprint %s was not granted to %s for %s",
+                    fingerprint,
+                    source,
+                    target,
+                )
+                return None
         self.revoke_onetime_accesses_for_fingerprint(fingerprint)
         if match and contains(requested_folder, match.folder):
             logger.info(
@@ -337,6 +887,8 @@ class _LegacyConnectToFolderPolicy(object):
             pass
 
     def apply_policy_changes_from(self, matrix: DecisionMatrix) -> None:
+        import glob
+
         existing_policy_files = glob.glob(self.FNTPL % "*")
         for fingerprint, decision in matrix.items():
             if self.FNTPL % fingerprint in existing_policy_files:
@@ -351,8 +903,17 @@ class _LegacyConnectToFolderPolicy(object):
 class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
     FOLDER = "/etc/qubes/policy.d"
     FNTPL = os.path.join(FOLDER, "79-qubes-shared-folders.policy")
+    MIGRATED_MARKER = "/etc/qubes/shared-folders/legacy-policies-migrated"
+
+    def migrate_legacy_policies(self) -> None:
+        """Move the rules in old-style policy files into the policy file.
+
+        This only happens once; afterwards a marker file records that the
+        old-style policy files need not be looked for anymore."""
+        if os.path.exists(self.MIGRATED_MARKER):
+            return
+        import glob
 
-    def __init__(self) -> None:
         old_policy_files = glob.glob(super().FNTPL % "*")
         old_lines = []
         for file in old_policy_files:
@@ -377,6 +938,11 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
                 f.write("\n".join(complete_lines))
             for file in old_policy_files:
                 os.unlink(file)
+        try:
+            with open(self.MIGRATED_MARKER, "w"):
+                pass
+        except OSError as e:
+            logger.warning("Cannot record policy migration: %s", e)
 
     def known_fingerprints(self) -> List[str]:
         with open(self.FNTPL) as f:
@@ -424,24 +990,91 @@ class _NewConnectToFolderPolicy(_LegacyConnectToFolderPolicy):
         with open(self.FNTPL, "w") as f:
             f.write("".join(policies_without_fp))
 
+    def _rule_fingerprint(self, line: str) -> Optional[str]:
+        if not line.startswith(CONNECT_RPCNAME):
+            return None
+        fields = line.split()
+        return fields[1][1:] if len(fields) > 1 else None
+
+    def _replace_policy(self, text: str) -> None:
+        """Replace the policy file with text, atomically where possible."""
+        tmp = self.FNTPL + ".tmp"
+        try:
+            st: Optional[os.stat_result] = os.stat(self.FNTPL)
+        except FileNotFoundError:
+            st = None
+        try:
+            with open(tmp, "w") as f:
+                f.write(text)
+        except PermissionError:
+            # The policy folder is usually writable only by root, and the
+            # policy file is made group-writable so that unprivileged
+            # dom0 users can still update it in place.
+            with open(self.FNTPL, "w") as f:
+                f.write(text)
+            return
+        if st is not None:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            try:
+                os.chown(tmp, -1, st.st_gid)
+            except PermissionError:
+                pass
+        os.rename(tmp, self.FNTPL)
+
     def apply_policy_changes_from(self, matrix: DecisionMatrix) -> None:
         """For each known share, add allow and remove deny.
 
-        Unknown shares are removed and default to deny.
+        Unknown shares are removed and default to deny.  The policy file
+        is read once and rewritten at most once.
         """
-        existing_fingerprints = self.known_fingerprints()
-        acted_upon = collections.defaultdict(bool)
-        for fingerprint, decision in matrix.items():
-            action = self.grant_for if decision.response.is_allow() else self.revoke_for
-            action(decision.source, decision.target, fingerprint)
-            acted_upon[fingerprint] = True
-        for fingerprint in existing_fingerprints:
-            if not acted_upon[fingerprint]:
-                self.revoke_for("ignored", "ignored", fingerprint)
+        try:
+            with open(self.FNTPL) as f:
+                lines = f.read().splitlines(True)
+        except FileNotFoundError:
+            lines = []
+        allowed = dict(
+            (fingerprint, decision)
+            for fingerprint, decision in matrix.items()
+            if decision.response.is_allow()
+        )
+        kept: List[str] = []
+        present = set()
+        for line in lines:
+            fingerprint = self._rule_fingerprint(line)
+            if fingerprint is not None:
+                if fingerprint not in allowed:
+                    continue
+                present.add(fingerprint)
+            kept.append(line)
+        revoked = len(lines) - len(kept)
+        granted = [fp for fp in allowed if fp not in present]
+        if not revoked and not granted:
+            return
+        if kept and not kept[-1].endswith("\n"):
+            kept[-1] = kept[-1] + "\n"
+        for fingerprint in granted:
+            decision = allowed[fingerprint]
+            kept.append(
+                "%s +%s %s %s allow\n"
+                % (CONNECT_RPCNAME, fingerprint, decision.source, decision.target)
+            )
+        logger.info(
+            "Granting %d and revoking %d rules in %s", len(granted), revoked, self.FNTPL
+        )
+        self._replace_policy("".join(kept))
 
 
-ConnectToFolderPolicy = (
-    _NewConnectToFolderPolicy()
-    if os.path.isdir(_NewConnectToFolderPolicy.FOLDER)
-    else _LegacyConnectToFolderPolicy()
-)
+_connect_to_folder_policy: Optional[_LegacyConnectToFolderPolicy] = None
+
+
+def connect_to_folder_policy() -> _LegacyConnectToFolderPolicy:
+    """Return the ConnectToFolder policy manager for this system."""
+    global _connect_to_folder_policy
+    if _connect_to_folder_policy is None:
+        if os.path.isdir(_NewConnectToFolderPolicy.FOLDER):
+            policy = _NewConnectToFolderPolicy()
+            policy.migrate_legacy_policies()
+            _connect_to_folder_policy = policy
+        else:
+            _connect_to_folder_policy = _LegacyConnectToFolderPolicy()
+    return _connect_to_folder_policy
@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+
+"""Measure how the authorization engine performs with many decisions.
+
+Run from the py directory of a source checkout:
+
+    python3 -m sharedfolders.bench_authorization --sizes 1000,10000
+
+For every matrix size, a synthetic policy database is generated in a
+temporary directory, and the latency of the operations dom0 performs
+while authorizing mounts is measured against it, along with the memory
+a matrix loaded from it takes.  Results can be saved as a baseline, and
+later runs compared against it.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sharedfolders
+from sharedfolders import (
+    RESPONSES,
+    Decision,
+    DecisionMatrix,
+    fingerprint_decision,
+)
+
+
+QUBE_NAMES = [
+    "work",
+    "personal",
+    "vault",
+    "untrusted",
+    "banking",
+    "dev",
+    "media",
+    "storage",
+    "sys-usb",
+    "mail",
+] + ["project-%d" % n for n in range(30)]
+DISPOSABLE_NAMES = ["disp%d" % n for n in range(1000, 1010)]
+FOLDER_NAMES = [
+    "Documents",
+    "Downloads",
+    "Music",
+    "Pictures",
+    "Videos",
+    "Projects",
+    "src",
+    "build",
+    "photos",
+    "2023",
+    "2024",
+    "archive",
+    "reports",
+    "drafts",
+    "shared",
+]
+
+Timings = Dict[str, Dict[str, float]]
+# The timings of each operation, and the memory used by a loaded matrix.
+Results = Dict[str, Dict[str, Any]]
+
+
+class SyntheticInventory(sharedfolders.VMInventory):
+    def query(self) -> List[str]:
+        return QUBE_NAMES + DISPOSABLE_NAMES
+
+
+def pick_qube(rng: random.Random) -> str:
+    # A handful of qubes hold most of the shares.
+    index = min(int(rng.paretovariate(1.2)) - 1, len(QUBE_NAMES) - 1)
+    return QUBE_NAMES[index]
+
+
+def random_folder(rng: random.Random) -> str:
+    depth = rng.randint(1, 6)
+    return "/home/user/" + "/".join(rng.choice(FOLDER_NAMES) for _ in range(depth))
+
+
+def random_decision(rng: random.Random) -> Decision:
+    source = rng.choice(DISPOSABLE_NAMES) if rng.random() < 0.05 else pick_qube(rng)
+    target = pick_qube(rng)
+    while target == source:
+        target = rng.choice(QUBE_NAMES)
+    roll = rng.random()
+    if sharedfolders.is_disp(source):
+        response = RESPONSES.ALLOW_ONETIME if roll < 0.7 else RESPONSES.DENY_ONETIME
+    elif roll < 0.7:
+        response = RESPONSES.ALLOW_ALWAYS
+    elif roll < 0.9:
+        response = RESPONSES.DENY_ALWAYS
+    else:
+        response = RESPONSES.ALLOW_ONETIME
+    return Decision(source, target, random_folder(rng), response)
+
+
+def synthetic_matrix(size: int, rng: random.Random) -> DecisionMatrix:
+    matrix = DecisionMatrix()
+    while len(matrix) < size:
+        d = random_decision(rng)
+        matrix[fingerprint_decision(d.source, d.target, d.folder)] = d
+    return matrix
+
+
+def random_request(matrix: DecisionMatrix, rng: random.Random) -> Tuple[str, str, str]:
+    """Return a request for a folder under a known share, or an unknown one."""
+    if rng.random() < 0.5:
+        d = matrix[rng.choice(list(matrix))]
+        return d.source, d.target, d.folder + "/" + rng.choice(FOLDER_NAMES)
+    source = pick_qube(rng)
+    target = rng.choice([q for q in QUBE_NAMES if q != source])
+    return source, target, random_folder(rng)
+
+
+def measure(
+    samples: int, prepare: Callable[[], Any], run: Callable[[Any], Any]
+) -> List[float]:
+    """Return the latency of each run, in milliseconds.
+
+    prepare() is called before every run, outside the measurement, and its
+    return value is passed to run()."""
+    timings = []
+    for _ in range(samples):
+        arg = prepare()
+        start = time.perf_counter_ns()
+        run(arg)
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+    return timings
+
+
+def percentiles(timings: List[float]) -> Dict[str, float]:
+    timings = sorted(timings)
+
+    def pct(p: float) -> float:
+        return timings[min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))]
+
+    return {"p50": pct(50), "p90": pct(90), "p99": pct(99), "max": timings[-1]}
+
+
+def loaded_matrix_size() -> int:
+    """Return the bytes allocated to load the matrix in the policy database."""
+    DecisionMatrix._cache = None
+    tracemalloc.start()
+    try:
+        matrix = DecisionMatrix.load()
+        # The cache shares its decisions and index with the loaded matrix.
+        DecisionMatrix._cache = None
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert matrix is not None
+    return allocated
+
+
+def bench_size(size: int, samples: int, slow_samples: int, seed: int) -> Results:
+    rng = random.Random(seed)
+    results: Timings = {}
+    memory: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        class Policy(sharedfolders._NewConnectToFolderPolicy):
+            FOLDER = tmpdir
+            FNTPL = os.path.join(tmpdir, "79-qubes-shared-folders.policy")
+            MIGRATED_MARKER = os.path.join(tmpdir, "migrated")
+
+        old_db = DecisionMatrix.POLICY_DB
+        old_inventory = sharedfolders.vm_inventory
+        old_policy = sharedfolders._connect_to_folder_policy
+        DecisionMatrix.POLICY_DB = os.path.join(tmpdir, "policy.db")
+        sharedfolders.vm_inventory = SyntheticInventory()
+        sharedfolders._connect_to_folder_policy = Policy()
+        try:
+            policy = sharedfolders.connect_to_folder_policy()
+            generated = synthetic_matrix(size, rng)
+            generated.copy().save()
+            policy.apply_policy_changes_from(generated)
+            matrix = DecisionMatrix.load()
+            allocated = loaded_matrix_size()
+            memory["matrix KiB"] = allocated / 1024
+            memory["bytes per decision"] = allocated / size
+
+            def time_op(
+                name: str, n: int, prepare: Callable[[], Any], run: Callable[[Any], Any]
+            ) -> None:
+                results[name] = percentiles(measure(n, prepare, run))
+
+            time_op(
+                "lookup_decision",
+                samples,
+                lambda: random_request(matrix, rng),
+                lambda r: matrix.lookup_decision(*r),
+            )
+            time_op(
+                "lookup_prior_authorization",
+                samples,
+                lambda: random_request(matrix, rng),
+                lambda r: matrix.lookup_prior_authorization(*r),
+            )
+            time_op(
+                "process_authorization_request",
+                slow_samples,
+                lambda: random_request(matrix, rng),
+                lambda r: matrix.process_authorization_request(
+                    r[0], r[1], r[2], RESPONSES.ALLOW_ALWAYS
+                ),
+            )
+
+            def uncached() -> None:
+                DecisionMatrix._cache = None
+
+            time_op("load", slow_samples, uncached, lambda _: DecisionMatrix.load())
+            time_op(
+                "load (cached)",
+                slow_samples,
+                lambda: None,
+                lambda _: DecisionMatrix.load(),
+            )
+
+            def one_change() -> DecisionMatrix:
+                m = DecisionMatrix.load()
+                d = random_decision(rng)
+                m[fingerprint_decision(d.source, d.target, d.folder)] = d
+                return m
+
+            time_op("save (one change)", slow_samples, one_change, lambda m: m.save())
+            # A matrix that was not loaded from the store is saved in full.
+            time_op(
+                "save (full)",
+                slow_samples,
+                lambda: DecisionMatrix(matrix),
+                lambda m: m.save(),
+            )
+
+            def changed_matrix() -> DecisionMatrix:
+                m = matrix.copy()
+                for fingerprint in rng.sample(list(m), min(10, len(m))):
+                    d = m[fingerprint]
+                    m[fingerprint] = Decision(
+                        d.source,
+                        d.target,
+                        d.folder,
+                        (
+                            RESPONSES.DENY_ALWAYS
+                            if d.response.is_allow()
+                            else RESPONSES.ALLOW_ALWAYS
+                        ),
+                    )
+                return m
+
+            time_op(
+                "apply_policy_changes_from",
+                slow_samples,
+                changed_matrix,
+                lambda m: policy.apply_policy_changes_from(m),
+            )
+        finally:
+            DecisionMatrix.POLICY_DB = old_db
+            DecisionMatrix._cache = None
+            sharedfolders.vm_inventory = old_inventory
+            sharedfolders._connect_to_folder_policy = old_policy
+    return {"timings": results, "memory": memory}
+
+
+def compare(value: float, baseline: Optional[float], tolerance: float) -> str:
+    if baseline is None:
+        return ""
+    ratio = value / baseline if baseline else 1.0
+    comparison = "%.2fx" % ratio
+    if ratio > tolerance:
+        comparison += " REGRESSION"
+    return comparison
+
+
+def report(size: int, results: Results, baseline: Results, tolerance: float) -> int:
+    """Print the results for one size, and return how many regressed."""
+    comparisons = []
+    print()
+    print("%d decisions:" % size)
+    print(
+        "%-32s %10s %10s %10s %10s  %s"
+        % ("operation", "p50 ms", "p90 ms", "p99 ms", "max ms", "vs. baseline p50")
+    )
+    base_timings = baseline.get("timings", {})
+    for op, r in results["timings"].items():
+        comparison = compare(r["p50"], base_timings.get(op, {}).get("p50"), tolerance)
+        comparisons.append(comparison)
+        print(
+            "%-32s %10.3f %10.3f %10.3f %10.3f  %s"
+            % (op, r["p50"], r["p90"], r["p99"], r["max"], comparison)
+        )
+    base_memory = baseline.get("memory", {})
+    for what, value in results["memory"].items():
+        comparison = compare(value, base_memory.get(what), tolerance)
+        comparisons.append(comparison)
+        print("%-32s %10.1f  %s" % (what, value, comparison))
+    return len([c for c in comparisons if c.endswith("REGRESSION")])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="comma-separated numbers of decisions (default %(default)s)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=500,
+        help="runs of each lookup operation (default %(default)s)",
+    )
+    parser.add_argument(
+        "--slow-samples",
+        type=int,
+        default=20,
+        help="runs of each operation that writes or loads (default %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="compare against results saved here")
+    parser.add_argument("--save", help="save the results here")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="p50 ratio over the baseline deemed a regression (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    baseline: Dict[str, Results] = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    all_results: Dict[str, Results] = {}
+    regressions = 0
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results = bench_size(size, args.samples, args.slow_samples, args.seed)
+        all_results[str(size)] = results
+        regressions += report(
+            size, results, baseline.get(str(size), {}), args.tolerance
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(all_results, f, indent=4, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
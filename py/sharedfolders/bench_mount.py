@@ -0,0 +1,481 @@
+#!/usr/bin/python3
+
+"""Measure how fast a folder mounted through qfsd is.
+
+Build qfsd in release mode, then run as root, or as a user who can run
+sudo without a password, from the py directory of a source checkout:
+
+    python3 -m sharedfolders.bench_mount --qfsd ../target/release/qfsd
+
+Synthetic trees are created in a temporary directory: many small files
+in a git repository, a deep hierarchy, a huge flat directory and a large
+file.  src/test-qfsd-mount.py then exports the directory through qfsd
+and mounts it with the Linux 9p client, over a pair of pipes like
+qvm-mount-folder does over qrexec, all on this machine.  Workloads run
+against the mount: sequential and random reads and writes, reading every
+small file, stat(2) of every file, find, ls -lR and git status.  The
+throughput, operations per second and latencies of each are reported.
+For find, ls -lR and git status, the latencies are those of the whole
+command.
+
+Results can be saved as a baseline, and later runs compared against it,
+with other mount options (--options, e.g. cache=loose), or another build
+of qfsd (--qfsd, --qfsd-args).  With --cold, the page cache is dropped
+before every run, which evicts the files both from the mount and from
+the folder qfsd exports.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple
+
+from sharedfolders.bench_qfsd import compare
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOPDIR = os.path.dirname(os.path.dirname(HERE))
+MOUNT_SCRIPT = os.path.join(TOPDIR, "src", "test-qfsd-mount.py")
+
+# The size of the small files, of the files in the deep hierarchy, and of
+# the files in the flat directory.
+SMALL_FILE_SIZE = 4096
+DEEP_FILE_SIZE = 1024
+FLAT_FILE_SIZE = 100
+SMALL_FILES_PER_DIR = 100
+DEEP_FILES_PER_DIR = 8
+
+# Sequential I/O goes a MiB at a time, random I/O a page at a time.
+SEQUENTIAL_IO_SIZE = 1024 * 1024
+RANDOM_IO_SIZE = 4096
+
+# Throughput, operations per second and latencies of each workload.
+Results = Dict[str, Dict[str, float]]
+
+
+class Trees(NamedTuple):
+    """The synthetic trees, and how big they are."""
+
+    root: str
+    small_files: int
+    flat_files: int
+    depth: int
+    large_size: int
+    random_ops: int
+
+    def small(self) -> List[str]:
+        return [
+            os.path.join("small", "d%03d" % (i // SMALL_FILES_PER_DIR), "f%05d" % i)
+            for i in range(self.small_files)
+        ]
+
+    def deep(self) -> List[str]:
+        paths: List[str] = []
+        d = "deep"
+        for level in range(self.depth):
+            d = os.path.join(d, "l%02d" % level)
+            paths.extend(os.path.join(d, "f%d" % i) for i in range(DEEP_FILES_PER_DIR))
+        return paths
+
+    def flat(self) -> List[str]:
+        return [os.path.join("flat", "f%06d" % i) for i in range(self.flat_files)]
+
+    def on(self, root: str) -> "Trees":
+        """Return the same trees, as seen under another root."""
+        return self._replace(root=root)
+
+
+def make_trees(trees: Trees) -> None:
+    for paths, size in [
+        (trees.small(), SMALL_FILE_SIZE),
+        (trees.deep(), DEEP_FILE_SIZE),
+        (trees.flat(), FLAT_FILE_SIZE),
+    ]:
+        data = os.urandom(size)
+        for path in paths:
+            path = os.path.join(trees.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+    with open(os.path.join(trees.root, "large"), "wb") as f:
+        chunk = os.urandom(SEQUENTIAL_IO_SIZE)
+        for _ in range(0, trees.large_size, len(chunk)):
+            f.write(chunk)
+        f.truncate(trees.large_size)
+        # Only clean pages can be dropped from the page cache.
+        os.fsync(f.fileno())
+
+    if shutil.which("git"):
+        small = os.path.join(trees.root, "small")
+        for cmd in [
+            ["init", "-q"],
+            ["add", "."],
+            ["-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+            + ["commit", "-q", "-m", "bench"],
+        ]:
+            subprocess.check_call(["git", "-C", small] + cmd)
+
+
+class Run(NamedTuple):
+    """What a run of a workload did, and the time each operation took."""
+
+    seconds: float
+    ops: int
+    bytes: int
+    latencies: List[float]
+
+
+def timed_ops(op: Callable[[int], int], n: int) -> Run:
+    """Run op(i) for every i under n, each returning the bytes it moved."""
+    latencies = []
+    moved = 0
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        moved += op(i)
+        latencies.append(time.perf_counter() - t)
+    return Run(time.perf_counter() - start, n, moved, latencies)
+
+
+def sequential_read(trees: Trees) -> Run:
+    buf = bytearray(SEQUENTIAL_IO_SIZE)
+    fd = os.open(os.path.join(trees.root, "large"), os.O_RDONLY)
+    try:
+        return timed_ops(
+            lambda _: os.readv(fd, [buf]),
+            -(-trees.large_size // SEQUENTIAL_IO_SIZE),
+        )
+    finally:
+        os.close(fd)
+
+
+def sequential_write(trees: Trees) -> Run:
+    data = os.urandom(SEQUENTIAL_IO_SIZE)
+    path = os.path.join(trees.root, "written")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        run = timed_ops(
+            lambda _: os.write(fd, data),
+            -(-trees.large_size // SEQUENTIAL_IO_SIZE),
+        )
+        start = time.perf_counter()
+        os.fsync(fd)
+        return run._replace(seconds=run.seconds + time.perf_counter() - start)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+def random_offsets(trees: Trees) -> List[int]:
+    pages = trees.large_size // RANDOM_IO_SIZE
+    rng = random.Random(0)
+    return [rng.randrange(pages) * RANDOM_IO_SIZE for _ in range(trees.random_ops)]
+
+
+def random_read(trees: Trees) -> Run:
+    offsets = random_offsets(trees)
+    fd = os.open(os.path.join(trees.root, "large"), os.O_RDONLY)
+    try:
+        return timed_ops(
+            lambda i: len(os.pread(fd, RANDOM_IO_SIZE, offsets[i])), len(offsets)
+        )
+    finally:
+        os.close(fd)
+
+
+def random_write(trees: Trees) -> Run:
+    offsets = random_offsets(trees)
+    data = os.urandom(RANDOM_IO_SIZE)
+    fd = os.open(os.path.join(trees.root, "large"), os.O_WRONLY)
+    try:
+        run = timed_ops(lambda i: os.pwrite(fd, data, offsets[i]), len(offsets))
+        start = time.perf_counter()
+        os.fsync(fd)
+        return run._replace(seconds=run.seconds + time.perf_counter() - start)
+    finally:
+        os.close(fd)
+
+
+def read_small_files(trees: Trees) -> Run:
+    paths = [os.path.join(trees.root, p) for p in trees.small()]
+
+    def read(i: int) -> int:
+        with open(paths[i], "rb") as f:
+            return len(f.read())
+
+    return timed_ops(read, len(paths))
+
+
+def stat_files(trees: Trees) -> Run:
+    paths = [
+        os.path.join(trees.root, p) for p in trees.small() + trees.deep() + trees.flat()
+    ]
+
+    def stat(i: int) -> int:
+        os.stat(paths[i])
+        return 0
+
+    return timed_ops(stat, len(paths))
+
+
+def command(cmd: List[str], ops: int) -> Run:
+    start = time.perf_counter()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return Run(elapsed, ops, 0, [elapsed])
+
+
+def entries(trees: Trees) -> int:
+    """Return the number of files and directories in the trees."""
+    files = trees.small_files + trees.depth * DEEP_FILES_PER_DIR + trees.flat_files
+    dirs = -(-trees.small_files // SMALL_FILES_PER_DIR) + trees.depth
+    return files + dirs
+
+
+def find(trees: Trees) -> Run:
+    return command(
+        ["find", trees.root, "-name", ".git", "-prune", "-o", "-print"],
+        entries(trees),
+    )
+
+
+def ls_lR(trees: Trees) -> Run:
+    return command(["ls", "-lR", trees.root], entries(trees))
+
+
+def git_status(trees: Trees) -> Run:
+    return command(
+        ["git", "-c", "safe.directory=*", "-C", os.path.join(trees.root, "small")]
+        + ["status", "--porcelain"],
+        trees.small_files,
+    )
+
+
+WORKLOADS: Dict[str, Callable[[Trees], Run]] = {
+    "seq-read": sequential_read,
+    "seq-write": sequential_write,
+    "rand-read": random_read,
+    "rand-write": random_write,
+    "small-read": read_small_files,
+    "stat": stat_files,
+    "find": find,
+    "ls-lR": ls_lR,
+    "git-status": git_status,
+}
+
+
+def summarize(runs: List[Run]) -> Dict[str, float]:
+    latencies = sorted(l for r in runs for l in r.latencies)
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p99 = quantiles[49], quantiles[98]
+    else:
+        p50 = p99 = latencies[0]
+    result = {
+        "ops/s": statistics.median(r.ops / r.seconds for r in runs),
+        "p50 ms": p50 * 1000,
+        "p99 ms": p99 * 1000,
+    }
+    if any(r.bytes for r in runs):
+        result["MB/s"] = statistics.median(r.bytes / 1e6 / r.seconds for r in runs)
+    return result
+
+
+def sudo(cmd: List[str]) -> List[str]:
+    return cmd if os.getuid() == 0 else ["sudo"] + cmd
+
+
+def drop_caches() -> None:
+    os.sync()
+    subprocess.run(
+        sudo(["tee", "/proc/sys/vm/drop_caches"]),
+        input=b"3\n",
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+@contextlib.contextmanager
+def mounted(source: str, qfsd: str, qfsd_args: str, options: str) -> Iterator[str]:
+    """Mount the folder through qfsd for the duration of the context, and
+    return where it is mounted."""
+    target = tempfile.mkdtemp(prefix="bench-mount-")
+    try:
+        cmd = [sys.executable, MOUNT_SCRIPT, "--qfsd", qfsd]
+        if qfsd_args:
+            cmd += ["--qfsd-args", qfsd_args]
+        if options:
+            cmd += ["-o", options]
+        subprocess.check_call(cmd + [source, target])
+        try:
+            yield target
+        finally:
+            subprocess.check_call(sudo(["umount", target]))
+    finally:
+        os.rmdir(target)
+
+
+def bench(
+    trees: Trees,
+    qfsd: str,
+    qfsd_args: str,
+    options: str,
+    workloads: List[str],
+    runs: int,
+    cold: bool = False,
+) -> Results:
+    results: Results = {}
+    make_trees(trees)
+    with mounted(trees.root, qfsd, qfsd_args, options) as target:
+        mount = trees.on(target)
+        for name in workloads:
+            done = []
+            for _ in range(runs):
+                if cold:
+                    drop_caches()
+                done.append(WORKLOADS[name](mount))
+            results[name] = summarize(done)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--qfsd",
+        default=shutil.which("qfsd") or "qfsd",
+        help="the qfsd program to measure (default %(default)s)",
+    )
+    parser.add_argument(
+        "--qfsd-args",
+        default="",
+        help="space-separated options for qfsd, e.g. '--workers 1'",
+    )
+    parser.add_argument(
+        "--options",
+        default="",
+        help="comma-separated mount options added to those of "
+        "qvm-mount-folder, e.g. 'msize=1048576,cache=loose'",
+    )
+    parser.add_argument(
+        "--workloads",
+        default=",".join(WORKLOADS),
+        help="comma-separated workloads to run (default %(default)s)",
+    )
+    parser.add_argument(
+        "--small-files",
+        type=int,
+        default=10000,
+        help="small files in the git repository (default %(default)s)",
+    )
+    parser.add_argument(
+        "--flat-files",
+        type=int,
+        default=20000,
+        help="files in the flat directory (default %(default)s)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=32,
+        help="levels of the deep hierarchy (default %(default)s)",
+    )
+    parser.add_argument(
+        "--large-size",
+        type=int,
+        default=2048,
+        help="size of the large file, in MiB (default %(default)s)",
+    )
+    parser.add_argument(
+        "--random-ops",
+        type=int,
+        default=10000,
+        help="random reads and writes of the large file (default %(default)s)",
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="drop the page cache before every run",
+    )
+    parser.add_argument("--baseline", help="compare against results saved here")
+    parser.add_argument("--save", help="save the results here")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.1,
+        help="baseline over median ratio deemed a regression (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    workloads = args.workloads.split(",")
+    unknown = [w for w in workloads if w not in WORKLOADS]
+    if unknown:
+        parser.error("unknown workloads: %s" % ", ".join(unknown))
+
+    baseline: Results = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trees = Trees(
+            tmpdir,
+            args.small_files,
+            args.flat_files,
+            args.depth,
+            args.large_size * 1024 * 1024,
+            args.random_ops,
+        )
+        results = bench(
+            trees,
+            args.qfsd,
+            args.qfsd_args,
+            args.options,
+            workloads,
+            args.runs,
+            args.cold,
+        )
+
+    regressions = 0
+    print(
+        "%-10s %10s %10s %10s %10s  %s"
+        % ("workload", "MB/s", "ops/s", "p50 ms", "p99 ms", "vs. baseline median")
+    )
+    for name, r in results.items():
+        # Workloads that move data are compared on throughput, the others
+        # on operations per second.
+        metric = "MB/s" if "MB/s" in r else "ops/s"
+        comparison = compare(
+            r[metric], baseline.get(name, {}).get(metric), args.tolerance
+        )
+        if comparison.endswith("REGRESSION"):
+            regressions += 1
+        print(
+            "%-10s %10s %10.1f %10.3f %10.3f  %s"
+            % (
+                name,
+                "%.1f" % r["MB/s"] if "MB/s" in r else "-",
+                r["ops/s"],
+                r["p50 ms"],
+                r["p99 ms"],
+                comparison,
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+
+"""Measure how fast qfsd reads and writes files.
+
+Build qfsd in release mode, then run from the py directory of a source
+checkout:
+
+    python3 -m sharedfolders.bench_qfsd --qfsd ../target/release/qfsd
+
+A file is created in a temporary directory, which qfsd then exports over
+a pair of pipes, as it does over qrexec.  The file is read and written
+sequentially in messages as large as the negotiated message size, with
+several requests outstanding at a time like the Linux 9p client sends
+them, and the throughput of each run is reported.  Results can be saved
+as a baseline, and later runs compared against it.
+
+With --cold, the file is evicted from the page cache before every run,
+so that reads wait for the disk as they would on a file not read lately.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+TVERSION = 100
+TATTACH = 104
+TWALK = 110
+TLOPEN = 12
+TREAD = 116
+TWRITE = 118
+TCLUNK = 120
+RLERROR = 7
+
+NOFID = 0xFFFFFFFF
+O_RDONLY = 0
+O_WRONLY = 1
+
+# size[4] type[1] tag[2]
+HEADER = struct.Struct("<IBH")
+# The header of Rread, and of Twrite up to its data: count[4] and
+# fid[4] offset[8] count[4] respectively.
+RREAD_OVERHEAD = HEADER.size + 4
+TWRITE_OVERHEAD = HEADER.size + 16
+
+# Throughput of each operation, in MiB/s.
+Results = Dict[str, Dict[str, float]]
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def string(s: str) -> bytes:
+    b = s.encode("utf-8")
+    return struct.pack("<H", len(b)) + b
+
+
+class Client(object):
+    """A minimal 9P2000.L client, enough to read and write files.
+
+    Messages are sent and received without copying their bodies around,
+    so the client costs as little as possible next to the server."""
+
+    def __init__(self, readfd: int, writefd: int):
+        self.readfd = readfd
+        self.writefd = writefd
+        self.next_tag = 0
+        self.buf = bytearray(HEADER.size)
+        self.view = memoryview(self.buf)
+
+    def send(self, ty: int, *body: bytes) -> int:
+        tag = self.next_tag
+        self.next_tag = (self.next_tag + 1) % 0xFFFF
+        size = HEADER.size + sum(len(b) for b in body)
+        chunks: Sequence[bytes] = [HEADER.pack(size, ty, tag), *body]
+        while chunks:
+            written = os.writev(self.writefd, chunks)
+            while chunks and written >= len(chunks[0]):
+                written -= len(chunks[0])
+                chunks = chunks[1:]
+            if chunks and written:
+                chunks = [chunks[0][written:], *chunks[1:]]
+        return tag
+
+    def read_into(self, view: memoryview) -> None:
+        while view:
+            n = os.readv(self.readfd, [view])
+            if not n:
+                raise ProtocolError("qfsd closed the connection")
+            view = view[n:]
+
+    def receive(self) -> Tuple[int, int, memoryview]:
+        """Return the type, tag and body of the next response.  The body
+        is only valid until the next response is received."""
+        self.read_into(self.view[: HEADER.size])
+        size, ty, tag = HEADER.unpack_from(self.buf)
+        if size > len(self.buf):
+            self.buf = bytearray(size)
+            self.view = memoryview(self.buf)
+        body = self.view[: size - HEADER.size]
+        self.read_into(body)
+        if ty == RLERROR:
+            errno = struct.unpack_from("<I", body)[0]
+            raise ProtocolError("request failed: errno %d" % errno)
+        return ty, tag, body
+
+    def call(self, ty: int, body: bytes) -> bytes:
+        self.send(ty, body)
+        _, _, response = self.receive()
+        return bytes(response)
+
+    def version(self, msize: int) -> int:
+        body = self.call(TVERSION, struct.pack("<I", msize) + string("9P2000.L"))
+        negotiated: int = struct.unpack_from("<I", body)[0]
+        return negotiated
+
+    def attach(self, fid: int) -> None:
+        self.call(
+            TATTACH,
+            struct.pack("<II", fid, NOFID)
+            + string("bench")
+            + string("")
+            + struct.pack("<I", os.getuid()),
+        )
+
+    def walk(self, fid: int, newfid: int, names: List[str]) -> None:
+        self.call(
+            TWALK,
+            struct.pack("<IIH", fid, newfid, len(names))
+            + b"".join(string(n) for n in names),
+        )
+
+    def lopen(self, fid: int, flags: int) -> None:
+        self.call(TLOPEN, struct.pack("<II", fid, flags))
+
+    def clunk(self, fid: int) -> None:
+        self.call(TCLUNK, struct.pack("<I", fid))
+
+
+def pipelined(
+    client: Client, requests: List[Tuple[int, Tuple[bytes, ...]]], depth: int
+) -> int:
+    """Send the requests with up to depth of them outstanding, and return
+    the sum of the counts their responses start with."""
+    total = 0
+    sent = received = 0
+    while received < len(requests):
+        while sent < len(requests) and sent - received < depth:
+            ty, body = requests[sent]
+            client.send(ty, *body)
+            sent += 1
+        _, _, response = client.receive()
+        total += struct.unpack_from("<I", response)[0]
+        received += 1
+    return total
+
+
+def read_file(client: Client, fid: int, size: int, count: int, depth: int) -> int:
+    requests: List[Tuple[int, Tuple[bytes, ...]]] = [
+        (TREAD, (struct.pack("<IQI", fid, offset, count),))
+        for offset in range(0, size, count)
+    ]
+    return pipelined(client, requests, depth)
+
+
+def write_file(client: Client, fid: int, size: int, count: int, depth: int) -> int:
+    data = memoryview(os.urandom(count))
+    requests: List[Tuple[int, Tuple[bytes, ...]]] = []
+    for offset in range(0, size, count):
+        n = min(count, size - offset)
+        requests.append(
+            (TWRITE, (struct.pack("<IQI", fid, offset, n), bytes(data[:n])))
+        )
+    return pipelined(client, requests, depth)
+
+
+def cpu_time(pid: int) -> float:
+    """Return the CPU time the process used so far, in seconds."""
+    with open("/proc/%d/stat" % pid) as f:
+        # The command name may contain spaces, but not parentheses.
+        fields = f.read().rsplit(")", 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+
+def evict(path: str) -> None:
+    """Drop the pages of the file from the page cache."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def bench(
+    qfsd: str,
+    qfsd_args: List[str],
+    size: int,
+    msize: int,
+    depth: int,
+    runs: int,
+    cold: bool = False,
+) -> Results:
+    results: Results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "data")
+        with open(path, "wb") as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(0, size, len(chunk)):
+                f.write(chunk)
+            f.truncate(size)
+            # Only clean pages can be evicted.
+            os.fsync(f.fileno())
+
+        p = subprocess.Popen(
+            [qfsd] + qfsd_args + ["0", "1", tmpdir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        assert p.stdin and p.stdout
+        try:
+            client = Client(p.stdout.fileno(), p.stdin.fileno())
+            msize = client.version(msize)
+            client.attach(0)
+
+            for op, flags, overhead, transfer in [
+                ("read", O_RDONLY, RREAD_OVERHEAD, read_file),
+                ("write", O_WRONLY, TWRITE_OVERHEAD, write_file),
+            ]:
+                timings = []
+                cpu = 0.0
+                for _ in range(runs):
+                    client.walk(0, 1, ["data"])
+                    client.lopen(1, flags)
+                    if cold:
+                        evict(path)
+                    start, start_cpu = time.perf_counter(), cpu_time(p.pid)
+                    transferred = transfer(client, 1, size, msize - overhead, depth)
+                    timings.append(time.perf_counter() - start)
+                    cpu += cpu_time(p.pid) - start_cpu
+                    client.clunk(1)
+                    if transferred != size:
+                        raise ProtocolError(
+                            "%s %d bytes out of %d" % (op, transferred, size)
+                        )
+                mibs = [size / 1024 / 1024 / t for t in timings]
+                results[op] = {
+                    "median MiB/s": statistics.median(mibs),
+                    "best MiB/s": max(mibs),
+                    "qfsd CPU ms/GiB": cpu * 1000 / (runs * size / 1024**3),
+                }
+        finally:
+            p.stdin.close()
+            p.wait()
+    return results
+
+
+def compare(value: float, baseline: Optional[float], tolerance: float) -> str:
+    if not baseline:
+        return ""
+    # Lower throughput is worse.
+    ratio = baseline / value if value else float("inf")
+    comparison = "%.2fx" % (value / baseline)
+    if ratio > tolerance:
+        comparison += " REGRESSION"
+    return comparison
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--qfsd",
+        default="qfsd",
+        help="the qfsd program to measure (default %(default)s)",
+    )
+    parser.add_argument(
+        "--qfsd-args",
+        default="",
+        help="space-separated options for qfsd, e.g. '--workers 1'",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024,
+        help="size of the file read and written, in MiB (default %(default)s)",
+    )
+    parser.add_argument(
+        "--msize",
+        type=int,
+        default=1024 * 1024,
+        help="message size asked for; the Linux client uses at most 1 MiB "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=4,
+        help="requests outstanding at a time (default %(default)s)",
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="evict the file from the page cache before every run",
+    )
+    parser.add_argument("--baseline", help="compare against results saved here")
+    parser.add_argument("--save", help="save the results here")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.1,
+        help="baseline over median ratio deemed a regression (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    baseline: Results = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = bench(
+        args.qfsd,
+        args.qfsd_args.split(),
+        args.size * 1024 * 1024,
+        args.msize,
+        args.depth,
+        args.runs,
+        args.cold,
+    )
+
+    regressions = 0
+    print(
+        "%-10s %14s %14s %16s  %s"
+        % (
+            "operation",
+            "median MiB/s",
+            "best MiB/s",
+            "qfsd CPU ms/GiB",
+            "vs. baseline median",
+        )
+    )
+    for op, r in results.items():
+        comparison = compare(
+            r["median MiB/s"],
+            baseline.get(op, {}).get("median MiB/s"),
+            args.tolerance,
+        )
+        if comparison.endswith("REGRESSION"):
+            regressions += 1
+        print(
+            "%-10s %14.1f %14.1f %16.1f  %s"
+            % (
+                op,
+                r["median MiB/s"],
+                r["best MiB/s"],
+                r["qfsd CPU ms/GiB"],
+                comparison,
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+"""Measure how fast the shared folders programs start.
+
+Run from the py directory of a source checkout:
+
+    python3 -m sharedfolders.bench_startup
+
+The report lists the slowest imports of sharedfolders.programs, as
+measured by python -X importtime, and the wall-clock time each entry
+point takes to start and exit when it is not given a valid request.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYDIR = os.path.dirname(HERE)
+TOPDIR = os.path.dirname(PYDIR)
+
+ENTRY_POINTS = [
+    os.path.join(TOPDIR, "etc", "qubes-rpc", "ruddo.AuthorizeFolderAccess"),
+    os.path.join(TOPDIR, "etc", "qubes-rpc", "ruddo.QueryFolderAuthorization"),
+    os.path.join(TOPDIR, "bin", "qvm-mount-folder"),
+]
+
+# Modules that the qrexec services must not import until they need them.
+DEFERRED_MODULES = [
+    "argparse",
+    "glob",
+    "hashlib",
+    "json",
+    "sqlite3",
+    "subprocess",
+    "getpass",
+]
+
+
+def environment() -> Dict[str, str]:
+    env = dict(
+        (k, v)
+        for k, v in os.environ.items()
+        if not k.startswith("QREXEC_") and k != "PYTHONDONTWRITEBYTECODE"
+    )
+    env["PYTHONPATH"] = PYDIR
+    return env
+
+
+def import_times(module: str) -> List[Tuple[int, int, str]]:
+    """Return (self, cumulative, module) import times in microseconds."""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        env=environment(),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times.append((int(own), int(cumulative), name.strip()))
+    return times
+
+
+def loaded_modules(module: str) -> List[str]:
+    p = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, %s; print('\\n'.join(sys.modules))" % module,
+        ],
+        env=environment(),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return p.stdout.splitlines()
+
+
+def time_entry_point(path: str, runs: int) -> List[float]:
+    """Return the wall-clock time of each run of the entry point, in ms."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, path],
+            env=environment(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    # Warm up the bytecode cache, so compilation is not measured.
+    subprocess.run(
+        [sys.executable, "-m", "compileall", "-q", HERE], env=environment(), check=True
+    )
+
+    times = import_times("sharedfolders.programs")
+    total = max(cumulative for _, cumulative, _ in times)
+    print("Slowest imports of sharedfolders.programs (total %.1f ms):" % (total / 1000))
+    print("%10s %10s  %s" % ("self ms", "cumul ms", "module"))
+    for own, cumulative, name in sorted(times, key=lambda t: -t[0])[: args.top]:
+        print("%10.2f %10.2f  %s" % (own / 1000, cumulative / 1000, name))
+
+    loaded = loaded_modules("sharedfolders.programs")
+    deferred = [m for m in DEFERRED_MODULES if m in loaded]
+    print()
+    print("Deferred modules imported eagerly: %s" % (", ".join(deferred) or "none"))
+
+    print()
+    print("Entry point wall-clock time over %d runs:" % args.runs)
+    print("%10s %10s %10s  %s" % ("min ms", "median ms", "max ms", "entry point"))
+    # Running an empty script measures the startup of the interpreter alone.
+    entry_points = [(os.devnull, "(bare interpreter)")] + [
+        (path, os.path.relpath(path, TOPDIR))
+        for path in ENTRY_POINTS
+        if os.path.exists(path)
+    ]
+    for path, label in entry_points:
+        timings = time_entry_point(path, args.runs)
+        print(
+            "%10.1f %10.1f %10.1f  %s"
+            % (min(timings), statistics.median(timings), max(timings), label)
+        )
+    return 1 if deferred else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
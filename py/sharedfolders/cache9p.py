@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+
+"""Answer repeated 9P requests of a mount from a cache in the client qube.
+
+Every request of a mount goes over qrexec to qfsd, and waits for the
+round trip, even when it asks for the same attributes, directory entries
+or file data as a request made a moment ago.  For shares that are
+read-only or rarely change, the proxy sits between the kernel and qfsd
+and answers repeated Tgetattr, Treaddir, Tread and Treadlink requests
+from a cache of their responses, bounded in size:
+
+    python3 -m sharedfolders.cache9p -- qfsd 0 1 /folder
+
+qvm-mount-folder --cache-proxy SECONDS puts it in front of the folder it
+mounts.
+
+Responses are cached under the qid of the file they are about, which
+includes its version.  qfsd changes the version of a file whenever it
+changes, so the version the server last reported tells whether cached
+responses are current.  Walks, opens and Tgetattr requests the proxy
+does not answer itself carry the current version of the file, and every
+stat(2), open(2) or directory listing of the mount walks to the file
+afresh.  What the proxy learned about a file is only trusted for the
+given number of seconds after it learned it, so that a file held open
+while it changes in the server qube is eventually read again.  Requests
+from the client that change files drop the whole cache.
+
+Twalk is always forwarded, as the server must know the fids the client
+walks to before it is asked about them.
+"""
+
+import argparse
+import collections
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from sharedfolders.capture9p import HEADER, RLERROR, connect, write_all
+
+
+TSTATFS = 8
+TLOPEN = 12
+TLCREATE = 14
+TREADLINK = 22
+TGETATTR = 24
+TXATTRWALK = 30
+TREADDIR = 40
+TFSYNC = 50
+TLOCK = 52
+TGETLOCK = 54
+TVERSION = 100
+TAUTH = 102
+TATTACH = 104
+TFLUSH = 108
+TWALK = 110
+TREAD = 116
+TCLUNK = 120
+TREMOVE = 122
+
+O_TRUNC = 0o1000
+
+# The requests whose responses are cached.  They all start with the fid
+# they are about.
+CACHED = {TGETATTR, TREADDIR, TREAD, TREADLINK}
+# The requests that change nothing in the files served.  The others drop
+# the cache.
+READ_ONLY = CACHED | {
+    TSTATFS,
+    TLOPEN,
+    TXATTRWALK,
+    TFSYNC,
+    TLOCK,
+    TGETLOCK,
+    TVERSION,
+    TAUTH,
+    TATTACH,
+    TFLUSH,
+    TWALK,
+    TCLUNK,
+}
+
+# type[1] version[4] path[8]
+QID = struct.Struct("<BIQ")
+
+FRAME_BUFFER_SIZE = 256 * 1024
+
+# The cache key of a response: the type of the request, the path and
+# version of the qid of the file, and the rest of the request.
+Key = Tuple[int, int, int, bytes]
+
+
+class File(NamedTuple):
+    """What the proxy knows about the file a fid stands for."""
+
+    path: int
+    version: int
+    learned: float
+
+
+class Pending(NamedTuple):
+    """A request forwarded to the server, and what to learn from its
+    response."""
+
+    type: int
+    fid: int
+    # The fid walked to and the number of names walked, or the tag a
+    # Tflush flushes.
+    newfid: int = 0
+    names: int = 0
+    key: Optional[Key] = None
+
+
+class Cache(object):
+    """Responses, evicting the least recently used once they take more
+    than a number of bytes."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.entries: "collections.OrderedDict[Key, bytes]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Key) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: Key, body: bytes) -> None:
+        if len(body) > self.capacity:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+
+class Proxy(object):
+    """Follows the requests of a client and the responses of the server,
+    answering requests from the cache when it can."""
+
+    def __init__(
+        self,
+        capacity: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.cache = Cache(capacity)
+        self.ttl = ttl
+        self.clock = clock
+        self.fids: Dict[int, File] = {}
+        self.pending: Dict[int, Pending] = {}
+        self.lock = threading.Lock()
+
+    def learn(self, fid: int, qid: bytes) -> File:
+        _, version, path = QID.unpack_from(qid)
+        f = self.fids[fid] = File(path, version, self.clock())
+        return f
+
+    def request(self, ty: int, tag: int, body: bytes) -> Optional[bytes]:
+        """Handle a request of the client.  Return the frame of its
+        response if it was cached, or None if the request is to be
+        forwarded to the server."""
+        with self.lock:
+            if ty in CACHED:
+                (fid,) = struct.unpack_from("<I", body)
+                f = self.fids.get(fid)
+                key = None
+                if f:
+                    key = (ty, f.path, f.version, body[4:])
+                    cached = None
+                    if self.clock() - f.learned <= self.ttl:
+                        cached = self.cache.get(key)
+                    if cached is not None:
+                        return (
+                            HEADER.pack(HEADER.size + len(cached), ty + 1, tag) + cached
+                        )
+                # The response is cached under the version known now even
+                # if the file changes before the server reads it, as the
+                # version it changes to is a different one.
+                self.pending[tag] = Pending(ty, fid, key=key)
+                return None
+
+            if ty not in READ_ONLY:
+                self.cache.clear()
+            if ty == TVERSION:
+                self.fids.clear()
+                self.pending.clear()
+                self.cache.clear()
+                self.pending[tag] = Pending(ty, 0)
+            elif ty == TWALK:
+                fid, newfid, names = struct.unpack_from("<IIH", body)
+                self.pending[tag] = Pending(ty, fid, newfid, names)
+            elif ty == TFLUSH:
+                (oldtag,) = struct.unpack_from("<H", body)
+                self.pending[tag] = Pending(ty, 0, oldtag)
+            elif ty in (TCLUNK, TREMOVE):
+                (fid,) = struct.unpack_from("<I", body)
+                self.fids.pop(fid, None)
+                self.pending[tag] = Pending(ty, fid)
+            elif len(body) >= 4:
+                (fid,) = struct.unpack_from("<I", body)
+                if ty == TLOPEN and struct.unpack_from("<I", body, 4)[0] & O_TRUNC:
+                    self.cache.clear()
+                self.pending[tag] = Pending(ty, fid)
+            return None
+
+    def response(self, ty: int, tag: int, body: bytes) -> None:
+        """Learn from a response of the server, before it is forwarded to
+        the client."""
+        with self.lock:
+            p = self.pending.pop(tag, None)
+            if not p or ty == RLERROR:
+                return
+            if p.type in (TATTACH, TLOPEN, TLCREATE):
+                self.learn(p.fid, body[: QID.size])
+            elif p.type == TWALK:
+                # Only walks to every name given create the new fid.
+                (walked,) = struct.unpack_from("<H", body)
+                if walked == p.names and walked:
+                    offset = 2 + (walked - 1) * QID.size
+                    self.learn(p.newfid, body[offset : offset + QID.size])
+                elif walked == p.names and p.fid in self.fids:
+                    self.fids[p.newfid] = self.fids[p.fid]
+            elif p.type == TFLUSH:
+                self.pending.pop(p.newfid, None)
+            elif p.type == TGETATTR:
+                # valid[8] qid[13]
+                f = self.learn(p.fid, body[8 : 8 + QID.size])
+                if p.key:
+                    self.cache.put((p.key[0], f.path, f.version, p.key[3]), body)
+            elif p.key:
+                self.cache.put(p.key, body)
+
+
+class FrameReader(object):
+    def __init__(self, fd: int):
+        self.f = os.fdopen(fd, "rb", buffering=FRAME_BUFFER_SIZE)
+
+    def read(self) -> Optional[Tuple[int, int, bytes, bytes]]:
+        """Return the type, tag, header and body of the next frame, or None
+        at the end of the file."""
+        header = self.f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        size, ty, tag = HEADER.unpack(header)
+        body = self.f.read(size - HEADER.size)
+        if len(body) < size - HEADER.size:
+            return None
+        return ty, tag, header, body
+
+
+def serve(client: Tuple[int, int], server: Tuple[int, int], proxy: Proxy) -> None:
+    """Relay the traffic between the client and the server, each given
+    as the file descriptors to read from and write to, answering what
+    the proxy can from its cache."""
+    # Both directions write responses to the client.
+    client_lock = threading.Lock()
+
+    def to_client(frame: bytes) -> None:
+        with client_lock:
+            write_all(client[1], memoryview(frame))
+
+    def requests() -> None:
+        reader = FrameReader(client[0])
+        try:
+            while True:
+                frame = reader.read()
+                if not frame:
+                    break
+                ty, tag, header, body = frame
+                response = proxy.request(ty, tag, body)
+                if response:
+                    to_client(response)
+                else:
+                    write_all(server[1], memoryview(header + body))
+        except OSError:
+            pass
+        finally:
+            os.close(server[1])
+
+    def responses() -> None:
+        reader = FrameReader(server[0])
+        try:
+            while True:
+                frame = reader.read()
+                if not frame:
+                    break
+                ty, tag, header, body = frame
+                proxy.response(ty, tag, body)
+                to_client(header + body)
+        except OSError:
+            pass
+        finally:
+            with client_lock:
+                os.close(client[1])
+
+    threads = [threading.Thread(target=requests), threading.Thread(target=responses)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=60,
+        help="seconds what is learned about a file is trusted for "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=256,
+        help="MiB of responses cached at most (default %(default)s)",
+    )
+    parser.add_argument(
+        "--server-fds",
+        type=int,
+        nargs=2,
+        metavar=("READFD", "WRITEFD"),
+        help="file descriptors the server is connected to",
+    )
+    parser.add_argument(
+        "command",
+        nargs="*",
+        help="the server to run, connected to through its standard input "
+        "and output, e.g. -- qfsd 0 1 /folder",
+    )
+    args = parser.parse_args()
+
+    try:
+        server, p = connect(args.command, args.server_fds)
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_USAGE
+
+    serve((0, 1), server, Proxy(args.size * 1024 * 1024, args.ttl))
+    return p.wait() if p else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
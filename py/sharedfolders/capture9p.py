@@ -0,0 +1,546 @@
+#!/usr/bin/python3
+
+"""Capture the 9P traffic of a mount, and report on it.
+
+The recorder sits between the kernel and qfsd, passing every byte along
+and noting the header of every frame, when it was seen, and the first
+bytes of its body in a capture file.  Nothing is decoded while the mount
+is in use; the report is made from the capture afterwards:
+
+    python3 -m sharedfolders.capture9p record CAPTURE -- qfsd 0 1 /folder
+    python3 -m sharedfolders.capture9p report CAPTURE
+
+qvm-mount-folder --capture CAPTURE records the traffic of the folder it
+mounts, until it is unmounted.
+
+The report lists, for every kind of request, how many were made, how
+many bytes they moved, and how long their responses took, timed from
+when the start of the request was seen until the start of its response
+was.  It also lists the
+longest chains of requests the client made one at a time, each waiting
+for the response to the previous one.  A slow workload made of long
+chains of fast requests is slow because of how the client asks for
+things; one made of slow requests is slow because of the server.
+"""
+
+import argparse
+import errno
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+
+MAGIC = b"9PCAP\x00\x01\n"
+
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+
+# size[4] type[1] tag[2]
+HEADER = struct.Struct("<IBH")
+# time[8] direction[1] size[4] type[1] tag[2] prefix length[2], followed
+# by as many bytes of the body of the frame.
+RECORD = struct.Struct("<qBIBHH")
+# How much of the body of every frame is kept: enough for the fixed
+# fields of every request, and for the first names of a Twalk.
+PREFIX = 64
+
+# Bytes read at a time, the size of the rest of a frame past which it is
+# spliced instead, and bytes of records kept before they are written to
+# the capture.
+RELAY_BUFFER_SIZE = 64 * 1024
+SPLICE_THRESHOLD = 16 * 1024
+CAPTURE_BUFFER_SIZE = 1024 * 1024
+
+RLERROR = 7
+TREAD = 116
+TWRITE = 118
+TREADDIR = 40
+
+OPERATIONS = {
+    8: "statfs",
+    12: "lopen",
+    14: "lcreate",
+    16: "symlink",
+    18: "mknod",
+    20: "rename",
+    22: "readlink",
+    24: "getattr",
+    26: "setattr",
+    30: "xattrwalk",
+    32: "xattrcreate",
+    40: "readdir",
+    50: "fsync",
+    52: "lock",
+    54: "getlock",
+    70: "link",
+    72: "mkdir",
+    74: "renameat",
+    76: "unlinkat",
+    100: "version",
+    102: "auth",
+    104: "attach",
+    108: "flush",
+    110: "walk",
+    116: "read",
+    118: "write",
+    120: "clunk",
+    122: "remove",
+}
+
+
+class Recorder(object):
+    """Finds the frames in the bytes going one way, and records them.
+
+    Bytes are fed as they are relayed, in chunks that need not start or
+    end at frame boundaries."""
+
+    def __init__(self, capture: BinaryIO, direction: int):
+        self.capture = capture
+        self.direction = direction
+        # The start of the frame being received, up to its prefix.
+        self.head = bytearray()
+        self.wanted = 4
+        self.started = 0
+        # Bytes of the frame being received past its prefix.
+        self.skip = 0
+        self.broken = False
+
+    def feed(self, data: memoryview, timestamp: int) -> None:
+        pos, end = 0, len(data)
+        while pos < end and not self.broken:
+            if self.skip:
+                n = min(self.skip, end - pos)
+                self.skip -= n
+                pos += n
+                continue
+            if not self.head:
+                self.started = timestamp
+            n = min(self.wanted - len(self.head), end - pos)
+            self.head += data[pos : pos + n]
+            pos += n
+            if len(self.head) < self.wanted:
+                continue
+            if self.wanted == 4:
+                size = struct.unpack_from("<I", self.head)[0]
+                if size < HEADER.size:
+                    # Not 9P.  Keep relaying, but stop recording.
+                    self.broken = True
+                    return
+                self.wanted = min(size, HEADER.size + PREFIX)
+                continue
+            size, ty, tag = HEADER.unpack_from(self.head)
+            prefix = self.head[HEADER.size :]
+            self.capture.write(
+                RECORD.pack(self.started, self.direction, size, ty, tag, len(prefix))
+                + prefix
+            )
+            self.skip = size - len(self.head)
+            self.head = bytearray()
+            self.wanted = 4
+
+
+def write_all(fd: int, data: memoryview) -> None:
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def pump(src: int, dst: int, recorder: Recorder) -> None:
+    """Relay bytes from src to dst until src reaches end of file, then
+    close dst so the other side sees it too.
+
+    Only the start of every frame is read, and the rest of large ones,
+    like the data of reads and writes, is spliced along without being
+    copied, when the descriptors allow it."""
+    buf = bytearray(RELAY_BUFFER_SIZE)
+    view = memoryview(buf)
+    splice = True
+    try:
+        while True:
+            if splice and recorder.skip >= SPLICE_THRESHOLD:
+                try:
+                    n = os.splice(src, dst, recorder.skip)
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        break
+                    splice = False
+                    continue
+                if not n:
+                    break
+                recorder.skip -= n
+                continue
+            try:
+                n = os.readv(src, [buf])
+            except OSError:
+                break
+            if not n:
+                break
+            timestamp = time.monotonic_ns()
+            try:
+                write_all(dst, view[:n])
+            except OSError:
+                break
+            recorder.feed(view[:n], timestamp)
+    finally:
+        os.close(dst)
+
+
+def relay(client: Tuple[int, int], server: Tuple[int, int], capture: BinaryIO) -> None:
+    """Relay the traffic between the client and the server, each given
+    as the file descriptors to read from and write to, recording it."""
+    capture.write(MAGIC)
+    threads = [
+        threading.Thread(
+            target=pump,
+            args=(client[0], server[1], Recorder(capture, CLIENT_TO_SERVER)),
+        ),
+        threading.Thread(
+            target=pump,
+            args=(server[0], client[1], Recorder(capture, SERVER_TO_CLIENT)),
+        ),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    capture.flush()
+
+
+class Record(NamedTuple):
+    time: int
+    direction: int
+    size: int
+    type: int
+    tag: int
+    prefix: bytes
+
+
+def interpose(
+    arguments: List[str], server_read: int, server_write: int
+) -> Tuple[int, int]:
+    """Start a relay between the client and the server connected to the
+    given file descriptors, in a process of its own, and return the file
+    descriptors the client should read from and write to instead.  The
+    relay is run with python3 -m and the arguments, followed by
+    --server-fds."""
+    client_read, relay_write = os.pipe2(0)
+    relay_read, client_write = os.pipe2(0)
+    subprocess.Popen(
+        [sys.executable, "-m"]
+        + arguments
+        + ["--server-fds", str(server_read), str(server_write)],
+        stdin=relay_read,
+        stdout=relay_write,
+        pass_fds=(server_read, server_write),
+        close_fds=True,
+    )
+    os.close(relay_read)
+    os.close(relay_write)
+    return client_read, client_write
+
+
+def connect(
+    command: List[str], server_fds: Optional[List[int]]
+) -> Tuple[Tuple[int, int], Optional["subprocess.Popen[bytes]"]]:
+    """Return the file descriptors to read from and write to the server,
+    either those given, or those of the command, which is started, and
+    returned as well."""
+    if command[:1] == ["--"]:
+        command = command[1:]
+    if bool(command) == bool(server_fds):
+        raise ValueError("give either --server-fds or a command to run")
+    if server_fds:
+        return (server_fds[0], server_fds[1]), None
+    command_read, server_write = os.pipe2(0)
+    server_read, command_write = os.pipe2(0)
+    p = subprocess.Popen(command, stdin=command_read, stdout=command_write)
+    os.close(command_read)
+    os.close(command_write)
+    return (server_read, server_write), p
+
+
+def read_capture(path: str) -> List[Record]:
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a 9P capture" % path)
+        data = f.read()
+    pos = 0
+    while pos + RECORD.size <= len(data):
+        time_ns, direction, size, ty, tag, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        prefix = data[pos : pos + length]
+        pos += length
+        records.append(Record(time_ns, direction, size, ty, tag, prefix))
+    records.sort(key=lambda r: r.time)
+    return records
+
+
+class Exchange(NamedTuple):
+    """A request, and its response if one was captured."""
+
+    operation: str
+    sent: int
+    received: Optional[int]
+    wire_bytes: int
+    data_bytes: int
+    error: bool
+
+
+def data_bytes(request: Record, response: Record) -> int:
+    """Return the bytes of file data a request and its response moved."""
+    # Twrite carries fid[4] offset[8] count[4], and Rread and Rreaddir
+    # start with count[4].
+    if response.type == RLERROR:
+        return 0
+    if request.type == TWRITE and len(request.prefix) >= 16:
+        count: int = struct.unpack_from("<I", request.prefix, 12)[0]
+        return count
+    if request.type in (TREAD, TREADDIR) and len(response.prefix) >= 4:
+        count = struct.unpack_from("<I", response.prefix)[0]
+        return count
+    return 0
+
+
+def exchanges(records: Sequence[Record]) -> List[Exchange]:
+    """Pair every request with its response, in the order they were
+    sent."""
+    pending: Dict[int, Record] = {}
+    result = []
+    for record in records:
+        if record.direction == CLIENT_TO_SERVER:
+            old = pending.pop(record.tag, None)
+            if old:
+                result.append(unanswered(old))
+            pending[record.tag] = record
+            continue
+        request = pending.pop(record.tag, None)
+        if not request:
+            continue
+        result.append(
+            Exchange(
+                OPERATIONS.get(request.type, "type %d" % request.type),
+                request.time,
+                record.time,
+                request.size + record.size,
+                data_bytes(request, record),
+                record.type == RLERROR,
+            )
+        )
+    result.extend(unanswered(r) for r in pending.values())
+    result.sort(key=lambda x: x.sent)
+    return result
+
+
+def unanswered(request: Record) -> Exchange:
+    return Exchange(
+        OPERATIONS.get(request.type, "type %d" % request.type),
+        request.time,
+        None,
+        request.size,
+        0,
+        False,
+    )
+
+
+class Chain(NamedTuple):
+    exchanges: List[Exchange]
+
+    @property
+    def duration(self) -> int:
+        last = self.exchanges[-1]
+        return (last.received or last.sent) - self.exchanges[0].sent
+
+    @property
+    def server_time(self) -> int:
+        return sum(x.received - x.sent for x in self.exchanges if x.received)
+
+
+def serial_chains(xs: Sequence[Exchange]) -> List[Chain]:
+    """Split the exchanges into chains of requests that were each sent
+    after every earlier request was answered."""
+    chains: List[Chain] = []
+    done = 0
+    for x in xs:
+        if not chains or x.sent < done:
+            chains.append(Chain([x]))
+        else:
+            chains[-1].exchanges.append(x)
+        done = max(done, x.received or x.sent)
+    return chains
+
+
+def busy_time(xs: Sequence[Exchange]) -> int:
+    """Return the time at least one request was outstanding."""
+    busy = 0
+    start = end = 0
+    for x in xs:
+        if not x.received:
+            continue
+        if x.sent > end:
+            busy += end - start
+            start = x.sent
+        end = max(end, x.received)
+    return busy + end - start
+
+
+def ms(ns: float) -> str:
+    return "%.3f" % (ns / 1e6)
+
+
+def report(records: Sequence[Record], chains: int) -> List[str]:
+    xs = exchanges(records)
+    if not xs:
+        return ["no requests captured"]
+    lines = []
+
+    duration = max(r.time for r in records) - records[0].time
+    busy = busy_time(xs)
+    lines.append(
+        "%d requests in %s ms; at least one was outstanding %s ms (%.0f%%)"
+        % (len(xs), ms(duration), ms(busy), 100 * busy / duration if duration else 0)
+    )
+    missing = sum(1 for x in xs if x.received is None)
+    if missing:
+        lines.append("%d requests were not answered in the capture" % missing)
+    lines.append("")
+
+    lines.append(
+        "%-12s %8s %7s %12s %12s %10s %10s %10s %10s"
+        % (
+            "operation",
+            "count",
+            "errors",
+            "wire bytes",
+            "data bytes",
+            "median ms",
+            "p90 ms",
+            "p99 ms",
+            "max ms",
+        )
+    )
+    by_op: Dict[str, List[Exchange]] = {}
+    for x in xs:
+        by_op.setdefault(x.operation, []).append(x)
+    for op, ops in sorted(by_op.items(), key=lambda i: -len(i[1])):
+        latencies = sorted(x.received - x.sent for x in ops if x.received)
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p90, p99 = quantiles[89], quantiles[98]
+        else:
+            p90 = p99 = latencies[0] if latencies else 0
+        lines.append(
+            "%-12s %8d %7d %12d %12d %10s %10s %10s %10s"
+            % (
+                op,
+                len(ops),
+                sum(1 for x in ops if x.error),
+                sum(x.wire_bytes for x in ops),
+                sum(x.data_bytes for x in ops),
+                ms(statistics.median(latencies)) if latencies else "-",
+                ms(p90),
+                ms(p99),
+                ms(latencies[-1]) if latencies else "-",
+            )
+        )
+
+    longest = sorted(serial_chains(xs), key=lambda c: -len(c.exchanges))[:chains]
+    if longest and len(longest[0].exchanges) > 1:
+        lines.append("")
+        lines.append("Longest chains of requests made one at a time:")
+        lines.append(
+            "%8s %12s %12s %12s  %s"
+            % ("requests", "total ms", "server ms", "client ms", "operations")
+        )
+        for chain in longest:
+            if len(chain.exchanges) < 2:
+                break
+            counts: Dict[str, int] = {}
+            for x in chain.exchanges:
+                counts[x.operation] = counts.get(x.operation, 0) + 1
+            lines.append(
+                "%8d %12s %12s %12s  %s"
+                % (
+                    len(chain.exchanges),
+                    ms(chain.duration),
+                    ms(chain.server_time),
+                    ms(chain.duration - chain.server_time),
+                    ", ".join(
+                        "%s %d" % (op, n)
+                        for op, n in sorted(counts.items(), key=lambda i: -i[1])
+                    ),
+                )
+            )
+    return lines
+
+
+def record_main(args: argparse.Namespace) -> int:
+    try:
+        server, p = connect(args.command, args.server_fds)
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_USAGE
+
+    with open(args.capture, "wb", buffering=CAPTURE_BUFFER_SIZE) as capture:
+        relay((0, 1), server, capture)
+    return p.wait() if p else 0
+
+
+def report_main(args: argparse.Namespace) -> int:
+    try:
+        records = read_capture(args.capture)
+    except (OSError, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_NOINPUT
+    for line in report(records, args.chains):
+        print(line)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="action", required=True)
+
+    record = commands.add_parser(
+        "record",
+        help="relay 9P between standard input and output and a server, "
+        "recording every frame",
+    )
+    record.add_argument("capture", help="the capture file to write")
+    record.add_argument(
+        "--server-fds",
+        type=int,
+        nargs=2,
+        metavar=("READFD", "WRITEFD"),
+        help="file descriptors the server is connected to",
+    )
+    record.add_argument(
+        "command",
+        nargs="*",
+        help="the server to run, connected to through its standard input "
+        "and output, e.g. -- qfsd 0 1 /folder",
+    )
+    record.set_defaults(func=record_main)
+
+    rep = commands.add_parser("report", help="report on a capture file")
+    rep.add_argument("capture", help="the capture file to read")
+    rep.add_argument(
+        "--chains",
+        type=int,
+        default=5,
+        help="how many of the longest chains of serial requests to list "
+        "(default %(default)s)",
+    )
+    rep.set_defaults(func=report_main)
+
+    args = parser.parse_args()
+    ret: int = args.func(args)
+    return ret
+
+
+if __name__ == "__main__":
+    sys.exit(main())
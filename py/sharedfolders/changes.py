@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+"""Drop what this qube caches about files that change in the qube sharing them.
+
+9P has no way to tell a client that a file changed, so a folder mounted
+with a cache mode keeps returning what the client qube cached of its
+files.  qvm-mount-folder --watch asks the qube that shares the folder
+for the changes made to its files, which qfsd --watch reports over a
+connection of their own, and hands them to this program:
+
+    python3 -m sharedfolders.changes MOUNTPOINT < changes
+
+The cached pages of a file that changed are dropped with
+posix_fadvise(POSIX_FADV_DONTNEED).  The kernel cannot be asked to drop
+the attributes and directory entries of particular files, so once files
+or directories changed, the dentries and inodes not in use are dropped
+through /proc/sys/vm/drop_caches, at most once per interval.  When
+changes were lost, the page cache is dropped as well.
+
+The program runs until the folder is unmounted or the server qube closes
+the connection.
+"""
+
+import argparse
+import logging
+import os
+import select
+import stat
+import subprocess
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+# The kinds of the records qfsd --watch reports.  Every record is a kind,
+# the path of the file relative to the folder, and a nul byte.
+CHANGED = ord("C")
+ENTRIES = ord("D")
+EVERYTHING = ord("*")
+
+# What /proc/sys/vm/drop_caches is asked to drop.
+DROP_PAGES = 1
+DROP_DENTRIES_AND_INODES = 2
+DROP_ALL = DROP_PAGES | DROP_DENTRIES_AND_INODES
+
+# How often the program checks whether the folder is still mounted.
+CHECK_INTERVAL = 5.0
+
+Change = Tuple[int, bytes]
+
+
+class Records(object):
+    """Splits the records read from the server qube, which may come in
+    any number of pieces."""
+
+    def __init__(self) -> None:
+        self.rest = b""
+
+    def feed(self, data: bytes) -> List[Change]:
+        records = (self.rest + data).split(b"\0")
+        self.rest = records.pop()
+        return [(r[0], r[1:]) for r in records if r]
+
+
+def drop_caches(level: int) -> None:
+    """Ask the kernel to drop the caches given by level, as root."""
+    logger = logging.getLogger("changes")
+    value = b"%d\n" % level
+    try:
+        if os.getuid() == 0:
+            with open("/proc/sys/vm/drop_caches", "wb") as f:
+                f.write(value)
+            return
+        subprocess.run(
+            ["/usr/bin/sudo", "-n", "/usr/bin/tee", "/proc/sys/vm/drop_caches"],
+            input=value,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Cannot drop caches: %s", e)
+
+
+class Invalidator(object):
+    """Drops what is cached about the files of a mount as they change."""
+
+    def __init__(
+        self,
+        mountpoint: str,
+        interval: float,
+        drop: Callable[[int], None] = drop_caches,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.mountpoint = os.fsencode(mountpoint)
+        self.dev = os.stat(self.mountpoint).st_dev
+        self.interval = interval
+        self.drop = drop
+        self.clock = clock
+        # What is to be dropped from the caches of the kernel, and when
+        # that was last done.
+        self.pending = 0
+        self.dropped = -interval
+
+    def mounted(self) -> bool:
+        try:
+            return os.stat(self.mountpoint).st_dev == self.dev
+        except OSError:
+            return False
+
+    def drop_pages(self, path: bytes) -> bool:
+        """Drop the cached pages of the file at path, relative to the
+        mountpoint.  Return whether it is a file of the mount that they
+        were dropped for."""
+        # The paths come from the other qube, and must not lead anywhere
+        # else.
+        if path.startswith(b"/") or b".." in path.split(b"/"):
+            return False
+        full = os.path.join(self.mountpoint, path)
+        try:
+            st = os.lstat(full)
+            if not stat.S_ISREG(st.st_mode) or st.st_dev != self.dev:
+                return False
+            fd = os.open(full, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except OSError:
+            return False
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
+    def apply(self, changes: List[Change]) -> None:
+        for kind, path in changes:
+            if kind == EVERYTHING:
+                self.pending |= DROP_ALL
+                continue
+            if kind == CHANGED:
+                self.drop_pages(path)
+            # Attributes and directory entries are cached with the inodes
+            # and dentries.
+            self.pending |= DROP_DENTRIES_AND_INODES
+
+    def flush(self) -> Optional[float]:
+        """Drop what is pending if the interval passed since the last
+        time, and return how long until it can be dropped otherwise."""
+        if not self.pending:
+            return None
+        wait = self.dropped + self.interval - self.clock()
+        if wait > 0:
+            return wait
+        self.drop(self.pending)
+        self.pending = 0
+        self.dropped = self.clock()
+        return None
+
+
+def follow(fd: int, invalidator: Invalidator) -> None:
+    """Act on the changes read from fd until it ends or the folder is
+    unmounted."""
+    records = Records()
+    while True:
+        wait = invalidator.flush()
+        timeout = CHECK_INTERVAL if wait is None else min(wait, CHECK_INTERVAL)
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not invalidator.mounted():
+            return
+        if ready:
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                return
+            invalidator.apply(records.feed(data))
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO if os.getenv("DEBUG") else logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="seconds between drops of the caches of the kernel "
+        "(default %(default)s)",
+    )
+    parser.add_argument("mountpoint", help="where the folder is mounted")
+    args = parser.parse_args()
+
+    try:
+        invalidator = Invalidator(args.mountpoint, args.interval)
+    except OSError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_NOINPUT
+    follow(0, invalidator)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,507 @@
+#!/usr/bin/python3
+
+"""Carry the 9P sessions of several mounts over one connection to qfsd.
+
+Every mount made by qvm-mount-folder makes a qrexec connection of its
+own, which starts a qfsd of its own in the qube sharing the folder.
+With qvm-mount-folder --multiplex, the mounts of folders of the same
+qube share the connection the first of them made, and the qfsd it
+started serves all of them, asking dom0 whether the client qube may
+mount each folder when its mount attaches to it.
+
+The multiplexer runs in the client qube, and takes the sessions of new
+mounts as file descriptors passed over a socket:
+
+    python3 -m sharedfolders.mux9p --listen-fd FD -- qfsd 0 1 /folder
+
+Every request of a session is sent to qfsd with a tag the multiplexer
+allocates, and with the fids it names moved to a range of fids of the
+session, so that the requests of different sessions do not collide.
+The version is negotiated with qfsd once, and Tversion requests of the
+sessions are answered by the multiplexer.  When a session ends, the fids
+it left open are clunked.  The multiplexer exits once every session has
+ended, or when the connection to qfsd is lost.
+"""
+
+import argparse
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sharedfolders.cache9p import (
+    FrameReader,
+    TATTACH,
+    TAUTH,
+    TCLUNK,
+    TFLUSH,
+    TFSYNC,
+    TGETATTR,
+    TGETLOCK,
+    TLCREATE,
+    TLOCK,
+    TLOPEN,
+    TREAD,
+    TREADDIR,
+    TREADLINK,
+    TREMOVE,
+    TSTATFS,
+    TVERSION,
+    TWALK,
+    TXATTRWALK,
+)
+from sharedfolders.capture9p import HEADER, RLERROR, TWRITE, connect, write_all
+
+
+TSYMLINK = 16
+TMKNOD = 18
+TRENAME = 20
+TSETATTR = 26
+TXATTRCREATE = 32
+TLINK = 70
+TMKDIR = 72
+TRENAMEAT = 74
+TUNLINKAT = 76
+
+# The offsets of the fids in the requests that name any.  Trenameat
+# names a second one after a name, and is handled apart.
+FIDS = {
+    TSTATFS: (0,),
+    TLOPEN: (0,),
+    TLCREATE: (0,),
+    TSYMLINK: (0,),
+    TMKNOD: (0,),
+    TRENAME: (0, 4),
+    TREADLINK: (0,),
+    TGETATTR: (0,),
+    TSETATTR: (0,),
+    TXATTRWALK: (0, 4),
+    TXATTRCREATE: (0,),
+    TREADDIR: (0,),
+    TFSYNC: (0,),
+    TLOCK: (0,),
+    TGETLOCK: (0,),
+    TLINK: (0, 4),
+    TMKDIR: (0,),
+    TRENAMEAT: (0,),
+    TUNLINKAT: (0,),
+    TAUTH: (0,),
+    TATTACH: (0, 4),
+    TWALK: (0, 4),
+    TREAD: (0,),
+    TWRITE: (0,),
+    TCLUNK: (0,),
+    TREMOVE: (0,),
+}
+
+NOTAG = 0xFFFF
+NOFID = 0xFFFFFFFF
+
+# Every session gets the fids with its slot in the high bits.  The
+# kernel numbers the fids of a mount from zero up, and only needs as
+# many as it has files open and walked to at a time.
+FID_BITS = 24
+SLOTS = (NOFID >> FID_BITS) - 1
+
+# The largest message the kernel accepts over file descriptors.
+MSIZE = 1024 * 1024
+
+VERSION = "9P2000.L"
+
+
+def string(s: bytes) -> bytes:
+    return struct.pack("<H", len(s)) + s
+
+
+class Session(object):
+    """A mount whose session is carried over the connection."""
+
+    def __init__(self, slot: int, fd: int):
+        self.slot = slot
+        self.fd = fd
+        # The fids the server knows the session by, and the tags of its
+        # requests being served, with the tags they were sent with.
+        self.fids: Set[int] = set()
+        self.tags: Dict[int, int] = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def fid(self, fid: int) -> int:
+        """Return the fid the server knows fid of the session by."""
+        if fid == NOFID:
+            return fid
+        if fid >> FID_BITS:
+            raise ValueError(fid)
+        return self.slot << FID_BITS | fid
+
+    def send(self, ty: int, tag: int, body: bytes) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                write_all(
+                    self.fd,
+                    memoryview(HEADER.pack(HEADER.size + len(body), ty, tag) + body),
+                )
+            except OSError:
+                pass
+
+    def error(self, tag: int, code: int) -> None:
+        self.send(RLERROR, tag, struct.pack("<I", code))
+
+
+class Pending(NamedTuple):
+    """A request sent to the server, and what to do with its response."""
+
+    session: Session
+    tag: int
+    type: int
+    # The fid the request creates, if any, and the number of names a
+    # Twalk walks.
+    newfid: Optional[int] = None
+    names: int = 0
+    # The tag a Tflush flushes.
+    oldtag: Optional[int] = None
+    # Whether the request was flushed, and its response is not awaited.
+    flushed: bool = False
+
+
+class Multiplexer(object):
+    """Sends the requests of every session to the server, and the
+    responses of the server to the sessions that made the requests."""
+
+    def __init__(self, server_write: int, msize: int):
+        self.server_write = server_write
+        self.msize = msize
+        self.lock = threading.Lock()
+        self.server_lock = threading.Lock()
+        self.sessions: Dict[int, Session] = {}
+        self.pending: Dict[int, Pending] = {}
+        self.tags = list(range(NOTAG - 1, -1, -1))
+        self.served = 0
+        self.closing = False
+        self.done = threading.Event()
+
+    def add(self, fd: int) -> Optional[Session]:
+        """Return a new session reading and writing fd, or None if there
+        is no room for it or the multiplexer is exiting."""
+        with self.lock:
+            if self.closing:
+                return None
+            # The slots of sessions whose requests are still being
+            # served are not reused.
+            busy = set(self.sessions) | {p.session.slot for p in self.pending.values()}
+            for slot in range(SLOTS):
+                if slot not in busy:
+                    session = self.sessions[slot] = Session(slot, fd)
+                    self.served += 1
+                    return session
+            return None
+
+    def send(self, frames: List[bytes]) -> None:
+        """Send requests to the server.  Never called with the lock held,
+        as the server may wait for its responses to be read before it
+        reads more requests."""
+        with self.server_lock:
+            for frame in frames:
+                write_all(self.server_write, memoryview(frame))
+
+    def forward(self, ty: int, body: bytes, pending: Pending) -> Optional[bytes]:
+        """Return the frame of a request to send to the server with a tag
+        of its own, or None if no tag is left.  Must be called with the
+        lock held."""
+        if not self.tags:
+            return None
+        tag = self.tags.pop()
+        self.pending[tag] = pending
+        if pending.tag != NOTAG:
+            pending.session.tags[pending.tag] = tag
+        return HEADER.pack(HEADER.size + len(body), ty, tag) + body
+
+    def clunk(self, session: Session, fid: int) -> List[bytes]:
+        """Return the request clunking a fid the session cannot clunk any
+        more.  Must be called with the lock held."""
+        frame = self.forward(
+            TCLUNK, struct.pack("<I", fid), Pending(session, NOTAG, TCLUNK)
+        )
+        return [frame] if frame else []
+
+    def request(self, session: Session, ty: int, tag: int, body: bytes) -> None:
+        """Handle a request of a session."""
+        if ty == TVERSION:
+            msize, length = struct.unpack_from("<IH", body)
+            requested = body[6 : 6 + length]
+            version = VERSION if requested == VERSION.encode() else "unknown"
+            session.send(
+                ty + 1,
+                tag,
+                struct.pack("<I", min(msize, self.msize)) + string(version.encode()),
+            )
+            return
+
+        with self.lock:
+            if ty == TFLUSH:
+                (oldtag,) = struct.unpack_from("<H", body)
+                flushed = session.tags.get(oldtag)
+                if flushed is None:
+                    frame = None
+                else:
+                    frame = self.forward(
+                        ty,
+                        struct.pack("<H", flushed),
+                        Pending(session, tag, ty, oldtag=flushed),
+                    )
+                    if not frame:
+                        # Answering the flush first lets the client go on.
+                        flushed = None
+            else:
+                try:
+                    body = self.rewrite(session, ty, body)
+                except (ValueError, struct.error):
+                    session.error(tag, errno.EMFILE)
+                    return
+
+                newfid = None
+                names = 0
+                if ty in (TATTACH, TWALK, TXATTRWALK):
+                    offset = 0 if ty == TATTACH else 4
+                    (newfid,) = struct.unpack_from("<I", body, offset)
+                    if ty == TWALK:
+                        (names,) = struct.unpack_from("<H", body, 8)
+                elif ty in (TCLUNK, TREMOVE):
+                    # The fid is clunked even if the request fails.
+                    session.fids.discard(struct.unpack_from("<I", body)[0])
+                frame = self.forward(ty, body, Pending(session, tag, ty, newfid, names))
+
+        if frame:
+            self.send([frame])
+        elif ty == TFLUSH:
+            session.send(ty + 1, tag, b"")
+        else:
+            session.error(tag, errno.EAGAIN)
+
+    def rewrite(self, session: Session, ty: int, body: bytes) -> bytes:
+        """Return the body of a request with the fids it names replaced
+        with those the server knows them by."""
+        offsets: List[int] = list(FIDS.get(ty, ()))
+        if ty == TRENAMEAT:
+            (length,) = struct.unpack_from("<H", body, 4)
+            offsets.append(6 + length)
+        b = bytearray(body)
+        for offset in offsets:
+            (fid,) = struct.unpack_from("<I", b, offset)
+            struct.pack_into("<I", b, offset, session.fid(fid))
+        return bytes(b)
+
+    def response(self, ty: int, tag: int, body: bytes) -> None:
+        """Handle a response of the server."""
+        clunks: List[bytes] = []
+        with self.lock:
+            p = self.pending.pop(tag, None)
+            if p is None:
+                return
+            self.tags.append(tag)
+            if p.session.tags.get(p.tag) == tag:
+                del p.session.tags[p.tag]
+
+            created = None
+            if ty != RLERROR and p.newfid is not None:
+                if p.type != TWALK:
+                    created = p.newfid
+                else:
+                    # Only walks to every name given create the new fid.
+                    (walked,) = struct.unpack_from("<H", body)
+                    if walked == p.names:
+                        created = p.newfid
+            if p.type == TFLUSH and p.oldtag is not None:
+                # The session forgets the request flushed, and may use its
+                # tag again, so a response to it that comes later is
+                # dropped.
+                flushed = self.pending.get(p.oldtag)
+                if flushed:
+                    self.pending[p.oldtag] = flushed._replace(flushed=True)
+                    if p.session.tags.get(flushed.tag) == p.oldtag:
+                        del p.session.tags[flushed.tag]
+
+            deliver = not (p.session.closed or p.flushed)
+            if created is not None:
+                if deliver:
+                    p.session.fids.add(created)
+                else:
+                    clunks = self.clunk(p.session, created)
+
+        if clunks:
+            self.send(clunks)
+        if deliver and p.tag != NOTAG:
+            p.session.send(ty, p.tag, body)
+
+    def close(self, session: Session) -> None:
+        """End a session, clunking the fids it left open."""
+        clunks: List[bytes] = []
+        with self.lock:
+            with session.lock:
+                session.closed = True
+                os.close(session.fd)
+            del self.sessions[session.slot]
+            for fid in sorted(session.fids):
+                clunks += self.clunk(session, fid)
+            session.fids.clear()
+            if not self.sessions:
+                self.closing = True
+        try:
+            self.send(clunks)
+        except OSError:
+            pass
+        if self.closing:
+            self.done.set()
+
+    def lost(self) -> None:
+        """End every session, as the server is gone."""
+        with self.lock:
+            self.closing = True
+            for session in self.sessions.values():
+                with session.lock:
+                    if not session.closed:
+                        session.closed = True
+                        # The kernel reads from the file descriptor it was
+                        # given, which is another reference to the socket.
+                        socket.socket(fileno=os.dup(session.fd)).shutdown(
+                            socket.SHUT_RDWR
+                        )
+        self.done.set()
+
+
+def negotiate(server: Tuple[int, int], msize: int) -> int:
+    """Negotiate the version with the server, and return the largest
+    message size it accepts."""
+    body = struct.pack("<I", msize) + string(VERSION.encode())
+    write_all(
+        server[1],
+        memoryview(HEADER.pack(HEADER.size + len(body), TVERSION, NOTAG) + body),
+    )
+    # Nothing else is sent by the server until more is asked of it.
+    reader = FrameReader(os.dup(server[0]))
+    frame = reader.read()
+    reader.f.close()
+    if not frame or frame[0] != TVERSION + 1:
+        raise OSError(errno.EPROTO, "the server did not negotiate the version")
+    (accepted,) = struct.unpack_from("<I", frame[3])
+    return int(accepted)
+
+
+def serve_session(mux: Multiplexer, session: Session) -> None:
+    reader = FrameReader(os.dup(session.fd))
+    try:
+        while True:
+            frame = reader.read()
+            if not frame:
+                break
+            ty, tag, _, body = frame
+            mux.request(session, ty, tag, body)
+    except OSError:
+        pass
+    finally:
+        reader.f.close()
+        mux.close(session)
+
+
+def serve_server(mux: Multiplexer, server_read: int) -> None:
+    reader = FrameReader(server_read)
+    try:
+        while True:
+            frame = reader.read()
+            if not frame:
+                break
+            ty, tag, _, body = frame
+            mux.response(ty, tag, body)
+    except OSError:
+        pass
+    finally:
+        mux.lost()
+
+
+def listen(mux: Multiplexer, listener: socket.socket) -> None:
+    """Take the sessions of new mounts, each a file descriptor passed
+    over a connection to the listening socket, which is answered ok once
+    the session is carried."""
+    while not mux.done.is_set():
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        with conn:
+            try:
+                _, fds, _, _ = socket.recv_fds(conn, 16, 1)
+            except OSError:
+                continue
+            if not fds:
+                continue
+            session = mux.add(fds[0])
+            if session is None:
+                os.close(fds[0])
+                continue
+            threading.Thread(
+                target=serve_session, args=(mux, session), daemon=True
+            ).start()
+            try:
+                conn.sendall(b"ok\n")
+            except OSError:
+                pass
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--listen-fd",
+        type=int,
+        required=True,
+        help="listening Unix socket the sessions of new mounts are passed over",
+    )
+    parser.add_argument(
+        "--msize",
+        type=int,
+        default=MSIZE,
+        help="largest message size negotiated with the server (default %(default)s)",
+    )
+    parser.add_argument(
+        "--server-fds",
+        type=int,
+        nargs=2,
+        metavar=("READFD", "WRITEFD"),
+        help="file descriptors the server is connected to",
+    )
+    parser.add_argument(
+        "command",
+        nargs="*",
+        help="the server to run, connected to through its standard input "
+        "and output, e.g. -- qfsd 0 1 /folder",
+    )
+    args = parser.parse_args()
+
+    try:
+        server, p = connect(args.command, args.server_fds)
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_USAGE
+
+    listener = socket.socket(fileno=args.listen_fd)
+    try:
+        mux = Multiplexer(server[1], negotiate(server, args.msize))
+    except (OSError, struct.error) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return os.EX_PROTOCOL
+    threading.Thread(target=serve_server, args=(mux, server[0]), daemon=True).start()
+    threading.Thread(target=listen, args=(mux, listener), daemon=True).start()
+
+    mux.done.wait()
+    # Mounts that connect from now on start a multiplexer of their own.
+    listener.close()
+    os.close(server[1])
+    return p.wait() if p else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
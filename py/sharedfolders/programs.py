@@ -2,17 +2,62 @@
 
 import base64
 import errno
-import getpass
 import logging
 import os
-import subprocess
 import sys
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
 from sharedfolders import DecisionMatrix, Response, PATH_MAX, valid_path
+from sharedfolders import vm_inventory
+from sharedfolders import service
+
+if TYPE_CHECKING:
+    import argparse
+    import socket
 
 
 VM_NAME_MAX = 64
 
+# Largest 9P message the kernel is asked to negotiate with qfsd.  The fd
+# transport of the kernel caps messages at 1 MiB; the default of the kernel
+# is much smaller, which splits bulk reads and writes into many round trips.
+DEFAULT_MSIZE = 1024 * 1024
+MIN_MSIZE = 4096
+
+# The mount options users may pass on to the kernel, besides cache= and
+# msize=.  The others either configure the transport qvm-mount-folder sets
+# up, or would change how the permissions of the share are enforced.
+CACHE_MODES = ["none", "loose", "fscache", "mmap"]
+FLAG_MOUNT_OPTIONS = [
+    "ro",
+    "rw",
+    "noatime",
+    "relatime",
+    "nodiratime",
+    "nodev",
+    "nosuid",
+    "noexec",
+]
+# Options that undo each other, the last one given winning.
+EXCLUSIVE_MOUNT_OPTIONS = [("ro", "rw"), ("noatime", "relatime")]
+
+# Mount options for kinds of shares.  Files of a share mounted with
+# cache=loose stay in the page cache of the client qube, and are only
+# read from the server qube once, which is safe when nothing changes
+# them while the share is mounted, as in a package mirror.  cache=mmap
+# lets programs map files of the share into memory.
+MOUNT_PROFILES = {
+    "default": "",
+    "static-readonly": "ro,cache=loose,noatime",
+    "mmap": "cache=mmap",
+}
+
+MountOptions = Dict[str, Optional[str]]
+
+# Sent by qvm-mount-folder after the folder it asks dom0 for access to, so
+# that dom0 replies with the response it granted after the fingerprint.
+WITH_RESPONSE = b"with-response"
+
 
 def setup_logging() -> None:
     logging.basicConfig(level=logging.INFO if os.getenv("DEBUG") else logging.WARNING)
@@ -48,6 +93,8 @@ def base_to_str(binarydata: bytes) -> str:
 
 
 def ask_for_authorization(source: str, target: str, folder: str) -> Response:
+    import subprocess
+
     cmd = [
         "/usr/libexec/qvm-authorize-folder-access",
         source,
@@ -64,7 +111,15 @@ def ask_for_authorization(source: str, target: str, folder: str) -> Response:
 
 def AuthorizeFolderAccess() -> int:
     """AuthorizeFolderAccess runs in dom0 and is used by client
-    qubes to request permission to mount other qubes' folders."""
+    qubes to request permission to mount other qubes' folders.
+
+    The request is handed over to the authorization service if it is
+    running, and handled in this process otherwise."""
+    ret = service.call("AuthorizeFolderAccess")
+    return authorize_folder_access() if ret is None else ret
+
+
+def authorize_folder_access() -> int:
     logger = logging.getLogger("AuthorizeFolderAccess")
     setup_logging()
 
@@ -83,12 +138,15 @@ def AuthorizeFolderAccess() -> int:
     if not source:
         return reject("no source VM")
 
-    arguments = sys.stdin.buffer.read(int(PATH_MAX * 130 / 100 + VM_NAME_MAX))
+    arguments = sys.stdin.buffer.read(
+        int(PATH_MAX * 130 / 100 + VM_NAME_MAX) + len(WITH_RESPONSE) + 1
+    )
     sys.stdin.close()
     try:
         base64_target, base64_folder = arguments.split(b"\n")[0:2]
     except (ValueError, IndexError):
         return reject("the arguments were malformed")
+    with_response = arguments.split(b"\n")[2:3] == [WITH_RESPONSE]
 
     try:
         target = base_to_str(base64_target)
@@ -102,9 +160,7 @@ def AuthorizeFolderAccess() -> int:
     except Exception as e:
         return reject(str(e))
 
-    response, fingerprint = DecisionMatrix.load().lookup_prior_authorization(
-        source, target, folder
-    )
+    response, fingerprint = matrix.lookup_prior_authorization(source, target, folder)
     if response:
         logger.info(
             "VM %s has a response already registered for %s:%s: %s (fingerprint: %s)",
@@ -120,6 +176,8 @@ def AuthorizeFolderAccess() -> int:
         )
         # User has never been asked.
         response = ask_for_authorization(source, target, folder)
+        # The folder share manager may have saved changes while the user
+        # was being asked.  If it did not, this load is served from cache.
         fingerprint = DecisionMatrix.load().process_authorization_request(
             source, target, folder, response
         )
@@ -129,6 +187,8 @@ def AuthorizeFolderAccess() -> int:
         return deny()
 
     sys.stdout.write(fingerprint)
+    if with_response:
+        sys.stdout.write("\n%s" % response)
     sys.stdout.close()
     return 0
 
@@ -136,7 +196,15 @@ def AuthorizeFolderAccess() -> int:
 def QueryFolderForAuthorization() -> int:
     """QueryFolderForAuthorization runs in dom0 and is called by server
     qubes to verify that a client qube has been authorized to get access
-    to a folder."""
+    to a folder.
+
+    The request is handed over to the authorization service if it is
+    running, and handled in this process otherwise."""
+    ret = service.call("QueryFolderForAuthorization")
+    return query_folder_for_authorization() if ret is None else ret
+
+
+def query_folder_for_authorization() -> int:
     logger = logging.getLogger("QueryFolderForAuthorization")
     setup_logging()
 
@@ -158,15 +226,24 @@ def QueryFolderForAuthorization() -> int:
     # Read the requested folder from the caller.  The caller is NOT
     # the VM which wants to mount the folder -- it is rather the
     # server VM that has the desired folder to be mounted.
-    requested_folder_encoded = sys.stdin.buffer.read()
+    # A second line, if any, names the client qube, which the server
+    # qube passes along when the fingerprint did not come through a
+    # qrexec call of the client qube the policy allowed.
+    lines = sys.stdin.buffer.read().split(b"\n")
     try:
-        requested_folder = base_to_str(requested_folder_encoded)
+        requested_folder = base_to_str(lines[0])
         if not valid_path(requested_folder):
             raise ValueError(requested_folder)
     except Exception:
         return reject(
             "the requested folder is malformed, is not a proper absolute path, or has invalid characters"
         )
+    client = None
+    if len(lines) > 1 and lines[1]:
+        try:
+            client = base_to_str(lines[1])
+        except Exception:
+            return reject("the client qube could not be decoded")
 
     # Look up the folder in the authorization database.  If the
     # requested folder is exactly or is a subfolder of any of the
@@ -176,7 +253,17 @@ def QueryFolderForAuthorization() -> int:
         fingerprint,
         requested_folder,
     )
-    folder = DecisionMatrix.load().lookup_decision_folder(fingerprint, requested_folder)
+    if client is None:
+        folder = DecisionMatrix.load().lookup_decision_folder(
+            fingerprint, requested_folder
+        )
+    else:
+        folder = DecisionMatrix.load().lookup_decision_folder(
+            fingerprint,
+            requested_folder,
+            client,
+            os.getenv("QREXEC_REMOTE_DOMAIN"),
+        )
     if not folder:
         return deny()
 
@@ -185,40 +272,488 @@ def QueryFolderForAuthorization() -> int:
     return 0
 
 
+def AuthorizationService() -> int:
+    """AuthorizationService runs in dom0 and handles AuthorizeFolderAccess
+    and QueryFolderForAuthorization requests on behalf of their qrexec
+    services, keeping the policy database loaded between requests."""
+    setup_logging()
+
+    def refresh() -> None:
+        # Requests run in children of this process, and find the policy
+        # database and the list of qubes already loaded in the caches
+        # they inherit.
+        DecisionMatrix.load()
+        vm_inventory.names()
+
+    return service.serve(
+        {
+            "AuthorizeFolderAccess": authorize_folder_access,
+            "QueryFolderForAuthorization": query_folder_for_authorization,
+        },
+        refresh,
+    )
+
+
+def parse_mount_options(
+    text: str, options: Optional[MountOptions] = None
+) -> MountOptions:
+    """Add the comma-separated mount options in text to options, and
+    return them.  Raise ValueError if an option may not be passed on to
+    the kernel."""
+    options = dict(options or {})
+    for option in text.split(","):
+        if not option:
+            continue
+        name, sep, value = option.partition("=")
+        if name in FLAG_MOUNT_OPTIONS and not sep:
+            for exclusive in EXCLUSIVE_MOUNT_OPTIONS:
+                if name in exclusive:
+                    for other in exclusive:
+                        options.pop(other, None)
+            options[name] = None
+        elif name == "cache" and value in CACHE_MODES:
+            options[name] = value
+        elif name == "msize":
+            if not value.isdigit() or int(value) < MIN_MSIZE:
+                raise ValueError("msize must be at least %s" % MIN_MSIZE)
+            options[name] = value
+        else:
+            raise ValueError("unsupported mount option %s" % option)
+    return options
+
+
+def mount_options(
+    uid: int,
+    gid: int,
+    username: str,
+    aname: str,
+    msize: int,
+    options: Optional[MountOptions] = None,
+) -> str:
+    """Return the options to mount a 9P file system served over stdin/stdout."""
+    extra = "".join(
+        "," + name if value is None else ",%s=%s" % (name, value)
+        for name, value in (options or {}).items()
+    )
+    return (
+        "trans=fd,rfdno=%s,wfdno=%s,version=9p2000.L,msize=%s%s,"
+        "dfltuid=%s,dfltgid=%s,uname=%s,aname=%s"
+        % (0, 1, msize, extra, uid, gid, username, aname)
+    )
+
+
+def mount_folder_parser() -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="qvm-mount-folder", description="Mount a folder shared by another qube."
+    )
+    parser.add_argument(
+        "vm", metavar="VM", nargs="?", help="qube that shares the folder"
+    )
+    parser.add_argument(
+        "source", metavar="FOLDER", nargs="?", help="folder from the qube"
+    )
+    parser.add_argument(
+        "target", metavar="MOUNTPOINT", nargs="?", help="where to mount it"
+    )
+    parser.add_argument(
+        "--from-file",
+        metavar="FILE",
+        help="mount the folders listed in FILE at the same time instead; every "
+        "line of it is the VM, FOLDER and MOUNTPOINT of a mount, followed by "
+        "options for it, and options given here apply to all of them",
+    )
+    parser.add_argument(
+        "--msize",
+        type=int,
+        help="maximum 9P message size in bytes, at least %s (default %s)"
+        % (MIN_MSIZE, DEFAULT_MSIZE),
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(MOUNT_PROFILES),
+        default="default",
+        help="mount options for a kind of share: static-readonly mounts it "
+        "read-only and caches its files in this qube, for shares that do not "
+        "change while mounted; mmap lets programs map its files into memory "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        choices=CACHE_MODES,
+        help="how files of the share are cached in this qube",
+    )
+    parser.add_argument(
+        "--read-only", action="store_true", help="mount the share read-only"
+    )
+    parser.add_argument(
+        "-o",
+        dest="options",
+        action="append",
+        default=[],
+        metavar="OPTIONS",
+        help="comma-separated mount options to add to those of the profile; "
+        "cache=MODE, msize=BYTES and %s are supported" % ", ".join(FLAG_MOUNT_OPTIONS),
+    )
+    parser.add_argument(
+        "--cache-proxy",
+        type=float,
+        metavar="SECONDS",
+        help="answer repeated requests for attributes, directory entries and "
+        "file data from a cache in this qube, trusting what it learned about a "
+        "file for SECONDS; for shares that are read-only or rarely change",
+    )
+    parser.add_argument(
+        "--multiplex",
+        action="store_true",
+        help="mount the folder over the connection to the qube that other "
+        "mounts made with --multiplex share, making it if there is none, so "
+        "that one qfsd serves all of them",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="have the qube that shares the folder report changes made to its "
+        "files, and drop what this qube caches about them; for mounts with a "
+        "cache mode, and folders that access was granted to permanently",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="FILE",
+        help="record the 9P traffic of the mount to FILE, until it is unmounted; "
+        "python3 -m sharedfolders.capture9p report FILE reports on it",
+    )
+    return parser
+
+
 def QvmMountFolder() -> int:
     """QvmMountFolder runs in the qube that wants to mount a folder from
     another qube."""
-    logger = logging.getLogger("QvmMountFolder")
     setup_logging()
 
-    def usage(error: str = "") -> int:
-        if error:
-            print("error:", error, file=sys.stderr)
-        print(
-            """usage:
-
-"qvm-mount-folder" <VM> <folder from VM> <mountpoint>""",
-            file=sys.stderr if error else sys.stdout,
-        )
-        return os.EX_USAGE
+    parser = mount_folder_parser()
+    try:
+        args = parser.parse_args(sys.argv[1:])
+        if args.from_file is None and args.target is None:
+            parser.error("VM, FOLDER and MOUNTPOINT are required")
+        if args.from_file is not None and args.vm is not None:
+            parser.error("--from-file takes no VM, FOLDER or MOUNTPOINT")
+        if args.from_file is not None:
+            path, args.from_file = args.from_file, None
+            try:
+                mounts = read_manifest(parser, path, args)
+            except OSError as e:
+                return error("cannot read %s: %s" % (path, e), os.EX_NOINPUT)
+            return mount_manifest(mounts)
+    except SystemExit as e:
+        return os.EX_USAGE if e.code else 0
+    return mount_folder(args)
+
+
+def mount_folder(args: "argparse.Namespace", remembered: bool = True) -> int:
+    """Mount a folder as asked by the arguments of qvm-mount-folder.
+    Unless remembered is False, a fingerprint remembered for the folder
+    is used instead of asking dom0 for one."""
+    import getpass
+    import subprocess
 
+    logger = logging.getLogger("QvmMountFolder")
+    vm, source, target = args.vm, args.source, args.target
+    # Options given later override those given earlier, and the options
+    # of the profile.
+    given: List[str] = [MOUNT_PROFILES[args.profile]]
+    if args.msize is not None:
+        given.append("msize=%s" % args.msize)
+    if args.cache:
+        given.append("cache=%s" % args.cache)
+    if args.read_only:
+        given.append("ro")
+    options: MountOptions = {}
     try:
-        vm, source, target = sys.argv[1:4]
-    except (IndexError, ValueError):
-        return usage("invalid arguments")
+        for text in given + args.options:
+            options = parse_mount_options(text, options)
+    except ValueError as e:
+        return error(str(e), os.EX_USAGE)
+    msize = int(options.pop("msize", None) or DEFAULT_MSIZE)
 
     if not os.path.isdir(target):
-        error("%s does not exist or is not a directory" % target, errno.ENOENT)
+        return error("%s does not exist or is not a directory" % target, errno.ENOENT)
 
     vm_encoded = base64.standard_b64encode(vm.encode("utf-8"))
     folder_encoded = base64.standard_b64encode(source.encode("utf-8"))
 
+    # Permanent grants are remembered, and their fingerprints used without
+    # asking dom0 again, until the qube sharing the folder refuses them.
+    url = "qvm://%s%s" % (vm, source)
+    fingerprint = load_fingerprints().get(url) if remembered else None
+    cached = fingerprint is not None
+    if fingerprint is None:
+        ret, fingerprint = request_authorization(url, vm_encoded, folder_encoded)
+        if ret != 0:
+            return ret
+    else:
+        logger.info("Using the fingerprint remembered for %s", url)
+
+    # Mounts of folders of the same qube made with --multiplex share the
+    # connection of the first of them, through the multiplexer it starts.
+    # They wait for each other, so that only one connection is made.
+    session = None
+    lock = None
+    request = b""
+    if args.multiplex:
+        import fcntl
+
+        path = multiplexer_path(vm)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        lock = open(path + ".lock", "wb")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        session = multiplexed_session(path)
+        request = b"multiplex:"
+
+    if session is None:
+        f1_read, f1_write = os.pipe2(0)
+        f2_read, f2_write = os.pipe2(0)
+
+        stdin_for_read = os.fdopen(f1_read, "rb", buffering=0)
+        stdout_for_write = os.fdopen(f2_write, "wb", buffering=0)
+        stdin_for_write = os.fdopen(f1_write, "wb", buffering=0)
+        stdout_for_read = os.fdopen(f2_read, "rb", buffering=0)
+
+        # With the fingerprint, use it to invoke the RPC service that was
+        # just authorized for this script.
+        logger.info(
+            "Connecting to qvm://%s%s using fingerprint %s", vm, source, fingerprint
+        )
+        p = subprocess.Popen(
+            [
+                "qrexec-client-vm",
+                vm,
+                "ruddo.ConnectToFolder+%s" % fingerprint,
+            ],
+            stdin=stdin_for_read,
+            stdout=stdout_for_write,
+            bufsize=0,
+            close_fds=True,
+        )
+        stdin_for_read.close()
+        stdout_for_write.close()
+
+        # Now send the folder we intend to mount, which may be
+        # a subfolder of the requested folder.  This is thought
+        # so that e.g. permanent authorization for /home/user works to
+        # grant authorization for a mount request of /home/user/subfolder.
+        # The receiver will check if this script is not "cheating",
+        # id est, if the folder I am passing here is the same folder
+        # used to obtain the fingerprint above, or at least a subfolder
+        # of it.
+        stdin_for_write.write(request + folder_encoded + b"\n")
+        response = stdout_for_read.read(3).decode("utf-8").rstrip()
+        if response == "ok":
+            # Proceed.  We have received authorization and qfsd has
+            # already started on the other side.
+            pass
+        elif response == "":
+            # folder does not exist
+            ex = p.wait()
+            if cached and ex in (errno.EACCES, 126):
+                # dom0 no longer honors the grant the fingerprint was for.
+                logger.info("The fingerprint remembered for %s was refused", url)
+                save_fingerprint(url, None)
+                stdout_for_read.close()
+                stdin_for_write.close()
+                if lock:
+                    lock.close()
+                return mount_folder(args, remembered=False)
+            if ex == errno.ENOENT:
+                return error(
+                    "directory %s does not exist in qube %s" % (source, vm),
+                    errno.ENOENT,
+                )
+            elif ex == errno.EACCES:
+                return error(
+                    "qube %s has denied the mount request for directory %s"
+                    % (vm, source),
+                    errno.EACCES,
+                )
+            elif ex == 126:
+                return error(
+                    "qrexec policy has denied the mount request to %s for directory %s"
+                    % (vm, source),
+                    126,
+                )
+            else:
+                return error("unknown exit status %s" % ex, ex)
+        else:
+            p.kill()
+            assert 0, "not reached: %r" % response
+
+        if args.multiplex:
+            start_multiplexer(
+                path, stdout_for_read.fileno(), stdin_for_write.fileno(), msize
+            )
+            stdout_for_read.close()
+            stdin_for_write.close()
+            session = multiplexed_session(path)
+            if session is None:
+                return error("the connection to qube %s could not be shared" % vm)
+
+    aname = source
+    if session is not None:
+        if lock:
+            lock.close()
+        logger.info("Sharing the connection to qube %s", vm)
+        stdout_for_read = os.fdopen(os.dup(session.fileno()), "rb", buffering=0)
+        stdin_for_write = os.fdopen(session.detach(), "wb", buffering=0)
+        # qfsd authorizes the folder of every mount over the connection as
+        # the mount attaches to it.
+        aname = "%s:%s" % (fingerprint, folder_encoded.decode("ascii"))
+
+    uid = os.getuid()
+    gid = os.getgid()
+    username = getpass.getuser()
+    cmdline = [
+        "/usr/bin/sudo",
+        "/usr/bin/mount",
+        "-t",
+        "9p",
+        "-o",
+        mount_options(uid, gid, username, aname, msize, options),
+        "qvm://%s%s" % (vm, source),
+        target,
+    ]
+
+    # The cache proxy goes next to qrexec, so that the capture records
+    # what the mount asks for and how long it waits for it.
+    relays = []
+    if args.cache_proxy is not None:
+        logger.info("Caching responses for %s seconds", args.cache_proxy)
+        relays.append(["sharedfolders.cache9p", "--ttl", str(args.cache_proxy)])
+    if args.capture:
+        logger.info("Recording the traffic of the mount to %s", args.capture)
+        relays.append(["sharedfolders.capture9p", "record", args.capture])
+    for relay in relays:
+        from sharedfolders import capture9p
+
+        client_read, client_write = capture9p.interpose(
+            relay, stdout_for_read.fileno(), stdin_for_write.fileno()
+        )
+        stdout_for_read.close()
+        stdin_for_write.close()
+        stdout_for_read = os.fdopen(client_read, "rb", buffering=0)
+        stdin_for_write = os.fdopen(client_write, "wb", buffering=0)
+
+    # Over a shared connection, a remembered fingerprint is checked as
+    # the mount attaches to the folder, and mount(8) only tells a refusal
+    # from other failures by its message, which is read untranslated.
+    check_refusal = cached and session is not None
+    logger.info("Mounting qvm://%s%s", vm, source)
+    p2 = subprocess.Popen(
+        cmdline,
+        stdin=stdout_for_read,
+        stdout=stdin_for_write,
+        stderr=subprocess.PIPE if check_refusal else None,
+        env=dict(os.environ, LC_ALL="C") if check_refusal else None,
+        close_fds=True,
+    )
+    stdout_for_read.close()
+    stdin_for_write.close()
+
+    _, err = p2.communicate()
+    ret = p2.returncode
+    if err and ret != 0 and b"permission denied" in err.lower():
+        logger.info("The fingerprint remembered for %s was refused", url)
+        save_fingerprint(url, None)
+        return mount_folder(args, remembered=False)
+    if err:
+        sys.stderr.write(err.decode("utf-8", "replace"))
+    if ret == 0 and args.watch:
+        follow_changes(vm, fingerprint, folder_encoded, target)
+    return ret
+
+
+def read_manifest(
+    parser: "argparse.ArgumentParser", path: str, defaults: "argparse.Namespace"
+) -> List["argparse.Namespace"]:
+    """Return the arguments of the mounts listed in the file at path, one
+    per line, with the options in defaults applying to all of them.
+    Blank lines and comments started with # are skipped."""
+    import argparse
+    import shlex
+
+    with open(path) as f:
+        lines = f.readlines()
+    mounts = []
+    for number, line in enumerate(lines, 1):
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        try:
+            args = parser.parse_args(
+                words, namespace=argparse.Namespace(**vars(defaults))
+            )
+            if args.from_file or args.target is None:
+                parser.error("VM, FOLDER and MOUNTPOINT are required")
+        except SystemExit:
+            print("error: in line %s of %s" % (number, path), file=sys.stderr)
+            raise
+        mounts.append(args)
+    return mounts
+
+
+def mount_manifest(
+    mounts: List["argparse.Namespace"],
+    mount: "Callable[[argparse.Namespace], int]" = mount_folder,
+) -> int:
+    """Make the mounts at the same time, and report how each went as it
+    ends.  Return 0 if all of them were made, or the exit status of the
+    first of them that failed otherwise.  Mounts that were made are kept
+    when others fail."""
+    import concurrent.futures
+    import time
+
+    logger = logging.getLogger("QvmMountFolder")
+
+    def timed(args: "argparse.Namespace") -> Tuple[int, float]:
+        started = time.monotonic()
+        try:
+            ret = mount(args)
+        except Exception:
+            logger.exception("Mounting qvm://%s%s failed", args.vm, args.source)
+            ret = 1
+        return ret, time.monotonic() - started
+
+    statuses = [0] * len(mounts)
+    with concurrent.futures.ThreadPoolExecutor(max(len(mounts), 1)) as executor:
+        futures = {executor.submit(timed, args): n for n, args in enumerate(mounts)}
+        for future in concurrent.futures.as_completed(futures):
+            n = futures[future]
+            args = mounts[n]
+            statuses[n], elapsed = future.result()
+            if statuses[n] == 0:
+                outcome = "mounted in %.2f s" % elapsed
+            else:
+                outcome = "failed with status %s after %.2f s" % (statuses[n], elapsed)
+            print("qvm://%s%s on %s: %s" % (args.vm, args.source, args.target, outcome))
+            sys.stdout.flush()
+    return next((ret for ret in statuses if ret != 0), 0)
+
+
+def request_authorization(
+    url: str, vm_encoded: bytes, folder_encoded: bytes
+) -> Tuple[int, str]:
+    """Ask dom0 for access to the folder at url, and return the exit
+    status of the request and the fingerprint it returned.  Fingerprints
+    of permanent grants are remembered."""
+    import subprocess
+
+    logger = logging.getLogger("QvmMountFolder")
     # Request authorization for a specific folder (and its subfolders)
     # on a particular VM.  If the authorization is successful, a
     # ticket called a "fingerprint" is returned, which entitles this
     # program to access the folder (either one-time or permanently,
     # as the user has decided).
-    logger.info("Requesting authorization for qvm://%s%s", vm, source)
+    logger.info("Requesting authorization for %s", url)
     p = subprocess.Popen(
         ["qrexec-client-vm", "dom0", "ruddo.AuthorizeFolderAccess"],
         stdin=subprocess.PIPE,
@@ -230,8 +765,10 @@ def QvmMountFolder() -> int:
     assert p.stdout
     p.stdin.write(vm_encoded + b"\n")
     p.stdin.write(folder_encoded + b"\n")
+    # dom0 tells what it granted as well, if it can.
+    p.stdin.write(WITH_RESPONSE + b"\n")
     p.stdin.close()
-    fingerprint = p.stdout.read().decode("utf-8")
+    fingerprint, _, granted = p.stdout.read().decode("utf-8").partition("\n")
     p.stdout.close()
     ret = p.wait()
 
@@ -242,93 +779,163 @@ def QvmMountFolder() -> int:
             print("Invalid parameters", file=sys.stderr)
         else:
             print("Unknown error", file=sys.stderr)
-        sys.exit(ret)
+        return ret, ""
 
-    f1_read, f1_write = os.pipe2(0)
-    f2_read, f2_write = os.pipe2(0)
+    try:
+        response = Response.from_string(granted)
+    except Exception:
+        response = None
+    if response and response.is_allow() and not response.is_onetime():
+        save_fingerprint(url, fingerprint)
+    return 0, fingerprint
 
-    stdin_for_read = os.fdopen(f1_read, "rb", buffering=0)
-    stdout_for_write = os.fdopen(f2_write, "wb", buffering=0)
-    stdin_for_write = os.fdopen(f1_write, "wb", buffering=0)
-    stdout_for_read = os.fdopen(f2_read, "rb", buffering=0)
 
-    # With the fingerprint, use it to invoke the RPC service that was
-    # just authorized for this script.
-    logger.info(
-        "Connecting to qvm://%s%s using fingerprint %s", vm, source, fingerprint
-    )
+def fingerprints_path() -> str:
+    cache = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "qubes-shared-folders", "fingerprints.json")
+
+
+def load_fingerprints() -> Dict[str, str]:
+    """Return the fingerprints of the permanent grants this qube got,
+    by the qvm:// URL of their folder."""
+    import json
+
+    try:
+        with open(fingerprints_path()) as f:
+            fingerprints = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return fingerprints if isinstance(fingerprints, dict) else {}
+
+
+def save_fingerprint(url: str, fingerprint: Optional[str]) -> None:
+    """Remember the fingerprint of the permanent grant for the folder at
+    url, or forget it if None."""
+    import fcntl
+    import json
+
+    path = fingerprints_path()
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(path + ".lock", "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fingerprints = load_fingerprints()
+            if fingerprint is None:
+                fingerprints.pop(url, None)
+            else:
+                fingerprints[url] = fingerprint
+            tmp = "%s.%s" % (path, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(fingerprints, f)
+            os.rename(tmp, path)
+    except OSError as e:
+        logging.getLogger("QvmMountFolder").warning(
+            "Cannot remember the fingerprint for %s: %s", url, e
+        )
+
+
+def multiplexer_path(vm: str) -> str:
+    """Return the path of the socket the multiplexer of the mounts of
+    folders of a qube listens on."""
+    runtime = os.getenv("XDG_RUNTIME_DIR") or "/run/user/%d" % os.getuid()
+    return os.path.join(runtime, "qubes-shared-folders", "%s.sock" % vm)
+
+
+def start_multiplexer(
+    path: str, server_read: int, server_write: int, msize: int
+) -> None:
+    """Start sharedfolders.mux9p on the connection to qfsd given by the
+    file descriptors, listening on the socket at path.  Sessions get
+    messages of up to msize bytes, as does the connection to qfsd."""
+    import socket
+    import subprocess
+
+    # The socket of a multiplexer that exited is left behind.
+    if os.path.exists(path):
+        os.unlink(path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen()
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "sharedfolders.mux9p",
+                "--listen-fd",
+                str(listener.fileno()),
+                "--msize",
+                str(msize),
+                "--server-fds",
+                str(server_read),
+                str(server_write),
+            ],
+            pass_fds=(listener.fileno(), server_read, server_write),
+            close_fds=True,
+        )
+
+
+def multiplexed_session(path: str) -> Optional["socket.socket"]:
+    """Pass a new session to the multiplexer listening on the socket at
+    path, and return the socket to mount over, or None if there is no
+    multiplexer or it is exiting."""
+    import socket
+
+    ours, theirs = socket.socketpair()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+            socket.send_fds(conn, [b"session"], [theirs.fileno()])
+            if conn.recv(3) == b"ok\n":
+                return ours
+    except OSError:
+        pass
+    finally:
+        theirs.close()
+    ours.close()
+    return None
+
+
+def follow_changes(
+    vm: str, fingerprint: str, folder_encoded: bytes, target: str
+) -> None:
+    """Connect to the qube that shares the folder mounted at target again,
+    asking for the changes made to its files, and leave them to
+    sharedfolders.changes to act on until the folder is unmounted."""
+    import subprocess
+
+    logger = logging.getLogger("QvmMountFolder")
+    logger.info("Following changes to qvm://%s at %s", vm, target)
+    to_server_read, to_server_write = os.pipe2(0)
     p = subprocess.Popen(
-        [
-            "qrexec-client-vm",
-            vm,
-            "ruddo.ConnectToFolder+%s" % fingerprint,
-        ],
-        stdin=stdin_for_read,
-        stdout=stdout_for_write,
+        ["qrexec-client-vm", vm, "ruddo.ConnectToFolder+%s" % fingerprint],
+        stdin=to_server_read,
+        stdout=subprocess.PIPE,
         bufsize=0,
         close_fds=True,
     )
-    stdin_for_read.close()
-    stdout_for_write.close()
-
-    # Now send the folder we intend to mount, which may be
-    # a subfolder of the requested folder.  This is thought
-    # so that e.g. permanent authorization for /home/user works to
-    # grant authorization for a mount request of /home/user/subfolder.
-    # The receiver will check if this script is not "cheating",
-    # id est, if the folder I am passing here is the same folder
-    # used to obtain the fingerprint above, or at least a subfolder
-    # of it.
-    stdin_for_write.write(folder_encoded + b"\n")
-    response = stdout_for_read.read(3).decode("utf-8").rstrip()
-    if response == "ok":
-        # Proceed.  We have received authorization and qfsd has
-        # already started on the other side.
-        pass
-    elif response == "":
-        # folder does not exist
-        ex = p.wait()
-        if ex == errno.ENOENT:
-            return error(
-                "directory %s does not exist in qube %s" % (source, vm), errno.ENOENT
-            )
-        elif ex == errno.EACCES:
-            return error(
-                "qube %s has denied the mount request for directory %s" % (vm, source),
-                errno.EACCES,
-            )
-        elif ex == 126:
-            return error(
-                "qrexec policy has denied the mount request to %s for directory %s"
-                % (vm, source),
-                126,
-            )
-        else:
-            return error("unknown exit status %s" % ex, ex)
-    else:
-        p.kill()
-        assert 0, "not reached: %r" % response
-
-    uid = os.getuid()
-    gid = os.getgid()
-    username = getpass.getuser()
-    cmdline = [
-        "/usr/bin/sudo",
-        "/usr/bin/mount",
-        "-t",
-        "9p",
-        "-o",
-        "trans=fd,rfdno=%s,wfdno=%s,version=9p2000.L,dfltuid=%s,dfltgid=%s,uname=%s,aname=%s"
-        % (0, 1, uid, gid, username, source),
-        "qvm://%s%s" % (vm, source),
-        target,
-    ]
-
-    logger.info("Mounting qvm://%s%s", vm, source)
-    p2 = subprocess.Popen(
-        cmdline, stdin=stdout_for_read, stdout=stdin_for_write, close_fds=True
+    os.close(to_server_read)
+    assert p.stdout
+    # The same request as for the mount, prefixed so that the changes are
+    # served instead of the folder.
+    os.write(to_server_write, b"watch:" + folder_encoded + b"\n")
+    if p.stdout.read(3) != b"ok\n":
+        os.close(to_server_write)
+        p.stdout.close()
+        p.wait()
+        print(
+            "warning: qube %s does not report changes to the folder; the access "
+            "granted to it may not be permanent" % vm,
+            file=sys.stderr,
+        )
+        return
+    # The connection is closed, and the server qube stops watching, when
+    # the program exits.
+    subprocess.Popen(
+        [sys.executable, "-m", "sharedfolders.changes", target],
+        stdin=p.stdout,
+        stdout=to_server_write,
+        close_fds=True,
     )
-    stdout_for_read.close()
-    stdin_for_write.close()
-
-    return p2.wait()
+    p.stdout.close()
+    os.close(to_server_write)
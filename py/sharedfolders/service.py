@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+from typing import Callable, Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Largest request the service accepts.  Requests carry only the name of
+# the program and its environment, NUL-separated; the standard I/O of the
+# caller is passed along as file descriptors.
+MAX_REQUEST = 256 * 1024
+
+
+def socket_path() -> str:
+    """Return the path of the authorization service socket for this user."""
+    return os.path.join(
+        "/run/user/%d" % os.getuid(), "qubes-shared-folders", "authorization.sock"
+    )
+
+
+def call(
+    program: str, fds: Sequence[int] = (0, 1, 2), path: Optional[str] = None
+) -> Optional[int]:
+    """Run program in the authorization service, if the service is running.
+
+    The service runs the program with the environment of this process, and
+    with the file descriptors in fds as its standard input, output and error.
+
+    Return the exit status of the program, or None if the service could not
+    be reached and the program must be run in this process instead.
+    """
+    if path is None:
+        path = socket_path()
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        try:
+            s.connect(path)
+            request = [program.encode("utf-8")] + [
+                k + b"=" + v for k, v in os.environb.items()
+            ]
+            socket.send_fds(s, [b"\0".join(request)], list(fds))
+        except OSError as e:
+            logger.debug("Authorization service unavailable at %s: %s", path, e)
+            return None
+        # Once the request is sent, the service owns our standard I/O, so
+        # the program cannot be run again here if the service fails.
+        reply = s.recv(64)
+    finally:
+        s.close()
+    if not reply:
+        print("error: the authorization service failed", file=sys.stderr)
+        return 4
+    return int(reply.decode("ascii"))
+
+
+def _peer_uid(conn: socket.socket) -> int:
+    creds = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return int(uid)
+
+
+def _run_request(conn: socket.socket, programs: Dict[str, Callable[[], int]]) -> int:
+    """Run the request on conn.  Called in a child forked off the service."""
+    data, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST, 3)
+    if len(fds) != 3 or not data:
+        logger.error("Malformed request to the authorization service")
+        return 4
+    name, *env = data.split(b"\0")
+    program = programs.get(name.decode("utf-8"))
+    if program is None:
+        logger.error("Unknown program %r", name)
+        return 4
+    os.environb.clear()
+    for variable in env:
+        k, _, v = variable.partition(b"=")
+        os.environb[k] = v
+    for n, fd in enumerate(fds):
+        os.dup2(fd, n)
+        os.close(fd)
+    # Do not reuse the standard streams of the service, which may hold
+    # buffered data of their own.
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", closefd=False)
+    return program()
+
+
+def _handle(
+    conn: socket.socket,
+    programs: Dict[str, Callable[[], int]],
+    listener: socket.socket,
+) -> None:
+    """Fork a child that runs the request on conn and reports its exit status.
+    The child does not keep the listening socket of the service open."""
+    pid = os.fork()
+    if pid != 0:
+        return
+    ret = 4
+    try:
+        listener.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        ret = _run_request(conn, programs)
+    except SystemExit as e:
+        ret = 0 if e.code is None else e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        logger.exception("Error running request in the authorization service")
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        try:
+            conn.send(b"%d" % ret)
+        finally:
+            os._exit(ret)
+
+
+def serve(
+    programs: Dict[str, Callable[[], int]],
+    refresh: Callable[[], None],
+    path: Optional[str] = None,
+) -> int:
+    """Serve requests to run programs until terminated.
+
+    Each request runs in a child forked off this process, so it inherits
+    whatever state refresh() keeps warm in this process.  refresh() is
+    called at startup and after requests finish.
+    """
+    if path is None:
+        path = socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    s.bind(path)
+    os.chmod(path, 0o600)
+    s.listen(64)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    refresh()
+    logger.info("Authorization service listening on %s", path)
+    children = 0
+    try:
+        while True:
+            readable, _, _ = select.select([s], [], [], 1.0 if children else None)
+            if readable:
+                conn, _ = s.accept()
+                try:
+                    if _peer_uid(conn) != os.getuid():
+                        logger.error("Rejecting connection from another user")
+                        continue
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    _handle(conn, programs, s)
+                    children += 1
+                finally:
+                    conn.close()
+            finished = 0
+            while children:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                children -= 1
+                finished += 1
+            if finished:
+                refresh()
+    finally:
+        s.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -1,17 +1,41 @@
 #!/usr/bin/python3 -m unittest
 
+import argparse
 import json
 import os
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
 import sys
 import tempfile
+import time
+from typing import Iterable, List, Optional, Tuple
 import unittest
 
 import sharedfolders
-
+from sharedfolders import (
+    bench_authorization,
+    bench_mount,
+    bench_qfsd,
+    bench_startup,
+    cache9p,
+    capture9p,
+    changes,
+    mux9p,
+    programs,
+    service,
+)
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 
+def export_json(decisions: sharedfolders.DecisionMatrix, path: str) -> None:
+    """Write decisions to path as the JSON policy database of old."""
+    sharedfolders._JSONPolicyStore(path).save(decisions, None, None)
+
+
 matrix = sharedfolders.DecisionMatrix(
     {
         "fprint": sharedfolders.Decision(
@@ -55,6 +79,22 @@ class TestDecisions(unittest.TestCase):
         ), decision
         assert fingerprint == "fprint"
 
+    def test_folder_of_fingerprint_passed_along(self) -> None:
+        global matrix
+        assert (
+            matrix.lookup_decision_folder("fprint", "/home/user/sub", "one", "two")
+            == "/home/user"
+        )
+        # The fingerprint of another client qube, or for another server qube.
+        assert (
+            matrix.lookup_decision_folder("fprint", "/home/user/sub", "three", "two")
+            is None
+        )
+        assert (
+            matrix.lookup_decision_folder("fprint", "/home/user/sub", "one", "three")
+            is None
+        )
+
     def test_not_authorized(self) -> None:
         global matrix
         source, target = "one", "two"
@@ -112,3 +152,774 @@ class TestDecisionMatrixLoad(unittest.TestCase):
                 matrix.load()
         finally:
             matrix.POLICY_DB = old
+            sqlite = os.path.splitext(t.name)[0] + ".sqlite"
+            if os.path.exists(sqlite):
+                os.unlink(sqlite)
+
+
+class TestDecisionMatrixIndex(unittest.TestCase):
+    def test_index_follows_deletions(self) -> None:
+        global matrix
+        m = matrix.copy()
+        del m["fprint3"]
+        decision, fingerprint = m.lookup_decision("one", "two", "/var/lib")
+        assert (
+            decision is not None
+            and decision.response is sharedfolders.RESPONSES.DENY_ALWAYS
+        ), decision
+        assert fingerprint == "fprint4"
+        m.pop("fprint4")
+        decision, fingerprint = m.lookup_decision("one", "two", "/var/lib")
+        assert decision is None, decision
+        assert "var" not in m._index[("one", "two")].children
+
+    def test_index_follows_replacements(self) -> None:
+        global matrix
+        m = matrix.copy()
+        m["fprint"] = sharedfolders.Decision(
+            "one", "three", "/home/user", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        decision, fingerprint = m.lookup_decision("one", "two", "/home/user")
+        assert (
+            decision is not None
+            and decision.response is sharedfolders.RESPONSES.DENY_ALWAYS
+        ), decision
+        assert fingerprint == "fprint2"
+        decision, fingerprint = m.lookup_decision("one", "three", "/home/user/x")
+        assert decision is not None and fingerprint == "fprint", decision
+
+    def test_sibling_prefix_does_not_match(self) -> None:
+        global matrix
+        decision, _ = matrix.lookup_decision("one", "two", "/variable")
+        assert decision is None, decision
+
+    def test_copies_do_not_share_changes(self) -> None:
+        global matrix
+        m = matrix.copy()
+        del m["fprint4"]
+        n = m.copy()
+        n["fprint4"] = matrix["fprint4"]
+        del m["fprint3"]
+        decision, fingerprint = matrix.lookup_decision("one", "two", "/var/lib")
+        assert fingerprint == "fprint3", decision
+        decision, fingerprint = m.lookup_decision("one", "two", "/var/lib")
+        assert decision is None, decision
+        decision, fingerprint = n.lookup_decision("one", "two", "/var/lib")
+        assert fingerprint == "fprint3", decision
+
+
+class TestDecision(unittest.TestCase):
+    def test_decisions_are_immutable(self) -> None:
+        d = sharedfolders.Decision(
+            "one", "two", "/home", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        assert not hasattr(d, "__dict__")
+        with self.assertRaises(AttributeError):
+            d.folder = "/"
+        with self.assertRaises(AttributeError):
+            del d.response
+
+    def test_decisions_compare_by_value(self) -> None:
+        a = sharedfolders.Decision(
+            "one", "two", "/home", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        b = sharedfolders.Decision(
+            "one", "two", "/home", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        c = sharedfolders.Decision(
+            "one", "two", "/home", sharedfolders.RESPONSES.DENY_ALWAYS
+        )
+        assert a == b and hash(a) == hash(b)
+        assert a != c
+
+    def test_names_are_interned(self) -> None:
+        a = sharedfolders.Decision(
+            "".join(["o", "ne"]), "two", "/home", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        b = sharedfolders.Decision(
+            "".join(["on", "e"]), "two", "/home", sharedfolders.RESPONSES.DENY_ALWAYS
+        )
+        assert a.source is b.source
+
+
+class PolicyDBTestCase(unittest.TestCase):
+    """Keeps the policy database in a temporary directory."""
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old = sharedfolders.DecisionMatrix.POLICY_DB
+        sharedfolders.DecisionMatrix.POLICY_DB = os.path.join(
+            self.tmpdir.name, "policy.db"
+        )
+
+    def tearDown(self) -> None:
+        sharedfolders.DecisionMatrix.POLICY_DB = self.old
+        self.tmpdir.cleanup()
+
+
+class TestDecisionMatrixCache(PolicyDBTestCase):
+    def test_load_returns_independent_copies(self) -> None:
+        global matrix
+        matrix.copy().save()
+        first = sharedfolders.DecisionMatrix.load()
+        del first["fprint"]
+        second = sharedfolders.DecisionMatrix.load()
+        assert sorted(second) == sorted(matrix), second
+
+    def test_load_notices_changes_on_disk(self) -> None:
+        global matrix
+        matrix.copy().save()
+        sharedfolders.DecisionMatrix.load()
+        # Another process revokes a decision behind our back.
+        store = sharedfolders.DecisionMatrix.STORE(
+            sharedfolders.DecisionMatrix.POLICY_DB
+        )
+        store.save({}, {"fprint"}, None)
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert "fprint" not in loaded and "fprint2" in loaded, loaded
+
+
+class TestDecisionMatrixStore(PolicyDBTestCase):
+    def test_migrates_json_database(self) -> None:
+        global matrix
+        export_json(matrix, sharedfolders.DecisionMatrix.POLICY_DB)
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert sorted(loaded) == sorted(matrix), loaded
+        assert loaded["fprint4"].folder == "/var/lib", loaded
+        assert not os.path.exists(sharedfolders.DecisionMatrix.POLICY_DB)
+
+    def test_empty_json_database_is_nothing_to_migrate(self) -> None:
+        open(sharedfolders.DecisionMatrix.POLICY_DB, "w").close()
+        with self.assertNoLogs(level="ERROR"):
+            assert len(sharedfolders.DecisionMatrix.load()) == 0
+
+    def test_failed_migration_is_tried_again(self) -> None:
+        global matrix
+        with open(sharedfolders.DecisionMatrix.POLICY_DB, "w") as f:
+            f.write("{not json")
+        with self.assertLogs(level="ERROR"):
+            assert len(sharedfolders.DecisionMatrix.load()) == 0
+        export_json(matrix, sharedfolders.DecisionMatrix.POLICY_DB)
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert sorted(loaded) == sorted(matrix), loaded
+
+    def test_incomplete_database_is_completed(self) -> None:
+        global matrix
+        export_json(matrix, sharedfolders.DecisionMatrix.POLICY_DB)
+        # As left by a crash right after the database was created.
+        sqlite = os.path.splitext(sharedfolders.DecisionMatrix.POLICY_DB)[0]
+        open(sqlite + ".sqlite", "w").close()
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert sorted(loaded) == sorted(matrix), loaded
+
+    def test_migration_happens_once(self) -> None:
+        global matrix
+        sharedfolders.DecisionMatrix.load()
+        # A JSON database appearing later, e.g. restored from a backup,
+        # does not override the decisions made since.
+        export_json(matrix, sharedfolders.DecisionMatrix.POLICY_DB)
+        assert len(sharedfolders.DecisionMatrix.load()) == 0
+
+    def test_save_keeps_concurrent_changes(self) -> None:
+        global matrix
+        matrix.copy().save()
+        first = sharedfolders.DecisionMatrix.load()
+        second = sharedfolders.DecisionMatrix.load()
+        del first["fprint"]
+        first.save()
+        second["fprint5"] = sharedfolders.Decision(
+            "one", "two", "/srv", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        second.save()
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert "fprint" not in loaded and "fprint5" in loaded, loaded
+
+    def test_json_store_roundtrips(self) -> None:
+        global matrix
+        path = os.path.join(self.tmpdir.name, "export.json")
+        export_json(matrix, path)
+        with open(path) as f:
+            data = json.load(f)
+        assert data["fprint"]["response"] == "ALLOW_ALWAYS", data
+        exported = dict(sharedfolders._JSONPolicyStore(path).load())
+        assert sorted(exported) == sorted(matrix), exported
+        # Saving changes only leaves the other decisions alone.
+        sharedfolders._JSONPolicyStore(path).save({}, {"fprint"}, None)
+        exported = dict(sharedfolders._JSONPolicyStore(path).load())
+        assert "fprint" not in exported and "fprint2" in exported, exported
+
+    def test_failed_load_does_not_replace_decisions(self) -> None:
+        global matrix
+        matrix.copy().save()
+
+        class FailingStore(sharedfolders._SQLitePolicyStore):
+            def load(self) -> Iterable[Tuple[str, sharedfolders.Decision]]:
+                raise sqlite3.OperationalError("database is locked")
+
+        old_store = sharedfolders.DecisionMatrix.STORE
+        sharedfolders.DecisionMatrix.STORE = FailingStore
+        sharedfolders.DecisionMatrix._cache = None
+        try:
+            with self.assertLogs(level="ERROR"):
+                failed = sharedfolders.DecisionMatrix.load()
+        finally:
+            sharedfolders.DecisionMatrix.STORE = old_store
+        assert len(failed) == 0, failed
+        failed["fprint5"] = sharedfolders.Decision(
+            "one", "two", "/srv", sharedfolders.RESPONSES.ALLOW_ALWAYS
+        )
+        failed.save()
+        loaded = sharedfolders.DecisionMatrix.load()
+        assert len(loaded) == len(matrix) + 1, loaded
+
+
+class TestNewConnectToFolderPolicy(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        fntpl = os.path.join(self.tmpdir.name, "79-qubes-shared-folders.policy")
+
+        class Policy(sharedfolders._NewConnectToFolderPolicy):
+            FOLDER = self.tmpdir.name
+            FNTPL = fntpl
+
+        self.policy = Policy()
+        with open(fntpl, "w") as f:
+            f.write(
+                "# comment\n"
+                "ruddo.ConnectToFolder +fprint2 one two allow\n"
+                "ruddo.ConnectToFolder +stale one two allow\n"
+                "ruddo.ConnectToFolder +fprint3 one two allow"
+            )
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_apply_policy_changes(self) -> None:
+        global matrix
+        self.policy.apply_policy_changes_from(matrix)
+        with open(self.policy.FNTPL) as f:
+            lines = f.read().splitlines()
+        assert lines == [
+            "# comment",
+            "ruddo.ConnectToFolder +fprint3 one two allow",
+            "ruddo.ConnectToFolder +fprint one two allow",
+        ], lines
+
+    def test_apply_policy_changes_leaves_synced_file_alone(self) -> None:
+        global matrix
+        self.policy.apply_policy_changes_from(matrix)
+        before = os.stat(self.policy.FNTPL)
+        self.policy.apply_policy_changes_from(matrix)
+        after = os.stat(self.policy.FNTPL)
+        assert before.st_ino == after.st_ino
+        assert before.st_mtime_ns == after.st_mtime_ns
+
+
+class TestAuthorizationService(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "authorization.sock")
+
+        def echo() -> int:
+            data = sys.stdin.buffer.read()
+            sys.stdout.write(data.decode("utf-8").upper())
+            sys.stdout.write(os.environ.get("QREXEC_REMOTE_DOMAIN", ""))
+            return 3
+
+        def listeners() -> int:
+            # The listening sockets among the open file descriptors.
+            count = 0
+            for fd in os.listdir("/proc/self/fd"):
+                try:
+                    with socket.socket(fileno=os.dup(int(fd))) as sock:
+                        count += sock.getsockopt(
+                            socket.SOL_SOCKET, socket.SO_ACCEPTCONN
+                        )
+                except OSError:
+                    pass
+            sys.stdout.write(str(count))
+            return 0
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                service.serve(
+                    {"Echo": echo, "Listeners": listeners}, lambda: None, self.path
+                )
+            finally:
+                os._exit(0)
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self) -> None:
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.tmpdir.cleanup()
+
+    def call(self, program: str, data: bytes) -> Tuple[Optional[int], bytes]:
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        os.write(stdin_w, data)
+        os.close(stdin_w)
+        os.environ["QREXEC_REMOTE_DOMAIN"] = "work"
+        try:
+            ret = service.call(program, (stdin_r, stdout_w, 2), self.path)
+        finally:
+            del os.environ["QREXEC_REMOTE_DOMAIN"]
+            os.close(stdin_r)
+            os.close(stdout_w)
+        with os.fdopen(stdout_r, "rb") as f:
+            return ret, f.read()
+
+    def test_runs_program_with_caller_io_and_environment(self) -> None:
+        ret, output = self.call("Echo", b"hello ")
+        assert ret == 3, ret
+        assert output == b"HELLO work", output
+
+    def test_programs_do_not_keep_listening_socket(self) -> None:
+        ret, output = self.call("Listeners", b"")
+        assert ret == 0, ret
+        assert output == b"0", output
+
+    def test_unknown_program(self) -> None:
+        ret, output = self.call("Nope", b"")
+        assert ret == 4, ret
+        assert output == b"", output
+
+    def test_service_not_running(self) -> None:
+        ret = service.call("Echo", (0, 1, 2), self.path + ".missing")
+        assert ret is None, ret
+
+
+class TestVMInventory(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.queries = 0
+        test = self
+
+        class Inventory(sharedfolders.VMInventory):
+            QUBES_XML = os.path.join(self.tmpdir.name, "qubes.xml")
+
+            def query(self) -> List[str]:
+                test.queries += 1
+                return ["one", "two"]
+
+        self.inventory = Inventory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_queries_once_while_qubes_database_unchanged(self) -> None:
+        with open(self.inventory.QUBES_XML, "w") as f:
+            f.write("<qubes/>")
+        assert "one" in self.inventory
+        assert "three" not in self.inventory
+        assert self.inventory.names() == ["one", "two"]
+        assert self.queries == 1, self.queries
+        with open(self.inventory.QUBES_XML, "w") as f:
+            f.write("<qubes></qubes>")
+        assert "two" in self.inventory
+        assert self.queries == 2, self.queries
+
+    def test_expires_without_qubes_database(self) -> None:
+        assert "one" in self.inventory
+        assert "two" in self.inventory
+        assert self.queries == 1, self.queries
+        self.inventory._fetched -= self.inventory.TTL + 1
+        assert "one" in self.inventory
+        assert self.queries == 2, self.queries
+
+
+class TestBenchAuthorization(unittest.TestCase):
+    def test_bench_restores_configuration(self) -> None:
+        policy_db = sharedfolders.DecisionMatrix.POLICY_DB
+        inventory = sharedfolders.vm_inventory
+        results = bench_authorization.bench_size(50, 5, 2, 0)
+        timings = results["timings"]
+        assert "lookup_decision" in timings
+        assert "apply_policy_changes_from" in timings
+        for r in timings.values():
+            assert r["p50"] <= r["p90"] <= r["p99"] <= r["max"], r
+        assert results["memory"]["bytes per decision"] > 0, results
+        assert sharedfolders.DecisionMatrix.POLICY_DB == policy_db
+        assert sharedfolders.vm_inventory is inventory
+        assert sharedfolders._connect_to_folder_policy is None
+
+    def test_synthetic_matrix_is_valid(self) -> None:
+        import random
+
+        matrix = bench_authorization.synthetic_matrix(200, random.Random(1))
+        assert len(matrix) == 200
+        for d in matrix.values():
+            assert d.source != d.target
+            assert not (sharedfolders.is_disp(d.source) and not d.response.is_onetime())
+
+
+class TestBenchQfsd(unittest.TestCase):
+    def test_client_frames_messages(self) -> None:
+        r, w = os.pipe()
+        try:
+            client = bench_qfsd.Client(r, w)
+            tag = client.send(bench_qfsd.TREAD, b"abc", b"defg")
+            ty, received_tag, body = client.receive()
+            assert ty == bench_qfsd.TREAD, ty
+            assert received_tag == tag, received_tag
+            assert bytes(body) == b"abcdefg", bytes(body)
+        finally:
+            os.close(r)
+            os.close(w)
+
+
+class TestBenchMount(unittest.TestCase):
+    def test_workloads_run_on_a_local_folder(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trees = bench_mount.Trees(tmpdir, 150, 10, 3, 3 * 1024 * 1024, 20)
+            bench_mount.make_trees(trees)
+            assert len(os.listdir(os.path.join(tmpdir, "flat"))) == 10
+            runs = {
+                name: workload(trees)
+                for name, workload in bench_mount.WORKLOADS.items()
+                if name != "git-status" or os.path.isdir(tmpdir + "/small/.git")
+            }
+        assert runs["seq-read"].bytes == 3 * 1024 * 1024, runs["seq-read"]
+        assert runs["seq-write"].ops == 3, runs["seq-write"]
+        assert runs["rand-read"].bytes == 20 * 4096, runs["rand-read"]
+        assert runs["small-read"].ops == 150, runs["small-read"]
+        assert runs["stat"].ops == 150 + 3 * 8 + 10, runs["stat"]
+        result = bench_mount.summarize([runs["stat"], runs["stat"]])
+        assert result["p50 ms"] <= result["p99 ms"], result
+        assert "MB/s" not in result, result
+
+
+class TestCache9P(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.proxy = cache9p.Proxy(1024 * 1024, 10, lambda: self.now)
+        self.forward(cache9p.TATTACH, 1, struct.pack("<II", 0, 0xFFFFFFFF), b"")
+        self.proxy.response(cache9p.TATTACH + 1, 1, self.qid(1, 1))
+
+    def qid(self, version: int, path: int) -> bytes:
+        return cache9p.QID.pack(0, version, path)
+
+    def forward(self, ty: int, tag: int, *body: bytes) -> None:
+        assert self.proxy.request(ty, tag, b"".join(body)) is None
+
+    def walk(self, version: int) -> None:
+        self.forward(cache9p.TWALK, 2, struct.pack("<IIH", 0, 1, 1), b"\x01\x00f")
+        self.proxy.response(
+            cache9p.TWALK + 1, 2, struct.pack("<H", 1) + self.qid(version, 5)
+        )
+
+    def getattr(self) -> Optional[bytes]:
+        return self.proxy.request(cache9p.TGETATTR, 3, struct.pack("<IQ", 1, 0x7FF))
+
+    def test_getattr_is_answered_while_version_is_unchanged(self) -> None:
+        attrs = struct.pack("<Q", 0x7FF) + self.qid(7, 5) + b"attributes"
+        self.walk(7)
+        assert self.getattr() is None
+        self.proxy.response(cache9p.TGETATTR + 1, 3, attrs)
+
+        self.walk(7)
+        response = self.getattr()
+        assert (
+            response
+            == capture9p.HEADER.pack(
+                capture9p.HEADER.size + len(attrs), cache9p.TGETATTR + 1, 3
+            )
+            + attrs
+        ), response
+
+        # The file changed on the server.
+        self.walk(8)
+        assert self.getattr() is None
+
+    def test_cache_expires_and_is_dropped_by_changes(self) -> None:
+        read = struct.pack("<IQI", 1, 0, 4096)
+        self.walk(7)
+        self.forward(cache9p.TREAD, 4, read)
+        self.proxy.response(cache9p.TREAD + 1, 4, struct.pack("<I", 4) + b"data")
+        assert self.proxy.request(cache9p.TREAD, 4, read)
+
+        self.now += 11
+        assert self.proxy.request(cache9p.TREAD, 4, read) is None
+        self.proxy.response(cache9p.TREAD + 1, 4, struct.pack("<I", 4) + b"data")
+        self.walk(7)
+        assert self.proxy.request(cache9p.TREAD, 4, read)
+
+        self.forward(capture9p.TWRITE, 5, struct.pack("<IQI", 1, 0, 1), b"x")
+        assert self.proxy.request(cache9p.TREAD, 4, read) is None
+
+
+class TestCapture9P(unittest.TestCase):
+    def frame(self, ty: int, tag: int, body: bytes) -> bytes:
+        return capture9p.HEADER.pack(capture9p.HEADER.size + len(body), ty, tag) + body
+
+    def capture(self, frames: List[Tuple[int, int, bytes]]) -> List[str]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "capture")
+            with open(path, "wb") as f:
+                f.write(capture9p.MAGIC)
+                for direction, time_ns, frame in frames:
+                    recorder = capture9p.Recorder(f, direction)
+                    recorder.feed(memoryview(frame), time_ns)
+            return capture9p.report(capture9p.read_capture(path), 5)
+
+    def test_frames_split_across_chunks(self) -> None:
+        data = b"".join(
+            [
+                self.frame(capture9p.TREAD, 1, struct.pack("<IQI", 0, 0, 8192)),
+                self.frame(capture9p.TREAD + 1, 1, struct.pack("<I", 100) + b"x" * 100),
+                self.frame(capture9p.RLERROR, 2, struct.pack("<I", 2)),
+            ]
+        )
+        with tempfile.TemporaryFile() as f:
+            recorder = capture9p.Recorder(f, capture9p.SERVER_TO_CLIENT)
+            for i in range(0, len(data), 3):
+                recorder.feed(memoryview(data[i : i + 3]), i)
+            f.seek(0)
+            records = f.read()
+        fields = []
+        pos = 0
+        while pos < len(records):
+            record = capture9p.RECORD.unpack_from(records, pos)
+            fields.append(record[:5])
+            pos += capture9p.RECORD.size + record[5]
+        assert fields == [
+            (0, 1, 23, capture9p.TREAD, 1),
+            (21, 1, 111, capture9p.TREAD + 1, 1),
+            (132, 1, 11, capture9p.RLERROR, 2),
+        ], fields
+
+    def test_report(self) -> None:
+        walk = struct.pack("<IIH", 0, 1, 0)
+        read = struct.pack("<IQI", 1, 0, 4096)
+        lines = self.capture(
+            [
+                # Two walks made one after the other, then two reads at
+                # once, one of which fails.
+                (0, 0, self.frame(110, 1, walk)),
+                (1, 1000, self.frame(111, 1, struct.pack("<H", 0))),
+                (0, 2000, self.frame(110, 1, walk)),
+                (1, 4000, self.frame(111, 1, struct.pack("<H", 0))),
+                (0, 5000, self.frame(capture9p.TREAD, 1, read)),
+                (0, 5500, self.frame(capture9p.TREAD, 2, read)),
+                (1, 6000, self.frame(117, 1, struct.pack("<I", 10) + b"x" * 10)),
+                (1, 9000, self.frame(capture9p.RLERROR, 2, struct.pack("<I", 5))),
+            ]
+        )
+        assert lines[0].startswith("4 requests in 0.009 ms"), lines
+        read_line = [line for line in lines if line.startswith("read ")][0]
+        assert read_line.split()[:5] == ["read", "2", "1", "78", "10"], read_line
+        assert lines[-1].split()[:2] == ["3", "0.006"], lines
+
+
+class TestChanges(unittest.TestCase):
+    def test_records_split_across_reads(self) -> None:
+        records = changes.Records()
+        assert records.feed(b"Ca/b\0D") == [(changes.CHANGED, b"a/b")]
+        assert records.feed(b"\0*") == [(changes.ENTRIES, b"")]
+        assert records.feed(b"\0") == [(changes.EVERYTHING, b"")]
+
+    def test_drops_are_limited_to_files_of_the_mount(self) -> None:
+        now = [0.0]
+        dropped: List[int] = []
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "file"), "wb") as f:
+                f.write(b"data")
+            os.mkdir(os.path.join(d, "dir"))
+            os.symlink("file", os.path.join(d, "link"))
+            invalidator = changes.Invalidator(d, 1.0, dropped.append, lambda: now[0])
+            assert invalidator.mounted()
+            assert invalidator.drop_pages(b"file")
+            for path in [b"dir", b"link", b"missing", b"/etc/passwd", b"dir/../file"]:
+                assert not invalidator.drop_pages(path), path
+
+            invalidator.apply([(changes.CHANGED, b"file")])
+            assert invalidator.flush() is None
+            assert dropped == [changes.DROP_DENTRIES_AND_INODES], dropped
+
+            # Later changes wait for the interval to pass.
+            now[0] += 0.25
+            invalidator.apply([(changes.ENTRIES, b"dir")])
+            invalidator.apply([(changes.EVERYTHING, b"")])
+            assert invalidator.flush() == 0.75
+            now[0] += 0.75
+            assert invalidator.flush() is None
+            assert dropped[1:] == [changes.DROP_ALL], dropped
+            assert invalidator.flush() is None
+            assert len(dropped) == 2
+
+
+class TestMountOptions(unittest.TestCase):
+    def test_msize_is_passed_to_the_kernel(self) -> None:
+        options = programs.mount_options(1000, 1000, "user", "/home/user", 262144)
+        assert "msize=262144," in options, options
+        assert options.startswith("trans=fd,rfdno=0,wfdno=1,"), options
+        assert options.endswith(",aname=/home/user"), options
+
+    def test_profile_options_are_passed_to_the_kernel(self) -> None:
+        options = programs.parse_mount_options(
+            programs.MOUNT_PROFILES["static-readonly"]
+        )
+        options = programs.parse_mount_options("rw,cache=fscache", options)
+        mount_options = programs.mount_options(
+            1000, 1000, "user", "/home/user", 262144, options
+        )
+        assert (
+            ",msize=262144,cache=fscache,noatime,rw,dfltuid=" in mount_options
+        ), mount_options
+        assert mount_options.endswith(",aname=/home/user"), mount_options
+
+    def test_unsupported_options_are_rejected(self) -> None:
+        for option in ["trans=tcp", "access=any", "cache=bogus", "ro=1", "msize=1"]:
+            with self.assertRaises(ValueError):
+                programs.parse_mount_options(option)
+
+    def test_too_small_msize_is_rejected(self) -> None:
+        old_argv = sys.argv
+        sys.argv = ["qvm-mount-folder", "--msize", "100", "vm", "/", os.getcwd()]
+        try:
+            assert programs.QvmMountFolder() == os.EX_USAGE
+        finally:
+            sys.argv = old_argv
+
+
+class TestFingerprints(unittest.TestCase):
+    def test_fingerprints_are_remembered_and_forgotten(self) -> None:
+        old_cache = os.environ.get("XDG_CACHE_HOME")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ["XDG_CACHE_HOME"] = tmpdir
+            try:
+                assert programs.load_fingerprints() == {}
+                programs.save_fingerprint("qvm://one/home/user", "fprint")
+                programs.save_fingerprint("qvm://two/home/user", "fprint2")
+                programs.save_fingerprint("qvm://one/home/user", None)
+                assert programs.load_fingerprints() == {
+                    "qvm://two/home/user": "fprint2"
+                }
+                mode = os.stat(programs.fingerprints_path()).st_mode
+                assert mode & 0o077 == 0, oct(mode)
+            finally:
+                if old_cache is None:
+                    del os.environ["XDG_CACHE_HOME"]
+                else:
+                    os.environ["XDG_CACHE_HOME"] = old_cache
+
+
+class TestMountManifest(unittest.TestCase):
+    def test_lines_take_options_given_to_all(self) -> None:
+        parser = programs.mount_folder_parser()
+        defaults = parser.parse_args(["--cache", "loose", "-o", "noatime"])
+        defaults.from_file = None
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("# mounts\n\none /home/user /mnt/a\n")
+            f.write("two '/home/user/my files' /mnt/b --cache none -o ro\n")
+            f.flush()
+            mounts = programs.read_manifest(parser, f.name, defaults)
+        assert [(m.vm, m.source, m.target) for m in mounts] == [
+            ("one", "/home/user", "/mnt/a"),
+            ("two", "/home/user/my files", "/mnt/b"),
+        ]
+        assert [m.cache for m in mounts] == ["loose", "none"]
+        assert [m.options for m in mounts] == [["noatime"], ["noatime", "ro"]]
+
+    def test_incomplete_lines_are_rejected(self) -> None:
+        parser = programs.mount_folder_parser()
+        defaults = parser.parse_args([])
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("one /home/user\n")
+            f.flush()
+            with self.assertRaises(SystemExit):
+                programs.read_manifest(parser, f.name, defaults)
+
+    def test_mounts_are_made_at_the_same_time(self) -> None:
+        parser = programs.mount_folder_parser()
+        mounts = [parser.parse_args([vm, "/", "/mnt"]) for vm in ["a", "b", "c"]]
+        made = []
+
+        def mount(args: argparse.Namespace) -> int:
+            time.sleep(0.3)
+            if args.vm == "b":
+                return 13
+            made.append(args.vm)
+            return 0
+
+        started = time.monotonic()
+        assert programs.mount_manifest(mounts, mount) == 13
+        assert time.monotonic() - started < 0.8
+        assert sorted(made) == ["a", "c"]
+
+
+class TestMux9P(unittest.TestCase):
+    def test_sessions_get_fids_and_tags_of_their_own(self) -> None:
+        server_read, server_write = os.pipe()
+        server = cache9p.FrameReader(server_read)
+        mux = mux9p.Multiplexer(server_write, 8192)
+        kernels = []
+        sessions = []
+        for _ in range(2):
+            kernel, theirs = socket.socketpair()
+            session = mux.add(theirs.detach())
+            assert session
+            kernels.append(cache9p.FrameReader(kernel.detach()))
+            sessions.append(session)
+
+        # Versions are answered by the multiplexer.
+        mux.request(
+            sessions[0],
+            cache9p.TVERSION,
+            1,
+            struct.pack("<I", 65536) + b"\x08\x009P2000.L",
+        )
+        frame = kernels[0].read()
+        assert frame and frame[0] == cache9p.TVERSION + 1 and frame[1] == 1, frame
+        assert struct.unpack_from("<I", frame[3]) == (8192,)
+
+        walk = struct.pack("<IIH", 0, 1, 0)
+        tags = []
+        for session in sessions:
+            mux.request(session, cache9p.TWALK, 7, walk)
+            frame = server.read()
+            assert frame and frame[0] == cache9p.TWALK
+            fid = session.slot << mux9p.FID_BITS
+            assert frame[3] == struct.pack("<IIH", fid, fid | 1, 0), frame
+            tags.append(frame[1])
+        assert tags[0] != tags[1]
+
+        mux.response(cache9p.TWALK + 1, tags[1], struct.pack("<H", 0))
+        frame = kernels[1].read()
+        assert frame and frame[:2] == (cache9p.TWALK + 1, 7), frame
+        assert sessions[1].fids == {1 << mux9p.FID_BITS | 1}
+
+        # The fids a session leaves open are clunked when it ends.
+        mux.close(sessions[1])
+        frame = server.read()
+        assert frame and frame[0] == cache9p.TCLUNK
+        assert frame[3] == struct.pack("<I", 1 << mux9p.FID_BITS | 1), frame
+        assert not mux.done.is_set()
+        mux.close(sessions[0])
+        assert mux.done.is_set()
+        os.close(server_write)
+        server.f.close()
+
+
+class TestStartup(unittest.TestCase):
+    def test_programs_import_defers_heavy_work(self) -> None:
+        loaded = bench_startup.loaded_modules("sharedfolders.programs")
+        deferred = [m for m in bench_startup.DEFERRED_MODULES if m in loaded]
+        assert not deferred, deferred
+
+    def test_programs_import_creates_no_policy(self) -> None:
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sharedfolders, sharedfolders.programs;"
+                " print(sharedfolders._connect_to_folder_policy)",
+            ],
+            env=bench_startup.environment(),
+            universal_newlines=True,
+        )
+        assert output.strip() == "None", output
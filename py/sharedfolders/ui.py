@@ -15,7 +15,7 @@ from sharedfolders import (
     get_vm_list,
     DecisionMatrix,
     Response,
-    ConnectToFolderPolicy,
+    connect_to_folder_policy,
     is_disp,
 )
 
@@ -349,7 +349,7 @@ class FolderShareManager(Gtk.Window):  # type: ignore
             message = "One of your share policies has a problem:\n\n%s" % e
         try:
             self.working_decision_matrix.save()
-            ConnectToFolderPolicy.apply_policy_changes_from(
+            connect_to_folder_policy().apply_policy_changes_from(
                 self.working_decision_matrix
             )
         except Exception as f:
@@ -20,6 +20,7 @@ BuildRequires:  python3-devel
 BuildRequires:  desktop-file-utils
 BuildRequires:  cargo-rpm-macros >= 24
 BuildRequires:  python3-rpm-macros
+BuildRequires:  systemd-rpm-macros
 BuildRequires:  checkpolicy
 BuildRequires:  selinux-policy-devel
 Requires:       bash
@@ -62,9 +63,8 @@ make -f /usr/share/selinux/devel/Makefile -C selinux fix-qvm-mount-folder.pp
 %install
 rm -rf "$RPM_BUILD_ROOT"
 for target in install-client install-server install-dom0; do
-    make $target PYTHON=%{python3} DESTDIR="$RPM_BUILD_ROOT" BINDIR=%{_bindir} SYSCONFDIR=%{_sysconfdir} LIBEXECDIR=%{_libexecdir} DATADIR=%{_datadir} SITEPACKAGES=%{python3_sitelib} || exit $?
+    make $target PYTHON=%{python3} DESTDIR="$RPM_BUILD_ROOT" BINDIR=%{_bindir} SYSCONFDIR=%{_sysconfdir} LIBEXECDIR=%{_libexecdir} DATADIR=%{_datadir} USERUNITDIR=%{_userunitdir} SITEPACKAGES=%{python3_sitelib} || exit $?
 done
-touch "$RPM_BUILD_ROOT"/%{_sysconfdir}/qubes/shared-folders/policy.db
 
 install -d %{buildroot}%{_datadir}/selinux/packages
 install -p -m 644 selinux/fix-qvm-mount-folder.pp "$RPM_BUILD_ROOT"/%{_datadir}/selinux/packages/fix-qvm-mount-folder.pp
@@ -90,6 +90,7 @@ fi || :
 %attr(0755, root, root) %{_bindir}/qvm-mount-folder
 %attr(0755, root, root) %{_bindir}/qfsd
 %attr(0755, root, root) %{_sysconfdir}/qubes-rpc/ruddo.ConnectToFolder
+%attr(0755, root, root) %{_libexecdir}/qfsd-authorize-attach
 %attr(0644, root, root) %{python3_sitelib}/sharedfolders/*
 %{_datadir}/selinux/packages/fix-qvm-mount-folder.pp
 %doc README.md TODO.md doc
@@ -99,10 +100,16 @@ fi || :
 %attr(0644, root, root) %{_datadir}/applications/*.desktop
 %config(noreplace) %attr(0664, root, qubes) %{_sysconfdir}/qubes/policy.d/*-qubes-shared-folders.policy
 %dir %attr(2775, root, qubes) %{_sysconfdir}/qubes/shared-folders
+%ghost %config(noreplace) %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.sqlite
+%ghost %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.sqlite-journal
 %ghost %config(noreplace) %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.db
+%ghost %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/policy.db.migrated
+%ghost %attr(0664, root, qubes) %{_sysconfdir}/qubes/shared-folders/legacy-policies-migrated
 %attr(0755, root, root) %{_sysconfdir}/qubes-rpc/ruddo.AuthorizeFolderAccess
 %attr(0755, root, root) %{_sysconfdir}/qubes-rpc/ruddo.QueryFolderAuthorization
 %attr(0755, root, root) %{_libexecdir}/qvm-authorize-folder-access
+%attr(0755, root, root) %{_libexecdir}/qvm-folder-authorization-service
+%attr(0644, root, root) %{_userunitdir}/qvm-folder-authorization.service
 %attr(0644, root, root) %{python3_sitelib}/sharedfolders/*
 %attr(0755, root, root) %{_bindir}/qvm-folder-share-manager
 %doc README.md TODO.md doc src/test-qfsd-mount.py
@@ -1,28 +1,241 @@
-use p9::Server;
+use p9::{Config, Server};
 use std::collections::BTreeMap;
+use std::ffi::OsStr;
 use std::fs;
 use std::fs::File;
+use std::io;
 use std::io::ErrorKind;
+use std::mem;
+use std::os::unix::ffi::OsStrExt;
 use std::os::unix::io::FromRawFd;
 use std::path::Path;
+use std::path::PathBuf;
+use std::process::Command;
+use std::process::Stdio;
+use std::ptr;
+use std::sync::Arc;
+use std::thread;
+
+mod watch;
 
 const EX_OK: i32 = 0;
 const EX_SERVER_ERROR: i32 = 8;
 const EX_USAGE: i32 = 64;
 
+// Largest message offered to clients, unless set with --msize.  The
+// client may ask for smaller messages when it negotiates the version.
+const DEFAULT_MSIZE: u32 = 4 * 1024 * 1024 + 24;
+
+// Number of requests served at the same time, unless set with --workers.
+const DEFAULT_WORKERS: usize = 4;
+
+// Number of inodes and names whose metadata is cached, unless set with
+// --metadata-cache.  At most 1/64 of the inotify watches of the user are
+// used to keep them current, so that the qfsd of many mounts leave enough
+// for everything else, qfsd --watch included.
+const DEFAULT_METADATA_CACHE: usize = 16384;
+
+fn usage(program: &str) -> ! {
+    eprintln!(
+        "Usage: {} [--msize <bytes>] [--workers <count>] [--metadata-cache <entries>] [--splice-reads <true|false>] [--readahead <bytes>] [--stats <file>] [--watch <true|false>] [--attach-command <command>] [--aname <aname>] <readfd> <writefd> <mountpoint>",
+        program
+    );
+    eprintln!("Examples:");
+    eprintln!("");
+    eprintln!(
+        "  {} 0 1 /export # serves /export by reading from stdin and writing to stdout",
+        program
+    );
+    eprintln!("");
+    eprintln!("Note that the file descriptors passed must already be opened.",);
+    eprintln!(
+        "The largest 9P message size offered to the client defaults to {} bytes,",
+        DEFAULT_MSIZE
+    );
+    eprintln!(
+        "and may be set with --msize between {} and {} bytes.",
+        p9::MIN_MESSAGE_SIZE,
+        p9::MAX_MESSAGE_SIZE
+    );
+    eprintln!(
+        "Up to {} requests are served at the same time, unless set with --workers;",
+        DEFAULT_WORKERS
+    );
+    eprintln!("--workers 1 serves requests one by one.");
+    eprintln!(
+        "The metadata of up to {} files and names is cached, unless set with",
+        DEFAULT_METADATA_CACHE
+    );
+    eprintln!("--metadata-cache; --metadata-cache 0 disables the cache.  Cached files are");
+    eprintln!("watched with inotify, up to 1/64 of fs.inotify.max_user_watches per qfsd;");
+    eprintln!("those beyond that are cached for a second only.  inotify misses writes through");
+    eprintln!("shared memory mappings and changes made by other machines to network file");
+    eprintln!("systems, so attributes are cached for 5 seconds at most; such changes may go");
+    eprintln!("unnoticed for that long.  Use --metadata-cache 0 to serve them at once.");
+    eprintln!("With --splice-reads true, file data is spliced to the client without being");
+    eprintln!("copied when <writefd> is a pipe.");
+    eprintln!("With --readahead <bytes>, files read sequentially are prefetched that far");
+    eprintln!("ahead into the page cache.");
+    eprintln!("With --stats <file>, statistics of the requests served are written to <file>");
+    eprintln!("as JSON on SIGUSR1 and at exit; --stats - writes them to standard error.");
+    eprintln!("With --watch true, nothing is served; instead, the changes made to the files");
+    eprintln!("under <mountpoint> are reported to <writefd> until <readfd> is closed.");
+    eprintln!("With --attach-command <command>, the client may attach to other folders than");
+    eprintln!("<mountpoint>: attaches with an aname other than the one given with --aname are");
+    eprintln!("served from the folder <command> prints when run with the aname as argument,");
+    eprintln!("and refused if it fails.");
+    std::process::exit(EX_USAGE);
+}
+
+// Writes the statistics of `server` to `path`, or to standard error if it is "-".  Files are
+// replaced whole, so that they can be read at any time.
+fn write_stats(server: &Server, path: &str) {
+    let res = if path == "-" {
+        server.stats().write_json(&mut std::io::stderr().lock())
+    } else {
+        let tmp = format!("{}.tmp", path);
+        File::create(&tmp)
+            .and_then(|mut f| server.stats().write_json(&mut f))
+            .and_then(|()| fs::rename(&tmp, path))
+    };
+    if let Err(e) = res {
+        eprintln!("Cannot write statistics to {}: {}", path, e);
+    }
+}
+
+// Writes the statistics of `server` to `path` every time SIGUSR1 is received.  Must be called
+// before any other thread is started, so that they all block the signal and only the thread
+// started here receives it.
+fn write_stats_on_signal(server: Arc<Server>, path: String) {
+    // Safe because these only modify `set`, which they are given a valid pointer to.
+    let set = unsafe {
+        let mut set: libc::sigset_t = mem::zeroed();
+        libc::sigemptyset(&mut set);
+        libc::sigaddset(&mut set, libc::SIGUSR1);
+        libc::pthread_sigmask(libc::SIG_BLOCK, &set, ptr::null_mut());
+        set
+    };
+    thread::spawn(move || loop {
+        let mut signal = 0;
+        // Safe because this only modifies `signal`.
+        if unsafe { libc::sigwait(&set, &mut signal) } == 0 {
+            write_stats(&server, &path);
+        }
+    });
+}
+
+// Returns the roots of a server that serves attaches with `aname` from `root`, and the others
+// from the folder `command` prints for their aname.
+fn attach_roots(command: String, aname: String, root: &Path) -> p9::Roots {
+    let root = root.to_path_buf();
+    Box::new(move |requested| {
+        if requested == aname {
+            return Ok(root.clone());
+        }
+        // Asked every time, as the grant may have been revoked, or been for one mount only.
+        let output = Command::new(&command)
+            .arg(requested)
+            .stdin(Stdio::null())
+            .stderr(Stdio::inherit())
+            .output()?;
+        let folder = output.stdout.strip_suffix(b"\n").unwrap_or(&output.stdout);
+        let folder = PathBuf::from(OsStr::from_bytes(folder));
+        if !output.status.success() || folder.as_os_str().is_empty() || !folder.is_dir() {
+            eprintln!("Refused attach to {}", requested);
+            return Err(io::Error::from_raw_os_error(libc::EACCES));
+        }
+        Ok(folder)
+    })
+}
+
+// Exits with `code`, writing the statistics of `server` first if asked to.
+fn exit(server: &Server, stats: &Option<String>, code: i32) -> ! {
+    if let Some(path) = stats {
+        write_stats(server, path);
+    }
+    std::process::exit(code);
+}
+
 fn main() {
-    let args: Vec<_> = std::env::args().collect();
+    let mut args: Vec<_> = std::env::args().collect();
+    let mut msize = DEFAULT_MSIZE;
+    let mut workers = DEFAULT_WORKERS;
+    let mut metadata_cache = DEFAULT_METADATA_CACHE;
+    let mut splice_reads = false;
+    let mut readahead = 0;
+    let mut stats = None;
+    let mut watch = false;
+    let mut attach_command = None;
+    let mut aname = String::new();
+    while args.len() > 1 && args[1].starts_with("--") {
+        let option = args.remove(1);
+        if args.len() < 2 {
+            usage(&args[0]);
+        }
+        let value = args.remove(1);
+        match option.as_str() {
+            "--msize" => {
+                msize = match value.parse::<u32>() {
+                    Ok(m) if m >= p9::MIN_MESSAGE_SIZE && m <= p9::MAX_MESSAGE_SIZE => m,
+                    _ => {
+                        eprintln!("Invalid message size {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--workers" => {
+                workers = match value.parse::<usize>() {
+                    Ok(w) if w >= 1 => w,
+                    _ => {
+                        eprintln!("Invalid number of workers {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--metadata-cache" => {
+                metadata_cache = match value.parse::<usize>() {
+                    Ok(m) => m,
+                    _ => {
+                        eprintln!("Invalid metadata cache size {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--splice-reads" => {
+                splice_reads = match value.parse::<bool>() {
+                    Ok(s) => s,
+                    _ => {
+                        eprintln!("Invalid value for --splice-reads {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--readahead" => {
+                readahead = match value.parse::<u32>() {
+                    Ok(r) => r,
+                    _ => {
+                        eprintln!("Invalid readahead size {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--stats" => stats = Some(value),
+            "--watch" => {
+                watch = match value.parse::<bool>() {
+                    Ok(w) => w,
+                    _ => {
+                        eprintln!("Invalid value for --watch {}", value);
+                        std::process::exit(EX_USAGE);
+                    }
+                }
+            }
+            "--attach-command" => attach_command = Some(value),
+            "--aname" => aname = value,
+            _ => usage(&args[0]),
+        }
+    }
     if args.len() < 4 {
-        eprintln!("Usage: {} <readfd> <writefd> <mountpoint>", args[0]);
-        eprintln!("Examples:");
-        eprintln!("");
-        eprintln!(
-            "  {} 0 1 /export # serves /export by reading from stdin and writing to stdout",
-            args[0]
-        );
-        eprintln!("");
-        eprintln!("Note that the file descriptors passed must already be opened.",);
-        std::process::exit(EX_USAGE);
+        usage(&args[0]);
     }
 
     let readfd = match args[1].parse::<i32>() {
@@ -64,7 +277,26 @@ fn main() {
 
     let root = Path::new(&args[3]);
 
-    let mut server = match Server::new(root, BTreeMap::new(), BTreeMap::new()) {
+    if watch {
+        match watch::watch(root, readhalf, writehalf) {
+            Ok(()) => std::process::exit(EX_OK),
+            Err(e) => {
+                eprintln!("Fatal error watching {}: {}", args[3], e);
+                std::process::exit(EX_SERVER_ERROR);
+            }
+        }
+    }
+
+    let mut server = match Server::with_config(Config {
+        root: root.into(),
+        msize,
+        uid_map: BTreeMap::new(),
+        gid_map: BTreeMap::new(),
+        ascii_casefold: false,
+        metadata_cache,
+        splice_reads,
+        readahead,
+    }) {
         Ok(s) => s,
         Err(e) => {
             eprintln!("Fatal error starting server: {}", e);
@@ -72,6 +304,25 @@ fn main() {
         }
     };
 
+    if let Some(command) = attach_command {
+        server.set_roots(attach_roots(command, aname, root));
+    }
+    let server = Arc::new(server);
+
+    if let Some(ref path) = stats {
+        write_stats_on_signal(server.clone(), path.clone());
+    }
+
+    if workers > 1 {
+        match server.serve(readhalf, writehalf, workers) {
+            Ok(()) => exit(&server, &stats, EX_OK),
+            Err(e) => {
+                eprintln!("Fatal error handling request from client: {} ({:?})", e, e);
+                exit(&server, &stats, EX_SERVER_ERROR);
+            }
+        }
+    }
+
     loop {
         let res = server.handle_message(&mut readhalf, &mut writehalf);
         match res {
@@ -82,10 +333,10 @@ fn main() {
                     // not seem to provide a facility to distinguish EOF in the
                     // course of operations from EOF when client unmounts and
                     // the file descriptor is closed.
-                    std::process::exit(EX_OK);
+                    exit(&server, &stats, EX_OK);
                 };
                 eprintln!("Fatal error handling request from client: {} ({:?})", e, e);
-                std::process::exit(EX_SERVER_ERROR);
+                exit(&server, &stats, EX_SERVER_ERROR);
             }
             _ => (),
         }
@@ -6,6 +6,7 @@ import socket
 import subprocess
 import sys
 import logging
+from typing import List
 
 
 def error(message: str, exitstatus: int = 4) -> int:
@@ -19,9 +20,27 @@ def main() -> int:
     logger = logging.getLogger()
 
     hostname = socket.gethostname()
+    argv = sys.argv[1:]
+    capture = None
+    qfsd = "qfsd"
+    qfsd_args: List[str] = []
+    extra_options = ""
+    while argv[:1] in (["--capture"], ["--qfsd"], ["--qfsd-args"], ["-o"]):
+        if len(argv) < 2:
+            argv = []
+            break
+        if argv[0] == "--capture":
+            capture = argv[1]
+        elif argv[0] == "--qfsd":
+            qfsd = argv[1]
+        elif argv[0] == "--qfsd-args":
+            qfsd_args = shlex.split(argv[1])
+        else:
+            extra_options = "," + argv[1]
+        argv = argv[2:]
     try:
-        source = sys.argv[1]
-        target = sys.argv[2]
+        source = argv[0]
+        target = argv[1]
     except IndexError:
         relfile = os.path.relpath(__file__, os.getcwd())
         return error(
@@ -30,18 +49,31 @@ def main() -> int:
 usage:
 
     export PATH="/path/to/built/qfsd:$PATH"
-    {sys.executable} {relfile} <folder to export through qfsd> <mount point for the exported folder>
+    {sys.executable} {relfile} [options] <folder to export through qfsd> <mount point for the exported folder>
+
+options:
+
+    --qfsd <path>          the qfsd to run instead of the one in the PATH
+    --qfsd-args <args>     space-separated options for qfsd
+    -o <options>           comma-separated options added to the mount options
+    --capture <file>       record the 9P traffic of the mount to the file
 
 Note that this program will attempt to run the mount operation using sudo.
 If sudo is not passwordless and you are not running as root, the mount
 operation will fail.
+
+With --capture, the 9P traffic of the mount is recorded to the file until
+it is unmounted, and can be reported on with:
+
+    PYTHONPATH=py {sys.executable} -m sharedfolders.capture9p report <file>
 """,
             os.EX_USAGE,
         )
 
-    if not shutil.which("qfsd"):
+    if not shutil.which(qfsd):
         return error(
-            "qfsd cannot be found in the system PATH; did you cargo build it and export PATH?",
+            "%s cannot be found in the system PATH; did you cargo build it and export PATH?"
+            % qfsd,
             os.EX_USAGE,
         )
 
@@ -55,9 +87,23 @@ operation will fail.
 
     # With the fingerprint, use it to invoke the RPC service that was
     # just authorized for this script.
-    cmdline = ["qfsd", "0", "1", sys.argv[1]]
+    cmdline = [qfsd] + qfsd_args + ["0", "1", source]
     env = dict(os.environ.items())
     env["RUST_LOG"] = "info"
+    if capture:
+        # Record the traffic from between the mount and qfsd.
+        cmdline = [
+            sys.executable,
+            "-m",
+            "sharedfolders.capture9p",
+            "record",
+            capture,
+            "--",
+        ] + cmdline
+        py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py")
+        env["PYTHONPATH"] = os.pathsep.join(
+            [py] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        )
     logger.info("Running %s", shlex.join(cmdline))
     subprocess.Popen(
         cmdline,
@@ -74,16 +120,17 @@ operation will fail.
     gid = os.getgid()
     username = getpass.getuser()
     cmdline = [
-        "/usr/bin/sudo",
         "/usr/bin/mount",
         "-t",
         "9p",
         "-o",
-        "trans=fd,rfdno=%s,wfdno=%s,version=9p2000.L,dfltuid=%s,dfltgid=%s,uname=%s,aname=%s"
-        % (0, 1, uid, gid, username, source),
+        "trans=fd,rfdno=%s,wfdno=%s,version=9p2000.L,dfltuid=%s,dfltgid=%s,uname=%s,aname=%s%s"
+        % (0, 1, uid, gid, username, source, extra_options),
         "unpfs://%s%s" % (hostname, source),
         target,
     ]
+    if uid != 0:
+        cmdline = ["/usr/bin/sudo"] + cmdline
     logger.info("Running %s", shlex.join(cmdline))
     p2 = subprocess.Popen(
         cmdline, stdin=stdout_for_read, stdout=stdin_for_write, close_fds=True
@@ -0,0 +1,350 @@
+//! Reports the changes made to the files of an exported folder, so that clients that cache them
+//! can drop what they cached.
+//!
+//! 9P has no way for the server to tell a client that a file changed, so these reports travel
+//! outside of it, over a connection of their own.  The folder is watched with inotify, a watch per
+//! directory, and every change is written as a record: a byte telling what changed, the path of
+//! the file it changed relative to the folder, and a nul byte.  Changes that come in bursts are
+//! gathered for a moment and written together, each path once.
+//!
+//! Directories that cannot be watched, for instance once the limit of watches of the user is
+//! reached, are left out, and their changes go unreported.
+
+use std::collections::BTreeSet;
+use std::collections::HashMap;
+use std::ffi::CStr;
+use std::ffi::CString;
+use std::ffi::OsStr;
+use std::fs;
+use std::fs::File;
+use std::io;
+use std::io::Read;
+use std::io::Write;
+use std::mem::size_of;
+use std::os::unix::ffi::OsStrExt;
+use std::os::unix::ffi::OsStringExt;
+use std::os::unix::io::AsRawFd;
+use std::os::unix::io::FromRawFd;
+use std::path::Path;
+use std::path::PathBuf;
+use std::ptr;
+use std::time::Duration;
+use std::time::Instant;
+
+/// The contents or the attributes of the file changed.
+pub const CHANGED: u8 = b'C';
+/// Entries were added to or removed from the directory.
+pub const ENTRIES: u8 = b'D';
+/// Anything may have changed, because changes were lost.  The path is empty.
+pub const EVERYTHING: u8 = b'*';
+
+const WATCH_MASK: u32 = libc::IN_MODIFY
+    | libc::IN_ATTRIB
+    | libc::IN_CLOSE_WRITE
+    | libc::IN_CREATE
+    | libc::IN_DELETE
+    | libc::IN_MOVED_FROM
+    | libc::IN_MOVED_TO
+    | libc::IN_ONLYDIR
+    | libc::IN_DONT_FOLLOW;
+
+// How long changes are gathered after the first one before they are reported, and how long at
+// most while they keep coming.
+const SETTLE: Duration = Duration::from_millis(50);
+const GATHER: Duration = Duration::from_secs(1);
+
+/// Watches every directory under a folder.
+pub struct Watcher {
+    root: PathBuf,
+    inotify: File,
+    // The path of the directory of every watch, relative to the root.
+    dirs: HashMap<libc::c_int, PathBuf>,
+    // Whether a directory could not be watched for lack of watches, which is only logged once.
+    exhausted: bool,
+}
+
+impl Watcher {
+    pub fn new(root: &Path) -> io::Result<Watcher> {
+        // Safe because this doesn't modify any memory and we check the return value.
+        let fd = unsafe { libc::inotify_init1(libc::IN_CLOEXEC) };
+        if fd < 0 {
+            return Err(io::Error::last_os_error());
+        }
+        let mut watcher = Watcher {
+            root: root.into(),
+            // Safe because we just opened this fd.
+            inotify: unsafe { File::from_raw_fd(fd) },
+            dirs: HashMap::new(),
+            exhausted: false,
+        };
+        watcher.add_tree(PathBuf::new());
+        Ok(watcher)
+    }
+
+    pub fn inotify_fd(&self) -> &File {
+        &self.inotify
+    }
+
+    // Watches the directory at `dir`, relative to the root, and the directories under it.
+    fn add_tree(&mut self, dir: PathBuf) {
+        let path = match CString::new(self.root.join(&dir).into_os_string().into_vec()) {
+            Ok(p) => p,
+            Err(_) => return,
+        };
+        // Safe because this doesn't modify any memory and we check the return value.
+        let wd =
+            unsafe { libc::inotify_add_watch(self.inotify.as_raw_fd(), path.as_ptr(), WATCH_MASK) };
+        if wd < 0 {
+            let err = io::Error::last_os_error();
+            if err.raw_os_error() == Some(libc::ENOSPC) && !self.exhausted {
+                eprintln!(
+                    "Cannot watch {}: {}; its changes will not be reported",
+                    path.to_string_lossy(),
+                    err
+                );
+                self.exhausted = true;
+            }
+            return;
+        }
+        self.dirs.insert(wd, dir.clone());
+
+        let entries = match fs::read_dir(self.root.join(&dir)) {
+            Ok(e) => e,
+            Err(_) => return,
+        };
+        for entry in entries.flatten() {
+            // The type of the entry itself, so that symbolic links are not followed.
+            if entry.file_type().map(|t| t.is_dir()).unwrap_or(false) {
+                self.add_tree(dir.join(entry.file_name()));
+            }
+        }
+    }
+
+    // Drops every watch and watches the whole folder again.
+    fn rewatch(&mut self) -> io::Result<()> {
+        let watcher = Watcher::new(&self.root)?;
+        *self = watcher;
+        Ok(())
+    }
+
+    /// Waits for changes and returns them as records, each once.
+    pub fn changes(&mut self) -> io::Result<BTreeSet<(u8, Vec<u8>)>> {
+        let mut changes = BTreeSet::new();
+        let mut rewatch = false;
+        self.read_events(&mut changes, &mut rewatch)?;
+
+        let started = Instant::now();
+        while started.elapsed() < GATHER && poll(&self.inotify, SETTLE)? {
+            self.read_events(&mut changes, &mut rewatch)?;
+        }
+
+        if rewatch {
+            // Changes made while the folder is watched again are lost.
+            self.rewatch()?;
+            changes.insert((EVERYTHING, Vec::new()));
+        }
+        if changes.contains(&(EVERYTHING, Vec::new())) {
+            changes.retain(|(kind, _)| *kind == EVERYTHING);
+        }
+        Ok(changes)
+    }
+
+    fn read_events(
+        &mut self,
+        changes: &mut BTreeSet<(u8, Vec<u8>)>,
+        rewatch: &mut bool,
+    ) -> io::Result<()> {
+        let mut buf = [0u8; 64 * 1024];
+        let len = (&self.inotify).read(&mut buf)?;
+
+        let events = &buf[..len];
+        let mut offset = 0;
+        while offset + size_of::<libc::inotify_event>() <= events.len() {
+            // Safe because the kernel wrote a whole event here, and it is read unaligned.
+            let event = unsafe {
+                ptr::read_unaligned(events[offset..].as_ptr() as *const libc::inotify_event)
+            };
+            let start = offset + size_of::<libc::inotify_event>();
+            offset = start + event.len as usize;
+            // The name is padded with nul bytes, and missing for events on the watched directory
+            // itself.
+            let name = CStr::from_bytes_until_nul(&events[start..offset]).unwrap_or_default();
+            self.event(event.wd, event.mask, name, changes, rewatch);
+        }
+        Ok(())
+    }
+
+    fn event(
+        &mut self,
+        wd: libc::c_int,
+        mask: u32,
+        name: &CStr,
+        changes: &mut BTreeSet<(u8, Vec<u8>)>,
+        rewatch: &mut bool,
+    ) {
+        if mask & libc::IN_Q_OVERFLOW != 0 {
+            changes.insert((EVERYTHING, Vec::new()));
+            return;
+        }
+        if mask & libc::IN_IGNORED != 0 {
+            self.dirs.remove(&wd);
+            return;
+        }
+        let dir = match self.dirs.get(&wd) {
+            Some(d) => d.clone(),
+            None => return,
+        };
+        if name.to_bytes().is_empty() {
+            if mask & libc::IN_ATTRIB != 0 {
+                changes.insert((CHANGED, dir.into_os_string().into_vec()));
+            }
+            return;
+        }
+
+        let path = dir.join(OsStr::from_bytes(name.to_bytes()));
+        if mask & (libc::IN_MODIFY | libc::IN_ATTRIB | libc::IN_CLOSE_WRITE) != 0 {
+            changes.insert((CHANGED, path.clone().into_os_string().into_vec()));
+        }
+        if mask & (libc::IN_CREATE | libc::IN_DELETE | libc::IN_MOVED_FROM | libc::IN_MOVED_TO) != 0
+        {
+            changes.insert((ENTRIES, dir.into_os_string().into_vec()));
+        }
+        if mask & libc::IN_ISDIR != 0 {
+            if mask & (libc::IN_CREATE | libc::IN_MOVED_TO) != 0 {
+                self.add_tree(path);
+            } else if mask & libc::IN_MOVED_FROM != 0 {
+                // The watches under the directory moved know it by its old path.
+                *rewatch = true;
+            }
+        }
+    }
+}
+
+// Waits up to `timeout` for `file` to be readable.
+fn poll(file: &File, timeout: Duration) -> io::Result<bool> {
+    let mut fds = [libc::pollfd {
+        fd: file.as_raw_fd(),
+        events: libc::POLLIN,
+        revents: 0,
+    }];
+    // Safe because this only modifies `fds`, and we check the return value.
+    let ret = unsafe { libc::poll(fds.as_mut_ptr(), 1, timeout.as_millis() as libc::c_int) };
+    if ret < 0 {
+        let err = io::Error::last_os_error();
+        if err.kind() == io::ErrorKind::Interrupted {
+            return Ok(true);
+        }
+        return Err(err);
+    }
+    Ok(ret > 0)
+}
+
+/// Writes `changes` as records to `writer`, at once.
+pub fn write_changes<W: Write>(
+    writer: &mut W,
+    changes: &BTreeSet<(u8, Vec<u8>)>,
+) -> io::Result<()> {
+    let mut records = Vec::new();
+    for (kind, path) in changes {
+        records.push(*kind);
+        records.extend_from_slice(path);
+        records.push(0);
+    }
+    writer.write_all(&records)
+}
+
+/// Reports the changes made under `root` to `writer` until `reader`, which the client does not
+/// write to, reaches its end.
+pub fn watch(root: &Path, mut reader: File, mut writer: File) -> io::Result<()> {
+    let mut watcher = Watcher::new(root)?;
+    loop {
+        let mut fds = [
+            libc::pollfd {
+                fd: watcher.inotify_fd().as_raw_fd(),
+                events: libc::POLLIN,
+                revents: 0,
+            },
+            libc::pollfd {
+                fd: reader.as_raw_fd(),
+                events: libc::POLLIN,
+                revents: 0,
+            },
+        ];
+        // Safe because this only modifies `fds`, and we check the return value.
+        if unsafe { libc::poll(fds.as_mut_ptr(), 2, -1) } < 0 {
+            let err = io::Error::last_os_error();
+            if err.kind() == io::ErrorKind::Interrupted {
+                continue;
+            }
+            return Err(err);
+        }
+        if fds[1].revents != 0 {
+            let mut buf = [0u8; 4096];
+            if reader.read(&mut buf)? == 0 {
+                return Ok(());
+            }
+        }
+        if fds[0].revents != 0 {
+            let changes = watcher.changes()?;
+            match write_changes(&mut writer, &changes) {
+                Ok(()) => (),
+                // The client went away.
+                Err(e) if e.kind() == io::ErrorKind::BrokenPipe => return Ok(()),
+                Err(e) => return Err(e),
+            }
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn record(kind: u8, path: &str) -> (u8, Vec<u8>) {
+        (kind, path.as_bytes().to_vec())
+    }
+
+    #[test]
+    fn changes() {
+        let mut root = std::env::temp_dir();
+        root.push(format!("qfsd-watch-{}", std::process::id()));
+        let _ = fs::remove_dir_all(&root);
+        fs::create_dir_all(root.join("a/b")).unwrap();
+        fs::write(root.join("a/b/file"), b"old").unwrap();
+
+        let mut watcher = Watcher::new(&root).unwrap();
+
+        fs::write(root.join("a/b/file"), b"new").unwrap();
+        fs::create_dir(root.join("c")).unwrap();
+        let changes = watcher.changes().unwrap();
+        assert!(changes.contains(&record(CHANGED, "a/b/file")));
+        assert!(changes.contains(&record(ENTRIES, "")));
+        assert!(!changes.contains(&record(EVERYTHING, "")));
+
+        // Directories created are watched as well.
+        fs::write(root.join("c/file"), b"").unwrap();
+        let changes = watcher.changes().unwrap();
+        assert!(changes.contains(&record(ENTRIES, "c")));
+        assert!(changes.contains(&record(CHANGED, "c/file")));
+
+        // Moving a directory away changes the paths of everything under it.
+        fs::rename(root.join("a"), root.join("d")).unwrap();
+        let changes = watcher.changes().unwrap();
+        assert_eq!(changes, [record(EVERYTHING, "")].into_iter().collect());
+        fs::write(root.join("d/b/file"), b"newer").unwrap();
+        let changes = watcher.changes().unwrap();
+        assert!(changes.contains(&record(CHANGED, "d/b/file")));
+
+        let mut out = Vec::new();
+        write_changes(
+            &mut out,
+            &[record(ENTRIES, ""), record(CHANGED, "x")]
+                .into_iter()
+                .collect(),
+        )
+        .unwrap();
+        assert_eq!(out, b"Cx\0D\0");
+
+        fs::remove_dir_all(&root).unwrap();
+    }
+}